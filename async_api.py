@@ -0,0 +1,152 @@
+import executors
+import db
+import auth
+import file_manager
+import zip_manager
+import json_xml_handler
+# уже асинхронные операции file_manager - часть фасада
+from file_manager import (
+    async_write_file, async_write_file_stream, async_read_file, async_read_file_stream, async_run_batch
+)
+
+# асинхронный фасад всех операций: блокирующие вызовы идут в отдельные пулы executors,
+# event loop не блокируется. диск и бд - пул io, сжатие и разбор JSON/XML - пул cpu, bcrypt - пул процессов
+
+
+async def async_register_user(username: str, password: str) -> None:
+    # bcrypt - в пуле процессов
+    await auth.async_register_user(username, password)
+
+
+async def async_login_user(username: str, password: str) -> int:
+    return await auth.async_login_user(username, password)
+
+
+async def async_login_session(username: str, password: str) -> tuple[int, str]:
+    return await auth.async_login_session(username, password)
+
+
+async def async_validate_session(token: str) -> tuple[int, str]:
+    return await auth.async_validate_session(token)
+
+
+async def async_logout(token: str) -> None:
+    await executors.run_io(auth.logout, token)
+
+
+async def async_read_file_mmap(path: str, user_id: int, user_dir: str, offset: int = 0, count: int = None) -> memoryview:
+    return await executors.run_io(file_manager.read_file_mmap, path, user_id, user_dir, offset, count)
+
+
+async def async_delete_file(path: str, user_id: int, user_dir: str) -> None:
+    await executors.run_io(file_manager.delete_file, path, user_id, user_dir)
+
+
+async def async_copy_file(src_path: str, dest_path: str, user_id: int, user_dir: str) -> None:
+    await executors.run_io(file_manager.copy_file, src_path, dest_path, user_id, user_dir)
+
+
+async def async_move_file(src_path: str, dest_path: str, user_id: int, user_dir: str) -> None:
+    await executors.run_io(file_manager.move_file, src_path, dest_path, user_id, user_dir)
+
+
+async def async_create_directory(subdir: str, user_id: int, user_dir: str) -> None:
+    await executors.run_io(file_manager.create_directory, subdir, user_id, user_dir)
+
+
+async def async_delete_directory(subdir: str, user_id: int, user_dir: str, recursive: bool = False) -> None:
+    await executors.run_io(file_manager.delete_directory, subdir, user_id, user_dir, recursive)
+
+
+async def async_move_directory(src_subdir: str, dest_subdir: str, user_id: int, user_dir: str) -> None:
+    await executors.run_io(file_manager.move_directory, src_subdir, dest_subdir, user_id, user_dir)
+
+
+async def async_list_directory(subdir: str, user_id: int, user_dir: str) -> list:
+    return await executors.run_io(file_manager.list_directory, subdir, user_id, user_dir)
+
+
+async def async_list_directory_page(subdir: str, user_id: int, user_dir: str, after: tuple | None = None,
+                                    limit: int = file_manager.LIST_PAGE_SIZE, sort: str = "name",
+                                    reverse: bool = False, pattern: str | None = None):
+    return await executors.run_io(file_manager.list_directory_page, subdir, user_id, user_dir,
+                                  after, limit, sort, reverse, pattern)
+
+
+async def async_iter_directory(subdir: str, user_id: int, user_dir: str, sort: str = "name",
+                               reverse: bool = False, pattern: str | None = None,
+                               page_size: int = file_manager.LIST_PAGE_SIZE):
+    # листинг async генератором, каждая страница читается в пуле io
+    after = None
+    while True:
+        entries, after = await async_list_directory_page(subdir, user_id, user_dir, after, page_size,
+                                                         sort, reverse, pattern)
+        for entry in entries:
+            yield entry
+        if after is None:
+            return
+
+
+async def async_create_archive(paths: list[str], zip_path: str, user_id: int, user_dir: str) -> dict:
+    return await executors.run_cpu(zip_manager.create_archive, paths, zip_path, user_id, user_dir)
+
+
+async def async_extract_zip(zip_path: str, user_id: int, user_dir: str) -> None:
+    await executors.run_cpu(zip_manager.extract_zip, zip_path, user_id, user_dir)
+
+
+async def async_write_json(path: str, json_str: str, user_id: int, user_dir: str,
+                           ignore_null: bool = False, write_indented: bool = True) -> None:
+    await executors.run_cpu(json_xml_handler.write_json, path, json_str, user_id, user_dir, ignore_null, write_indented)
+
+
+async def async_read_json(path: str, user_id: int, user_dir: str) -> str:
+    return await executors.run_cpu(json_xml_handler.read_json, path, user_id, user_dir)
+
+
+async def async_read_json_page(path: str, user_id: int, user_dir: str, start: int = 0,
+                              count: int = json_xml_handler.JSON_PAGE_LINES) -> tuple[list[str], int | None]:
+    return await executors.run_cpu(json_xml_handler.read_json_page, path, user_id, user_dir, start, count)
+
+
+async def async_patch_json(path: str, operations: list[dict], user_id: int, user_dir: str,
+                           write_indented: bool = True) -> None:
+    await executors.run_cpu(json_xml_handler.patch_json, path, operations, user_id, user_dir, write_indented)
+
+
+async def async_update_json(path: str, updates: dict, user_id: int, user_dir: str,
+                            write_indented: bool = True) -> None:
+    await executors.run_cpu(json_xml_handler.update_json, path, updates, user_id, user_dir, write_indented)
+
+
+async def async_write_xml(path: str, xml_str: str, user_id: int, user_dir: str) -> None:
+    await executors.run_cpu(json_xml_handler.write_xml, path, xml_str, user_id, user_dir)
+
+
+async def async_read_xml(path: str, user_id: int, user_dir: str) -> str:
+    return await executors.run_cpu(json_xml_handler.read_xml, path, user_id, user_dir)
+
+
+async def async_read_xml_page(path: str, user_id: int, user_dir: str, start: int = 0,
+                             count: int = json_xml_handler.JSON_PAGE_LINES) -> tuple[list[str], int | None]:
+    return await executors.run_cpu(json_xml_handler.read_xml_page, path, user_id, user_dir, start, count)
+
+
+async def async_edit_xml_add_element(path: str, xpath: str, new_element_name: str, new_value: str,
+                                     user_id: int, user_dir: str) -> None:
+    await executors.run_cpu(json_xml_handler.edit_xml_add_element, path, xpath, new_element_name, new_value,
+                            user_id, user_dir)
+
+
+async def async_get_user_files(owner_id: int):
+    return await executors.run_io(db.get_user_files, owner_id)
+
+
+async def async_get_usage(owner_id: int) -> tuple[int, int, int | None]:
+    # (байт, файлов, квота) - квота уже с учётом общего лимита
+    used, files, quota = await executors.run_io(db.get_usage_stats, owner_id)
+    return used, files, file_manager.USER_QUOTA if quota is None else quota
+
+
+async def async_get_user_files_page(owner_id: int, limit: int, after: tuple | None = None):
+    return await executors.run_io(db.get_user_files_page, owner_id, limit, after)
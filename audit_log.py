@@ -0,0 +1,183 @@
+import atexit
+import datetime
+import os
+import queue
+import sys
+import threading
+import time
+import db
+
+# журнал операций (таблица Operations) с выбором надёжности записи:
+# sync  - запись в транзакции самой операции (по умолчанию, журнал всегда согласован с Files);
+# group - после commit операции запись уходит фоновому писателю, вызывающий ждёт, пока её пачка
+#         не будет записана: одновременные операции делят один commit журнала;
+# async - после commit операции запись ставится в очередь и вызывающий сразу продолжает,
+#         пачки пишутся по размеру/времени; при аварийном завершении теряется последняя пачка.
+# в очередь попадают только операции из закоммиченных транзакций (db.on_commit),
+# время операции фиксируется при её выполнении, а не при записи пачки
+
+SYNC = "sync"
+GROUP = "group"
+ASYNC = "async"
+
+MODE = SYNC
+QUEUE_SIZE = 10000  # записей в очереди; при заполнении операции ждут писателя (backpressure)
+BATCH_SIZE = 500  # записей в одном executemany/commit
+FLUSH_INTERVAL = 0.5  # async: сколько секунд запись может ждать в очереди
+GROUP_COMMIT_DELAY = 0.002  # group: ожидание одновременных операций для общего commit
+
+# ротация: записи старше RETENTION_DAYS удаляются (None - хранить всё),
+# ARCHIVE_PATH - перед удалением переносятся в отдельную бд
+RETENTION_DAYS = None
+ARCHIVE_PATH = None
+ROTATE_INTERVAL = 3600  # секунд между ротациями фонового писателя
+WRITE_RETRIES = 50  # попыток записи пачки (через 0.1 с), затем пачка отбрасывается с сообщением
+
+_STOP = object()
+
+_queue = None
+_writer = None
+_pid = None
+_writer_lock = threading.Lock()
+
+
+def configure(mode: str = SYNC, retention_days: int | None = None, archive_path: str | None = None):
+    global MODE, RETENTION_DAYS, ARCHIVE_PATH
+    if mode not in (SYNC, GROUP, ASYNC):
+        raise ValueError(f"Неизвестный режим журнала: {mode}")
+    flush()
+    MODE = mode
+    RETENTION_DAYS = retention_days
+    ARCHIVE_PATH = archive_path
+    if mode != SYNC or retention_days is not None:
+        _ensure_writer()
+
+
+def _now() -> str:
+    # в том же виде, что CURRENT_TIMESTAMP SQLite (UTC)
+    return datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def record(operation_type: str, file_id: int | None, user_id: int, conn=None):
+    record_many([(operation_type, file_id)], user_id, conn)
+
+
+def record_many(operations: list[tuple[str, int | None]], user_id: int, conn=None):
+    # запись операций [(тип, id файла)] пользователя в журнал в текущем режиме
+    if MODE == SYNC:
+        db.log_operations(operations, user_id, conn)
+        return
+    rows = [(_now(), operation_type, file_id, user_id) for operation_type, file_id in operations]
+    wait = MODE == GROUP
+    db.on_commit(lambda: _enqueue(rows, wait))
+
+
+def _ensure_writer() -> queue.Queue:
+    global _queue, _writer, _pid
+    with _writer_lock:
+        # после fork поток писателя родителя не существует - свой писатель и своя очередь
+        if _writer is None or _pid != os.getpid() or not _writer.is_alive():
+            _queue = queue.Queue(QUEUE_SIZE)
+            _pid = os.getpid()
+            _writer = threading.Thread(target=_run, args=(_queue,), name="sfm-audit", daemon=True)
+            _writer.start()
+        return _queue
+
+
+def _enqueue(rows: list[tuple], wait: bool):
+    done = threading.Event() if wait else None
+    _ensure_writer().put((rows, done))
+    if done is not None:
+        done.wait()
+
+
+def _write(pending: list[tuple]):
+    rows = [row for batch, _ in pending if batch for row in batch]
+    for attempt in range(WRITE_RETRIES if rows else 0):
+        try:
+            with db.transaction() as conn:
+                db.insert_operations(rows, conn)
+            break
+        except Exception as e:
+            # бд занята дольше BUSY_TIMEOUT и т.п.: повторяем, ожидающие операции не зависают навсегда
+            if attempt == WRITE_RETRIES - 1:
+                print(f"Журнал операций: {len(rows)} записей потеряно ({e})", file=sys.stderr)
+            else:
+                time.sleep(0.1)
+    for _, done in pending:
+        if done is not None:
+            done.set()
+
+
+def _rotate_if_due(last_rotation: float) -> float:
+    if RETENTION_DAYS is None or time.monotonic() - last_rotation < ROTATE_INTERVAL:
+        return last_rotation
+    try:
+        rotate()
+    except Exception as e:
+        print(f"Журнал операций: ошибка ротации ({e})", file=sys.stderr)
+    return time.monotonic()
+
+
+def _run(q: queue.Queue):
+    # фоновый писатель: копит записи до BATCH_SIZE или до истечения задержки режима
+    pending = []
+    count = 0
+    deadline = None
+    last_rotation = time.monotonic() - ROTATE_INTERVAL
+    while True:
+        timeout = 1.0 if deadline is None else max(0.0, deadline - time.monotonic())
+        try:
+            item = q.get(timeout=timeout)
+        except queue.Empty:
+            item = None
+        if item is _STOP:
+            _write(pending)
+            return
+        force = False
+        if item is not None:
+            rows, _ = item
+            pending.append(item)
+            if rows is None:
+                force = True  # flush(): записать накопленное сразу
+            else:
+                count += len(rows)
+                if deadline is None:
+                    deadline = time.monotonic() + (GROUP_COMMIT_DELAY if MODE == GROUP else FLUSH_INTERVAL)
+        if pending and (force or count >= BATCH_SIZE or deadline is not None and time.monotonic() >= deadline):
+            _write(pending)
+            pending, count, deadline = [], 0, None
+        last_rotation = _rotate_if_due(last_rotation)
+
+
+def flush():
+    # дождаться записи всего, что уже в очереди
+    if _writer is None or _pid != os.getpid() or not _writer.is_alive():
+        return
+    done = threading.Event()
+    _queue.put((None, done))
+    done.wait()
+
+
+def shutdown():
+    # запись очереди и остановка писателя (при выходе из программы, до close_db_connections)
+    global _writer
+    with _writer_lock:
+        writer, q = _writer, _queue
+        _writer = None
+    if writer is None or _pid != os.getpid() or not writer.is_alive():
+        return
+    q.put(_STOP)
+    writer.join()
+
+
+def rotate(retention_days: int | None = None, archive_path: str | None = None) -> int:
+    # удаление (и перенос в архив) записей старше retention_days дней, возвращает их число
+    days = RETENTION_DAYS if retention_days is None else retention_days
+    if days is None:
+        return 0
+    before = (datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=days)).strftime("%Y-%m-%d %H:%M:%S")
+    return db.rotate_operations(before, archive_path or ARCHIVE_PATH)
+
+
+atexit.register(shutdown)
@@ -1,23 +1,162 @@
 import bcrypt
 import sqlite3
+import hashlib
+import secrets
+import threading
+import time
+from collections import OrderedDict
 import db
+import metrics
+import executors
 
-def register_user(username: str, password: str):
+BCRYPT_ROUNDS = 12  # стоимость bcrypt; при изменении хэши пересчитываются при следующем входе
+SESSION_TTL = 7 * 24 * 3600  # секунд жизни токена сессии
+SESSION_CACHE_SIZE = 10000  # сессий в памяти процесса
+# сколько секунд доверять кэшу без обращения к бд: выход из сессии в другом процессе
+# виден здесь не позже чем через это время
+SESSION_CACHE_TTL = 60
+
+# кэш сессий: sha256(токен) -> (id пользователя, логин, срок действия, когда проверено в бд)
+_sessions = OrderedDict()
+_sessions_lock = threading.Lock()
+
+
+def _validate_registration(username: str, password: str):
     if len(username) < 3:
         raise ValueError("Логин должен содержать минимум 3 символа")
+    # логин - имя директории в хранилище: без разделителей и служебных имён (.locks и т.п.)
+    if username.startswith(".") or "/" in username or "\\" in username:
+        raise ValueError("Логин не может начинаться с точки и содержать / или \\")
     if len(password) < 6:
         raise ValueError("Пароль должен содержать минимум 6 символов")
-    # хэширование пароля
-    password_hash = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+
+# bcrypt - сотни миллисекунд CPU на вызов. Функции ниже - верхнего уровня,
+# чтобы async API мог выполнить их в пуле процессов executors
+
+def _hash_password(password: str, rounds: int) -> str:
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds)).decode('utf-8')
+
+def _check_password(password: str, password_hash: str) -> bool:
+    return bcrypt.checkpw(password.encode('utf-8'), password_hash.encode('utf-8'))
+
+def _needs_rehash(password_hash: str) -> bool:
+    # $2b$12$...: стоимость - третье поле
+    try:
+        return int(password_hash.split("$")[2]) != BCRYPT_ROUNDS
+    except (IndexError, ValueError):
+        return True
+
+def _add_user(username: str, password_hash: str):
     try:
         db.add_user(username, password_hash)
     except sqlite3.IntegrityError:
         raise ValueError("Пользователь с таким логином уже существует")
 
+@metrics.timed()
+def register_user(username: str, password: str):
+    _validate_registration(username, password)
+    # хэширование пароля
+    _add_user(username, _hash_password(password, BCRYPT_ROUNDS))
+
+@metrics.timed()
+async def async_register_user(username: str, password: str):
+    # bcrypt в пуле процессов, запись в бд - в пуле io
+    _validate_registration(username, password)
+    password_hash = await executors.run_process(_hash_password, password, BCRYPT_ROUNDS)
+    await executors.run_io(_add_user, username, password_hash)
+
+@metrics.timed()
 def login_user(username: str, password: str) -> int:
     user = db.get_user(username)
     if not user:
         raise ValueError("Неверный логин или пароль")
-    if not bcrypt.checkpw(password.encode('utf-8'), user[2].encode('utf-8')):
+    if not _check_password(password, user[2]):
         raise ValueError("Неверный логин или пароль")
-    return user[0]
\ No newline at end of file
+    if _needs_rehash(user[2]):
+        db.update_password_hash(user[0], _hash_password(password, BCRYPT_ROUNDS))
+    return user[0]
+
+@metrics.timed()
+async def async_login_user(username: str, password: str) -> int:
+    user = await executors.run_io(db.get_user, username)
+    if not user:
+        raise ValueError("Неверный логин или пароль")
+    if not await executors.run_process(_check_password, password, user[2]):
+        raise ValueError("Неверный логин или пароль")
+    if _needs_rehash(user[2]):
+        password_hash = await executors.run_process(_hash_password, password, BCRYPT_ROUNDS)
+        await executors.run_io(db.update_password_hash, user[0], password_hash)
+    return user[0]
+
+# сессии: после входа клиент предъявляет токен, проверка токена - поиск в кэше или одна строка бд,
+# без bcrypt. в бд хранится только sha256 токена
+
+def _token_hash(token: str) -> str:
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+def _cache_put(token_hash: str, user_id: int, username: str, expires_at: float):
+    with _sessions_lock:
+        _sessions[token_hash] = (user_id, username, expires_at, time.time())
+        _sessions.move_to_end(token_hash)
+        while len(_sessions) > SESSION_CACHE_SIZE:
+            _sessions.popitem(last=False)
+
+def _cache_get(token_hash: str) -> tuple[int, str] | None:
+    now = time.time()
+    with _sessions_lock:
+        entry = _sessions.get(token_hash)
+        if entry is None:
+            return None
+        user_id, username, expires_at, checked_at = entry
+        if now >= expires_at or now - checked_at >= SESSION_CACHE_TTL:
+            del _sessions[token_hash]
+            return None
+        _sessions.move_to_end(token_hash)
+        return user_id, username
+
+@metrics.timed()
+def create_session(user_id: int, username: str) -> str:
+    # новый токен сессии; заодно удаляются просроченные сессии
+    token = secrets.token_urlsafe(32)
+    now = time.time()
+    with db.transaction() as conn:
+        db.purge_sessions(now, conn)
+        db.add_session(_token_hash(token), user_id, now + SESSION_TTL, conn)
+    _cache_put(_token_hash(token), user_id, username, now + SESSION_TTL)
+    return token
+
+@metrics.timed()
+def validate_session(token: str) -> tuple[int, str]:
+    # (id пользователя, логин) по токену, иначе ValueError
+    token_hash = _token_hash(token)
+    cached = _cache_get(token_hash)
+    if cached is not None:
+        return cached
+    row = db.get_session(token_hash)
+    if row is None or row[2] <= time.time():
+        raise ValueError("Сессия недействительна или истекла")
+    _cache_put(token_hash, *row)
+    return row[0], row[1]
+
+async def async_validate_session(token: str) -> tuple[int, str]:
+    # попадание в кэш - без пула и бд
+    cached = _cache_get(_token_hash(token))
+    if cached is not None:
+        return cached
+    return await executors.run_io(validate_session, token)
+
+@metrics.timed()
+def logout(token: str):
+    token_hash = _token_hash(token)
+    with _sessions_lock:
+        _sessions.pop(token_hash, None)
+    db.delete_session(token_hash)
+
+def login_session(username: str, password: str) -> tuple[int, str]:
+    # вход с паролем и новая сессия: (id пользователя, токен)
+    user_id = login_user(username, password)
+    return user_id, create_session(user_id, username)
+
+async def async_login_session(username: str, password: str) -> tuple[int, str]:
+    user_id = await async_login_user(username, password)
+    return user_id, await executors.run_io(create_session, user_id, username)
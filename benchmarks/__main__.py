@@ -0,0 +1,91 @@
+# Набор бенчмарков горячих путей файлового менеджера.
+# Запуск из корня проекта:
+#   python -m benchmarks [--users 4] [--files 200] [--sizes small|mixed|large] [--concurrency 1,8]
+#                        [--ops write_file,read_file,...] [--iterations 200] [--async]
+#                        [--output results.json] [--compare old.json] [--metrics]
+# Для каждой операции: прогон в 1 потоке и в N потоках (--async - N задач async API),
+# ops/s, задержка p50/p99 и пиковый RSS; результаты сохраняются в JSON для сравнения прогонов
+import argparse
+import json
+import shutil
+import sys
+
+import db
+import executors
+import metrics
+from benchmarks import harness
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description="Бенчмарки файлового менеджера")
+    parser.add_argument("--users", type=int, default=4, help="синтетических пользователей")
+    parser.add_argument("--files", type=int, default=200, help="файлов в дереве каждого пользователя")
+    parser.add_argument("--depth", type=int, default=2, help="глубина дерева директорий")
+    parser.add_argument("--fanout", type=int, default=4, help="поддиректорий на уровень")
+    parser.add_argument("--sizes", choices=sorted(harness.SIZE_DISTRIBUTIONS), default="mixed",
+                        help="распределение размеров файлов")
+    parser.add_argument("--iterations", type=int, default=200, help="вызовов операции на прогон")
+    parser.add_argument("--concurrency", default="1,8", help="уровни параллелизма через запятую")
+    parser.add_argument("--ops", help="операции через запятую (по умолчанию все)")
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="задачи asyncio через async API вместо потоков")
+    parser.add_argument("--locks", choices=("thread", "process"), default="thread", help="реализация блокировок")
+    parser.add_argument("--cas", action="store_true", help="контентно-адресуемое хранилище")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="сохранить результаты в JSON")
+    parser.add_argument("--compare", help="сравнить с сохранённым JSON")
+    parser.add_argument("--metrics", action="store_true", help="собрать и вывести метрики (metrics.py)")
+    parser.add_argument("--keep", action="store_true", help="не удалять временное хранилище")
+    args = parser.parse_args(argv)
+
+    print(f"Подготовка: {args.users} польз. x {args.files} файлов ({args.sizes})...")
+    env = harness.Env(args.users, args.files, args.depth, args.fanout, args.sizes, args.seed,
+                      args.locks, args.cas)
+    ops = harness.operations(env, args.iterations)
+    selected = args.ops.split(",") if args.ops else list(ops)
+    unknown = [name for name in selected if name not in ops]
+    if unknown:
+        parser.error(f"неизвестные операции: {', '.join(unknown)}; есть: {', '.join(ops)}")
+    levels = [int(level) for level in args.concurrency.split(",")]
+
+    metrics.configure(args.metrics)
+    results = []
+    print(f"{'операция':<20}{'режим':<8}{'N':>4}{'ops/s':>10}{'p50, мс':>10}{'p99, мс':>10}{'RSS, МБ':>10}")
+    try:
+        for name in selected:
+            prepare, op, async_op = ops[name]
+            if prepare is not None:
+                prepare()
+            for level in levels:
+                if args.use_async:
+                    result = harness.run_tasks(name, async_op, args.iterations, level)
+                else:
+                    result = harness.run_threads(name, op, args.iterations, level)
+                if name == "extract_zip":
+                    prepare()  # архивы уже распакованы - следующий уровень на свежих
+                results.append(result)
+                print(f"{name:<20}{result['mode']:<8}{level:>4}{result['ops_per_s']:>10}"
+                      f"{result['p50_ms']:>10}{result['p99_ms']:>10}{result['peak_rss_mb']:>10}")
+    finally:
+        executors.shutdown()
+        db.close_db_connections()
+        if not args.keep:
+            shutil.rmtree(env.tmp, ignore_errors=True)
+
+    if args.metrics:
+        print(metrics.dump_text())
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"meta": harness.metadata(args), "results": results}, f, ensure_ascii=False, indent=2)
+        print(f"Результаты: {args.output}")
+    if args.compare:
+        print("Сравнение с", args.compare)
+        lines = harness.compare(results, args.compare)
+        for line in lines:
+            print(line)
+        if not lines:
+            print("Нет общих прогонов (операция, режим, параллелизм)")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,69 @@
+# Сравнение числа commit на одну файловую операцию:
+# "до" - отдельные auto-commit вызовы helper'ов db, как раньше делал file_manager,
+# "после" - единица работы db.transaction() внутри file_manager.
+# Запуск из корня проекта: python -m benchmarks.commits_per_op [N]
+import os
+import sys
+import time
+import tempfile
+
+import db
+import file_manager
+
+
+def _count_commits(fn, n: int) -> tuple[float, float]:
+    # считаем COMMIT через trace callback соединения текущего потока
+    statements = []
+    with db.get_db_connection() as conn:
+        conn.set_trace_callback(statements.append)
+    start = time.perf_counter()
+    for i in range(n):
+        fn(i)
+    elapsed = time.perf_counter() - start
+    with db.get_db_connection() as conn:
+        conn.set_trace_callback(None)
+    commits = sum(1 for s in statements if s.strip().upper() == "COMMIT")
+    return commits / n, elapsed / n * 1000
+
+
+def main(n: int = 500):
+    tmp = tempfile.mkdtemp(prefix="bench-commits-")
+    db.DB_PATH = os.path.join(tmp, "bench.db")
+    db.init_db()
+    db.add_user("bench", "-")
+    user_id = db.get_user("bench")[0]
+    user_dir = os.path.join(tmp, "bench")
+    os.makedirs(user_dir)
+
+    def old_write(i):
+        path = f"old_{i}.txt"
+        file_id = db.get_file_id(path, user_id)
+        if file_id is None:
+            file_id = db.add_file(path, 4, path, user_id)
+        with open(os.path.join(user_dir, path), "wb") as f:
+            f.write(b"data")
+        db.log_operation("create", file_id, user_id)
+
+    def old_delete(i):
+        path = f"old_{i}.txt"
+        file_id = db.get_file_id(path, user_id)
+        db.log_operation("delete", file_id, user_id)
+        os.remove(os.path.join(user_dir, path))
+        db.delete_file_record(file_id)
+
+    def new_write(i):
+        file_manager.write_file(f"new_{i}.txt", b"data", user_id, user_dir)
+
+    def new_delete(i):
+        file_manager.delete_file(f"new_{i}.txt", user_id, user_dir)
+
+    print(f"{'операция':<22}{'commit/оп':>12}{'мс/оп':>10}")
+    for name, fn in (("write (до)", old_write), ("write (после)", new_write),
+                     ("delete (до)", old_delete), ("delete (после)", new_delete)):
+        commits, ms = _count_commits(fn, n)
+        print(f"{name:<22}{commits:>12.2f}{ms:>10.3f}")
+    db.close_db_connections()
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 500)
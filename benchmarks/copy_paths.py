@@ -0,0 +1,64 @@
+# Сравнение способов копирования fast_copy на больших файлах:
+# reflink, copy_file_range, sendfile, buffered и shutil.copyfile для сравнения.
+# Запуск из корня проекта: python -m benchmarks.copy_paths [SIZE_MB] [DIR]
+# DIR - каталог на проверяемой ФС (XFS/btrfs для reflink), по умолчанию временный каталог
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import fast_copy
+
+REPEATS = 3
+
+
+def _make_source(path: str, size: int):
+    block = os.urandom(1024 * 1024)
+    with open(path, "wb") as f:
+        for _ in range(size // len(block)):
+            f.write(block)
+        f.write(block[:size % len(block)])
+
+
+def _measure(fn, src: str, dst: str) -> float:
+    best = None
+    for _ in range(REPEATS):
+        if os.path.exists(dst):
+            os.remove(dst)
+        start = time.perf_counter()
+        fn(src, dst)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main(size_mb: int = 256, directory: str | None = None):
+    tmp = tempfile.mkdtemp(prefix="bench-copy-", dir=directory)
+    try:
+        src = os.path.join(tmp, "source.bin")
+        dst = os.path.join(tmp, "copy.bin")
+        size = size_mb * 1024 * 1024
+        _make_source(src, size)
+        print(f"Файл {size_mb} МБ в {tmp}, лучшее из {REPEATS}")
+        print(f"{'способ':<16}{'время, с':>12}{'МБ/с':>12}")
+        cases = [(m, lambda s, d, m=m: fast_copy.copy_data(s, d, methods=[m])) for m in
+                 (fast_copy.REFLINK, fast_copy.COPY_FILE_RANGE, fast_copy.SENDFILE, fast_copy.BUFFERED)]
+        cases.append(("shutil.copyfile", shutil.copyfile))
+        for name, fn in cases:
+            try:
+                elapsed = _measure(fn, src, dst)
+            except (OSError, KeyError, AttributeError) as e:
+                print(f"{name:<16}{'недоступен':>12}  ({e})")
+                continue
+            if os.path.getsize(dst) != size:
+                print(f"{name:<16}{'ошибка: размер копии не совпал':>12}")
+                continue
+            print(f"{name:<16}{elapsed:>12.4f}{size_mb / max(elapsed, 1e-9):>12.0f}")
+        print(f"Автовыбор: {fast_copy.copy_data(src, dst)}")
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 256, sys.argv[2] if len(sys.argv) > 2 else None)
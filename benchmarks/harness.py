@@ -0,0 +1,358 @@
+# Общая часть набора бенчмарков: синтетические пользователи и деревья файлов,
+# запуск операции в одном потоке и в N потоках/задачах, ops/s, p50/p99 и пиковый RSS, JSON с результатами.
+# Точка входа - python -m benchmarks (benchmarks/__main__.py)
+import asyncio
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+    import resource
+
+import db
+import lock_manager
+import blob_store
+import executors
+import file_manager
+import zip_manager
+import json_xml_handler
+import async_api
+
+# распределения размеров файлов: функция (random.Random) -> байт
+SIZE_DISTRIBUTIONS = {
+    "small": lambda rng: rng.randint(256, 4096),
+    # логнормальное с медианой ~16 КБ: много мелких файлов и редкие крупные
+    "mixed": lambda rng: min(int(rng.lognormvariate(9.7, 1.3)), file_manager.MAX_FILE_SIZE),
+    "large": lambda rng: rng.randint(1024 * 1024, 8 * 1024 * 1024),
+}
+
+RSS_SAMPLE_INTERVAL = 0.01
+BATCH_SIZE = 50  # записей в одном run_batch операции batch_write
+
+
+class Env:
+    # хранилище бенчмарка во временной директории: бд, пользователи и их деревья файлов
+    def __init__(self, users: int, files: int, depth: int, fanout: int, sizes: str, seed: int,
+                 lock_backend: str = "thread", cas: bool = False):
+        self.tmp = tempfile.mkdtemp(prefix="bench-")
+        self.base_dir = os.path.join(self.tmp, "storage")
+        self.rng = random.Random(seed)
+        self.sizes = SIZE_DISTRIBUTIONS[sizes]
+        db.DB_PATH = os.path.join(self.tmp, "bench.db")
+        db.init_db()
+        os.makedirs(self.base_dir)
+        lock_manager.configure(lock_backend, self.base_dir)
+        blob_store.configure(self.base_dir, enabled=cas)
+        file_manager.USER_QUOTA = None  # бенчмарк меряет операции, а не упирается в квоту
+        self.users = []  # [(id, user_dir, [пути файлов])]
+        payload = os.urandom(file_manager.MAX_FILE_SIZE)
+        self.payload = payload
+        for u in range(users):
+            username = f"bench{u}"
+            db.add_user(username, "-")
+            user_id = db.get_user(username)[0]
+            user_dir = os.path.join(self.base_dir, username)
+            os.makedirs(user_dir)
+            dirs = self._tree(depth, fanout)
+            paths = []
+            for i in range(files):
+                path = f"{self.rng.choice(dirs)}/f{i}.bin".lstrip("/")
+                os.makedirs(os.path.dirname(os.path.join(user_dir, path)), exist_ok=True)
+                file_manager.write_file(path, self.data(), user_id, user_dir)
+                paths.append(path)
+            self.users.append((user_id, user_dir, paths))
+
+    def _tree(self, depth: int, fanout: int) -> list[str]:
+        dirs = [""]
+        level = [""]
+        for _ in range(depth):
+            level = [f"{parent}/d{i}".lstrip("/") for parent in level for i in range(fanout)]
+            dirs.extend(level)
+        return dirs
+
+    def data(self) -> bytes:
+        size = self.sizes(self.rng)
+        start = self.rng.randint(0, len(self.payload) - size)
+        return self.payload[start:start + size]
+
+    def user(self, worker: int):
+        return self.users[worker % len(self.users)]
+
+
+def percentile(sorted_values: list[float], p: float) -> float:
+    # ближайший ранг
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, int(round(p / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def _rss() -> int:
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    # без psutil - пик за всё время процесса (Linux: КБ, macOS: байты)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class _RssSampler:
+    # пиковый RSS за время прогона: фоновый поток опрашивает RSS
+    def __init__(self):
+        self.peak = _rss()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(RSS_SAMPLE_INTERVAL):
+            self.peak = max(self.peak, _rss())
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, _rss())
+
+
+def _summary(name: str, concurrency: int, mode: str, latencies: list[float], elapsed: float,
+             peak_rss: int, errors: int) -> dict:
+    latencies.sort()
+    return {
+        "op": name,
+        "mode": mode,
+        "concurrency": concurrency,
+        "ops": len(latencies),
+        "errors": errors,
+        "seconds": round(elapsed, 4),
+        "ops_per_s": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "peak_rss_mb": round(peak_rss / (1024 * 1024), 1),
+    }
+
+
+def run_threads(name: str, op, iterations: int, concurrency: int) -> dict:
+    # op(worker, i) в concurrency потоках, всего iterations вызовов
+    latencies = []
+    errors = []
+
+    def worker(w: int):
+        local = []
+        for i in range(w, iterations, concurrency):
+            start = time.perf_counter()
+            try:
+                op(w, i)
+            except Exception as e:
+                errors.append(e)
+                continue
+            local.append(time.perf_counter() - start)
+        return local
+
+    with _RssSampler() as rss:
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            for local in pool.map(worker, range(concurrency)):
+                latencies.extend(local)
+        elapsed = time.perf_counter() - started
+    if errors:
+        print(f"  {name}: {len(errors)} ошибок, первая: {errors[0]!r}", file=sys.stderr)
+    return _summary(name, concurrency, "threads", latencies, elapsed, rss.peak, len(errors))
+
+
+def run_tasks(name: str, op, iterations: int, concurrency: int) -> dict:
+    # async op(worker, i) в concurrency задачах одного event loop (async API поверх пулов executors)
+    latencies = []
+    errors = []
+
+    async def worker(w: int):
+        for i in range(w, iterations, concurrency):
+            start = time.perf_counter()
+            try:
+                await op(w, i)
+            except Exception as e:
+                errors.append(e)
+                continue
+            latencies.append(time.perf_counter() - start)
+
+    async def main():
+        await asyncio.gather(*(worker(w) for w in range(concurrency)))
+
+    with _RssSampler() as rss:
+        started = time.perf_counter()
+        asyncio.run(main())
+        elapsed = time.perf_counter() - started
+    if errors:
+        print(f"  {name}: {len(errors)} ошибок, первая: {errors[0]!r}", file=sys.stderr)
+    return _summary(name, concurrency, "tasks", latencies, elapsed, rss.peak, len(errors))
+
+
+def _zip_bytes(env: Env, members: int) -> bytes:
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as z:
+        for m in range(members):
+            z.writestr(f"m{m}.bin", env.data())
+    return buf.getvalue()
+
+
+def operations(env: Env, iterations: int) -> dict:
+    # операции бенчмарка: имя -> (подготовка или None, op(worker, i), async op(worker, i))
+    # подготовка выполняется до замера, op пишет в свои уникальные пути
+    def pick(worker: int):
+        user_id, user_dir, paths = env.user(worker)
+        return user_id, user_dir, env.rng.choice(paths)
+
+    def write(w, i):
+        user_id, user_dir, _ = env.user(w)
+        file_manager.write_file(f"w{w}_{i}.bin", env.data(), user_id, user_dir)
+
+    async def write_async(w, i):
+        user_id, user_dir, _ = env.user(w)
+        await async_api.async_write_file(f"aw{w}_{i}.bin", env.data(), user_id, user_dir)
+
+    def read(w, i):
+        user_id, user_dir, path = pick(w)
+        file_manager.read_file(path, user_id, user_dir)
+
+    async def read_async(w, i):
+        user_id, user_dir, path = pick(w)
+        await async_api.async_read_file(path, user_id, user_dir)
+
+    def copy(w, i):
+        user_id, user_dir, path = pick(w)
+        file_manager.copy_file(path, f"c{w}_{i}.bin", user_id, user_dir)
+
+    async def copy_async(w, i):
+        user_id, user_dir, path = pick(w)
+        await async_api.async_copy_file(path, f"ac{w}_{i}.bin", user_id, user_dir)
+
+    # пакет из BATCH_SIZE записей одним run_batch (сравнивать с BATCH_SIZE вызовами write_file)
+    def batch_write(w, i):
+        user_id, user_dir, _ = env.user(w)
+        file_manager.run_batch([{"op": "write", "path": f"bw{w}_{i}_{n}.bin", "content": env.data()}
+                                for n in range(BATCH_SIZE)], user_id, user_dir)
+
+    async def batch_write_async(w, i):
+        user_id, user_dir, _ = env.user(w)
+        await async_api.async_run_batch([{"op": "write", "path": f"abw{w}_{i}_{n}.bin", "content": env.data()}
+                                         for n in range(BATCH_SIZE)], user_id, user_dir)
+
+    def archive(w, i):
+        user_id, user_dir, paths = env.user(w)
+        zip_manager.create_archive(paths[:20], f"arch{w}_{i}.zip", user_id, user_dir)
+
+    async def archive_async(w, i):
+        user_id, user_dir, paths = env.user(w)
+        await async_api.async_create_archive(paths[:20], f"aarch{w}_{i}.zip", user_id, user_dir)
+
+    def prepare_extract():
+        # по архиву на вызов, каждый в своей директории: распаковка идёт рядом с архивом
+        data = _zip_bytes(env, 20)
+        for prefix in ("x", "ax"):
+            for i in range(iterations):
+                user_id, user_dir, _ = env.user(i)
+                path = f"{prefix}{i}/a.zip"
+                os.makedirs(os.path.join(user_dir, f"{prefix}{i}"), exist_ok=True)
+                file_manager.write_file(path, data, user_id, user_dir)
+
+    # worker для распаковки не важен: архив i принадлежит пользователю env.user(i)
+    def extract(w, i):
+        user_id, user_dir, _ = env.user(i)
+        zip_manager.extract_zip(f"x{i}/a.zip", user_id, user_dir)
+
+    async def extract_async(w, i):
+        user_id, user_dir, _ = env.user(i)
+        await async_api.async_extract_zip(f"ax{i}/a.zip", user_id, user_dir)
+
+    document = {"items": [{"id": n, "name": f"item{n}", "tags": ["a", "b"], "value": None} for n in range(200)]}
+    json_text = json.dumps(document)
+    xml_text = "<root>" + "".join(f"<item id='{n}'><name>item{n}</name></item>" for n in range(200)) + "</root>"
+
+    def write_json(w, i):
+        user_id, user_dir, _ = env.user(w)
+        json_xml_handler.write_json(f"j{w}_{i}.json", json_text, user_id, user_dir)
+
+    async def write_json_async(w, i):
+        user_id, user_dir, _ = env.user(w)
+        await async_api.async_write_json(f"aj{w}_{i}.json", json_text, user_id, user_dir)
+
+    def write_xml(w, i):
+        user_id, user_dir, _ = env.user(w)
+        json_xml_handler.write_xml(f"x{w}_{i}.xml", xml_text, user_id, user_dir)
+
+    async def write_xml_async(w, i):
+        user_id, user_dir, _ = env.user(w)
+        await async_api.async_write_xml(f"ax{w}_{i}.xml", xml_text, user_id, user_dir)
+
+    def db_lookup(w, i):
+        user_id, _, path = pick(w)
+        db.get_file_id(path, user_id)
+
+    async def db_lookup_async(w, i):
+        user_id, _, path = pick(w)
+        await executors.run_io(db.get_file_id, path, user_id)
+
+    def db_list(w, i):
+        user_id, _, _ = env.user(w)
+        db.get_user_files_page(user_id, 100)
+
+    async def db_list_async(w, i):
+        user_id, _, _ = env.user(w)
+        await async_api.async_get_user_files_page(user_id, 100)
+
+    return {
+        "write_file": (None, write, write_async),
+        "read_file": (None, read, read_async),
+        "copy_file": (None, copy, copy_async),
+        "batch_write": (None, batch_write, batch_write_async),
+        "create_archive": (None, archive, archive_async),
+        "extract_zip": (prepare_extract, extract, extract_async),
+        "write_json": (None, write_json, write_json_async),
+        "write_xml": (None, write_xml, write_xml_async),
+        "db_get_file_id": (None, db_lookup, db_lookup_async),
+        "db_user_files_page": (None, db_list, db_list_async),
+    }
+
+
+def metadata(args) -> dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "config": vars(args),
+    }
+
+
+def compare(results: list[dict], baseline_path: str) -> list[str]:
+    # строки сравнения с сохранённым прогоном: ops/s и p99 по (операция, режим, параллелизм)
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = {(r["op"], r["mode"], r["concurrency"]): r for r in json.load(f)["results"]}
+    lines = []
+    for r in results:
+        old = baseline.get((r["op"], r["mode"], r["concurrency"]))
+        if old is None or not old["ops_per_s"]:
+            continue
+        change = (r["ops_per_s"] / old["ops_per_s"] - 1) * 100
+        lines.append(f"{r['op']:<20}{r['mode']:<8}{r['concurrency']:>4}  ops/s {old['ops_per_s']:>9} -> "
+                     f"{r['ops_per_s']:>9} ({change:+.1f}%)  p99 {old['p99_ms']} -> {r['p99_ms']} мс")
+    return lines
@@ -0,0 +1,245 @@
+# Нагрузочный клиент для server.py: много одновременных соединений к серверу на localhost.
+# У каждого соединения свой пользователь (по кругу из --users) и сессия, запросы - смесь
+# загрузок (PUT /files), скачиваний (GET /files) и листингов (GET /dirs); --pipeline N - по N запросов
+# без ожидания ответов. Итог: запросов в секунду, МБ/с в обе стороны, задержка p50/p99 по видам.
+# Запуск из корня проекта:
+#   python -m benchmarks.load [--connections 16] [--users 4] [--requests 200] [--pipeline 1]
+#                             [--size 16384] [--mix put:1,get:4,list:1] [--url http://127.0.0.1:8080]
+#                             [--output load.json]
+# без --url сервер запускается отдельным процессом на временном хранилище и останавливается в конце
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.parse import urlsplit
+
+from benchmarks.harness import percentile, metadata
+
+PASSWORD = "load-password"
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Client:
+    # одно keep-alive соединение HTTP/1.1
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, host: str):
+        self.reader = reader
+        self.writer = writer
+        self.host = host
+        self.token = None
+        self.sent = 0
+        self.received = 0
+
+    @classmethod
+    async def connect(cls, host: str, port: int) -> "Client":
+        reader, writer = await asyncio.open_connection(host, port, limit=1024 * 1024)
+        return cls(reader, writer, host)
+
+    def send(self, method: str, path: str, body: bytes = b"", content_type: str | None = None):
+        headers = [f"{method} {path} HTTP/1.1", f"Host: {self.host}", f"Content-Length: {len(body)}"]
+        if self.token:
+            headers.append(f"Authorization: Bearer {self.token}")
+        if content_type:
+            headers.append(f"Content-Type: {content_type}")
+        data = ("\r\n".join(headers) + "\r\n\r\n").encode("latin-1") + body
+        self.writer.write(data)
+        self.sent += len(data)
+
+    async def response(self) -> tuple[int, bytes]:
+        while True:
+            head = await self.reader.readuntil(b"\r\n\r\n")
+            status = int(head.split(b" ", 2)[1])
+            if status != 100:
+                break
+        self.received += len(head)
+        headers = {}
+        for line in head.decode("latin-1").split("\r\n")[1:]:
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        if headers.get("transfer-encoding") == "chunked":
+            parts = []
+            while True:
+                size = int((await self.reader.readuntil(b"\r\n")).strip(), 16)
+                if not size:
+                    await self.reader.readuntil(b"\r\n")
+                    break
+                parts.append(await self.reader.readexactly(size))
+                await self.reader.readexactly(2)
+            body = b"".join(parts)
+        else:
+            body = await self.reader.readexactly(int(headers.get("content-length", 0)))
+        self.received += len(body)
+        return status, body
+
+    async def call(self, method: str, path: str, body: bytes = b"", content_type: str | None = None):
+        self.send(method, path, body, content_type)
+        await self.writer.drain()
+        return await self.response()
+
+    async def close(self):
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except ConnectionError:
+            pass
+
+
+def _parse_mix(text: str) -> list[str]:
+    # "put:1,get:4" -> ["put", "get", "get", "get", "get"] для random.choice
+    result = []
+    for part in text.split(","):
+        name, _, weight = part.partition(":")
+        if name not in ("put", "get", "list"):
+            raise ValueError(f"неизвестный вид запроса: {name}")
+        result += [name] * int(weight or 1)
+    return result
+
+
+async def _prepare(host: str, port: int, users: int) -> list[str]:
+    # пользователи load0..N-1 (если ещё нет), токены сессий и директория load у каждого
+    tokens = []
+    client = await Client.connect(host, port)
+    try:
+        for i in range(users):
+            credentials = json.dumps({"username": f"load{i}", "password": PASSWORD}).encode()
+            await client.call("POST", "/register", credentials, "application/json")
+            status, body = await client.call("POST", "/login", credentials, "application/json")
+            if status != 200:
+                raise RuntimeError(f"вход load{i}: {status} {body.decode('utf-8', 'replace')}")
+            client.token = json.loads(body)["token"]
+            await client.call("POST", "/dirs/load")
+            tokens.append(client.token)
+            client.token = None
+    finally:
+        await client.close()
+    return tokens
+
+
+async def _connection(index: int, host: str, port: int, token: str, args, mix: list[str], stats: dict):
+    rng = random.Random(args.seed + index)
+    client = await Client.connect(host, port)
+    client.token = token
+    payload = rng.randbytes(args.size)
+    uploaded = [f"/files/load/c{index}_seed.bin"]
+    await client.call("PUT", uploaded[0], payload)
+    try:
+        done = 0
+        while done < args.requests:
+            batch = []
+            for _ in range(min(args.pipeline, args.requests - done)):
+                kind = rng.choice(mix)
+                if kind == "put":
+                    path = f"/files/load/c{index}_{done + len(batch)}.bin"
+                    client.send("PUT", path, payload)
+                    uploaded.append(path)
+                elif kind == "get":
+                    client.send("GET", rng.choice(uploaded))
+                else:
+                    client.send("GET", "/dirs/load?limit=100")
+                batch.append(kind)
+            start = time.perf_counter()
+            await client.writer.drain()
+            for kind in batch:
+                status, _ = await client.response()
+                stats["latency"].setdefault(kind, []).append(time.perf_counter() - start)
+                if status >= 400:
+                    stats["errors"] += 1
+            done += len(batch)
+    finally:
+        stats["sent"] += client.sent
+        stats["received"] += client.received
+        await client.close()
+
+
+async def run(args) -> dict:
+    url = urlsplit(args.url)
+    host, port = url.hostname or "127.0.0.1", url.port or 80
+    mix = _parse_mix(args.mix)
+    tokens = await _prepare(host, port, args.users)
+    stats = {"latency": {}, "errors": 0, "sent": 0, "received": 0}
+    start = time.perf_counter()
+    await asyncio.gather(*(_connection(i, host, port, tokens[i % len(tokens)], args, mix, stats)
+                           for i in range(args.connections)))
+    elapsed = time.perf_counter() - start
+    all_latencies = sorted(value for values in stats["latency"].values() for value in values)
+    result = {
+        "requests": len(all_latencies),
+        "errors": stats["errors"],
+        "seconds": round(elapsed, 3),
+        "requests_per_s": round(len(all_latencies) / elapsed, 1),
+        "sent_mb_per_s": round(stats["sent"] / elapsed / 1e6, 2),
+        "received_mb_per_s": round(stats["received"] / elapsed / 1e6, 2),
+        "p50_ms": round(percentile(all_latencies, 50) * 1000, 3),
+        "p99_ms": round(percentile(all_latencies, 99) * 1000, 3),
+        "by_kind": {},
+    }
+    for kind, values in sorted(stats["latency"].items()):
+        values.sort()
+        result["by_kind"][kind] = {"requests": len(values), "p50_ms": round(percentile(values, 50) * 1000, 3),
+                                   "p99_ms": round(percentile(values, 99) * 1000, 3)}
+    return result
+
+
+def _start_server(tmp: str) -> tuple[subprocess.Popen, str]:
+    # сервер на свободном порту, временные хранилище и бд; адрес - из первой строки вывода
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, "server.py"), "--port", "0",
+         "--base-dir", os.path.join(tmp, "storage"), "--db", os.path.join(tmp, "file_manager.db")],
+        cwd=tmp, stdout=subprocess.PIPE, text=True)
+    line = process.stdout.readline()
+    if "http://" not in line:
+        process.kill()
+        raise RuntimeError(f"сервер не запустился: {line!r}")
+    return process, line[line.index("http://"):].strip()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.load", description="Нагрузка на server.py")
+    parser.add_argument("--url", help="адрес работающего сервера; без него сервер запускается на время прогона")
+    parser.add_argument("--connections", type=int, default=16, help="одновременных соединений")
+    parser.add_argument("--users", type=int, default=4, help="пользователей (сессий) на все соединения")
+    parser.add_argument("--requests", type=int, default=200, help="запросов на соединение")
+    parser.add_argument("--pipeline", type=int, default=1, help="запросов без ожидания ответа")
+    parser.add_argument("--size", type=int, default=16 * 1024, help="байт в загружаемом файле")
+    parser.add_argument("--mix", default="put:1,get:4,list:1", help="веса видов запросов")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="сохранить результат в JSON")
+    args = parser.parse_args(argv)
+
+    tmp = process = None
+    if not args.url:
+        tmp = tempfile.mkdtemp(prefix="sfm-load-")
+        process, args.url = _start_server(tmp)
+    try:
+        print(f"{args.connections} соединений x {args.requests} запросов (pipeline {args.pipeline}) -> {args.url}")
+        result = asyncio.run(run(args))
+    finally:
+        if process is not None:
+            process.send_signal(signal.SIGINT)
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    print(f"запросов {result['requests']} (ошибок {result['errors']}) за {result['seconds']} с: "
+          f"{result['requests_per_s']} запр/с, отправлено {result['sent_mb_per_s']} МБ/с, "
+          f"получено {result['received_mb_per_s']} МБ/с")
+    print(f"{'вид':<8}{'запросов':>10}{'p50, мс':>10}{'p99, мс':>10}")
+    for kind, row in result["by_kind"].items():
+        print(f"{kind:<8}{row['requests']:>10}{row['p50_ms']:>10}{row['p99_ms']:>10}")
+    print(f"{'всего':<8}{result['requests']:>10}{result['p50_ms']:>10}{result['p99_ms']:>10}")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"meta": metadata(args), "result": result}, f, ensure_ascii=False, indent=2)
+        print(f"Результат: {args.output}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
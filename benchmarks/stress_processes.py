@@ -0,0 +1,124 @@
+# Стресс-тест межпроцессных блокировок: N процессов одновременно дописывают строки
+# в общий файл, перезаписывают и читают общий файл в одном хранилище, а также читают,
+# перемещают, удаляют и заново создают общие файлы в moving/ (кэш метаданных каждого процесса
+# не должен отдавать id файла, который уже перенёс другой процесс).
+# Проверяется, что размеры в Files совпадают с диском, строки не перемешаны,
+# читатели не видят наполовину записанный файл, а у каждого файла в moving/ есть ровно своя запись.
+# Запуск из корня проекта: python -m benchmarks.stress_processes [процессов] [итераций]
+import os
+import random
+import sys
+import time
+import tempfile
+import multiprocessing
+
+import db
+import lock_manager
+import file_manager
+
+LINE = b"0123456789abcdef\n"
+STATE_SIZE = 256 * 1024
+MOVING_FILES = 4  # общие файлы moving/m<k>.a, которые процессы переносят в m<k>.b и удаляют
+
+
+def _worker(db_path: str, base_dir: str, user_id: int, worker: int, iterations: int):
+    db.DB_PATH = db_path
+    lock_manager.configure("process", base_dir)
+    user_dir = os.path.join(base_dir, "stress")
+    rng = random.Random(worker)
+    torn = 0
+    for i in range(iterations):
+        file_manager.write_file("shared.log", LINE, user_id, user_dir, mode="a")
+        file_manager.write_file("state.bin", bytes([i % 256]) * STATE_SIZE, user_id, user_dir)
+        state = file_manager.read_file("state.bin", user_id, user_dir)
+        if len(state) != STATE_SIZE or state.count(state[:1]) != STATE_SIZE:
+            torn += 1
+        _shuffle(rng.randrange(MOVING_FILES), worker, user_id, user_dir)
+    db.close_db_connections()
+    if torn:
+        print(f"процесс {worker}: {torn} разорванных чтений state.bin")
+        sys.exit(1)
+
+
+def _shuffle(k: int, worker: int, user_id: int, user_dir: str):
+    # чтение (id попадает в кэш метаданных), перенос, удаление старого пути и создание заново:
+    # между шагами тот же файл переносят и удаляют другие процессы
+    src, dest = f"moving/m{k}.a", f"moving/m{k}.b"
+    for step in (lambda: file_manager.read_file(src, user_id, user_dir),
+                 lambda: file_manager.move_file(src, dest, user_id, user_dir),
+                 lambda: file_manager.delete_file(src, user_id, user_dir)):
+        try:
+            step()
+        except FileNotFoundError:
+            pass
+    file_manager.write_file(src, b"x" * (worker + 1), user_id, user_dir)
+
+
+def _check_moving(base_dir: str, user_id: int) -> list[str]:
+    # файлы moving/ на диске и их записи в Files совпадают один к одному, с размерами
+    directory = os.path.join(base_dir, "stress", "moving")
+    on_disk = {name: os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory)}
+    indexed = {entry.name: entry.size for entry in file_manager.iter_directory(
+        "moving", user_id, os.path.join(base_dir, "stress")) if entry.file_id is not None}
+    if on_disk != indexed:
+        return [f"moving/: на диске {sorted(on_disk.items())}, в Files {sorted(indexed.items())}"]
+    return []
+
+
+def main(processes: int = 8, iterations: int = 200):
+    tmp = tempfile.mkdtemp(prefix="stress-")
+    db.DB_PATH = os.path.join(tmp, "stress.db")
+    base_dir = os.path.join(tmp, "storage")
+    os.makedirs(os.path.join(base_dir, "stress"))
+    db.init_db()
+    db.add_user("stress", "-")
+    user_id = db.get_user("stress")[0]
+    lock_manager.configure("process", base_dir)
+    file_manager.create_directory("moving", user_id, os.path.join(base_dir, "stress"))
+    db.close_db_connections()
+
+    # spawn: каждый процесс стартует с чистым интерпретатором, как отдельный рабочий процесс
+    ctx = multiprocessing.get_context("spawn")
+    start = time.perf_counter()
+    procs = [ctx.Process(target=_worker, args=(db.DB_PATH, base_dir, user_id, w, iterations))
+             for w in range(processes)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+    elapsed = time.perf_counter() - start
+    if any(p.exitcode != 0 for p in procs):
+        raise SystemExit("Рабочий процесс завершился с ошибкой")
+
+    expected = processes * iterations * len(LINE)
+    path = os.path.join(base_dir, "stress", "shared.log")
+    with open(path, "rb") as f:
+        data = f.read()
+    with db.get_db_connection() as conn:
+        rows = conn.execute("SELECT size FROM Files WHERE id = ?",
+                            (db.get_file_id("shared.log", user_id, conn),)).fetchall()
+        # операции над shared.log и state.bin: по одной на запись, без операций moving/
+        operations = conn.execute("SELECT COUNT(*) FROM Operations WHERE user_id = ? AND file_id IN (?, ?)",
+                                  (user_id, db.get_file_id("shared.log", user_id, conn),
+                                   db.get_file_id("state.bin", user_id, conn))).fetchone()[0]
+    errors = []
+    if len(data) != expected:
+        errors.append(f"размер на диске {len(data)}, ожидалось {expected}")
+    if data != LINE * (expected // len(LINE)):
+        errors.append("строки в shared.log перемешаны")
+    if len(rows) != 1 or rows[0][0] != expected:
+        errors.append(f"записи Files для shared.log: {rows}")
+    if operations != processes * iterations * 2:
+        errors.append(f"операций {operations}, ожидалось {processes * iterations * 2}")
+    errors += _check_moving(base_dir, user_id)
+    total_ops = processes * iterations * 6
+    print(f"{processes} процессов x {iterations} итераций: {total_ops / elapsed:.0f} оп/с")
+    db.close_db_connections()
+    if errors:
+        raise SystemExit("Ошибки:\n" + "\n".join(errors))
+    print("OK")
+
+
+if __name__ == "__main__":
+    args = [int(a) for a in sys.argv[1:3]]
+    main(*args)
@@ -0,0 +1,164 @@
+import os
+import sys
+import uuid
+import errno
+import hashlib
+import db
+import fast_copy
+import lock_manager
+
+# контентно-адресуемое хранилище (опционально): тело файла хранится один раз в BASE_DIR/.blobs/<sha256>,
+# файлы пользователей - жёсткие ссылки на него. Копия файла - ещё одна ссылка и запись в Files,
+# без копирования данных. Число ссылок из Files ведут триггеры бд (Blobs.refcount).
+# Изменение файла на месте сначала отделяет его копию (copy-on-write), запись через os.replace
+# и так не трогает общий inode.
+
+BLOB_DIR_NAME = ".blobs"
+HASH_CHUNK = 1024 * 1024
+
+BLOB_DIR = None  # задаётся configure
+ENABLED = False  # новые записи и копии идут через blob'ы
+
+
+def configure(base_dir: str, enabled: bool = True):
+    # enabled=False оставляет только сборку мусора для уже существующих blob'ов
+    global BLOB_DIR, ENABLED
+    BLOB_DIR = os.path.join(base_dir, BLOB_DIR_NAME)
+    ENABLED = enabled
+    os.makedirs(BLOB_DIR, exist_ok=True)
+
+
+def new_hasher():
+    return hashlib.sha256()
+
+
+def blob_path(digest: str) -> str:
+    return os.path.join(BLOB_DIR, digest[:2], digest)
+
+
+def hash_file(path: str) -> tuple[str, int]:
+    hasher = new_hasher()
+    size = 0
+    with open(path, "rb", buffering=0) as f:
+        while True:
+            chunk = f.read(HASH_CHUNK)
+            if not chunk:
+                break
+            hasher.update(chunk)
+            size += len(chunk)
+    return hasher.hexdigest(), size
+
+
+def _link_into(src: str, full_path: str):
+    # full_path атомарно становится ещё одной ссылкой на inode src
+    tmp = os.path.join(os.path.dirname(full_path), f".{os.path.basename(full_path)}.{uuid.uuid4().hex}.tmp")
+    os.link(src, tmp)
+    try:
+        os.replace(tmp, full_path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def ingest(full_path: str, conn, digest: str | None = None, size: int | None = None) -> str:
+    # файл пользователя попадает в хранилище: если такое содержимое уже есть,
+    # файл заменяется ссылкой на blob, иначе сам файл становится blob'ом. возвращает хэш
+    if digest is None:
+        digest, size = hash_file(full_path)
+    db.add_blob(digest, size, conn)
+    path = blob_path(digest)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    for _ in range(3):
+        try:
+            if not os.path.samefile(path, full_path):
+                _link_into(path, full_path)
+            return digest
+        except FileNotFoundError:
+            # blob'а нет на диске (новый или его только что убрал сборщик мусора)
+            try:
+                os.link(full_path, path)
+                return digest
+            except FileExistsError:
+                continue  # параллельно положили такой же blob - ссылаемся на него
+        except OSError as e:
+            if e.errno != errno.EMLINK:
+                raise
+            return digest  # лимит ссылок на inode: остаётся отдельная копия с тем же содержимым
+    return digest
+
+
+def link_copy(full_src: str, full_dest: str):
+    # копия файла без копирования данных
+    try:
+        _link_into(full_src, full_dest)
+    except OSError as e:
+        if e.errno != errno.EMLINK:
+            raise
+        tmp = os.path.join(os.path.dirname(full_dest), f".{os.path.basename(full_dest)}.{uuid.uuid4().hex}.tmp")
+        fast_copy.copy(full_src, tmp)
+        os.replace(tmp, full_dest)
+
+
+def unshare(full_path: str):
+    # перед изменением на месте (дозапись): файлу со ссылками на общий inode - своя копия
+    try:
+        if os.stat(full_path).st_nlink <= 1:
+            return
+    except FileNotFoundError:
+        return
+    tmp = os.path.join(os.path.dirname(full_path), f".{os.path.basename(full_path)}.{uuid.uuid4().hex}.tmp")
+    fast_copy.copy(full_path, tmp)
+    os.replace(tmp, full_path)
+
+
+def collect_garbage() -> int:
+    # удаление blob'ов, на которые больше не ссылается ни одна запись Files
+    if BLOB_DIR is None:
+        return 0
+    with db.get_db_connection() as conn:
+        if conn.execute("SELECT 1 FROM Blobs WHERE refcount <= 0 LIMIT 1").fetchone() is None:
+            return 0
+    with db.transaction() as conn:
+        hashes = db.pop_unreferenced_blobs(conn)
+    for digest in hashes:
+        try:
+            os.remove(blob_path(digest))
+        except FileNotFoundError:
+            pass
+    return len(hashes)
+
+
+def migrate_storage(base_dir: str) -> dict:
+    # перевод существующих storage/<user> в хранилище blob'ов: каждый файл из Files
+    # хэшируется и заменяется ссылкой на blob, одинаковые файлы начинают делить место на диске
+    configure(base_dir, enabled=ENABLED)
+    with db.get_db_connection() as conn:
+        users = conn.execute("SELECT id, username FROM Users").fetchall()
+    migrated = 0
+    for user_id, username in users:
+        user_dir = os.path.join(base_dir, username)
+        rows = db.get_unblobbed_files(user_id)
+        for file_id, location in rows:
+            full_path = os.path.join(user_dir, location)
+            if not os.path.isfile(full_path):
+                continue  # запись без файла на диске - оставляем как есть
+            with lock_manager.exclusive(user_id, location), db.transaction() as conn:
+                db.set_file_blob(file_id, ingest(full_path, conn), conn)
+            migrated += 1
+    with db.get_db_connection() as conn:
+        logical = conn.execute("SELECT COALESCE(SUM(size), 0) FROM Files WHERE blob_hash IS NOT NULL").fetchone()[0]
+        stored = conn.execute("SELECT COALESCE(SUM(size), 0) FROM Blobs").fetchone()[0]
+    return {"migrated": migrated, "logical_bytes": logical, "stored_bytes": stored}
+
+
+if __name__ == "__main__":
+    # python blob_store.py [BASE_DIR] [DB_PATH]
+    base = sys.argv[1] if len(sys.argv) > 1 else "./storage"
+    if len(sys.argv) > 2:
+        db.DB_PATH = sys.argv[2]
+    db.init_db()
+    lock_manager.configure("process", base)
+    stats = migrate_storage(base)
+    print(f"Файлов переведено: {stats['migrated']}, "
+          f"логический объём {stats['logical_bytes']:,} байт, на диске {stats['stored_bytes']:,} байт")
+    db.close_db_connections()
@@ -0,0 +1,119 @@
+import os
+import threading
+from collections import OrderedDict
+
+# кэш содержимого маленьких файлов в памяти процесса: read_file, read_file_stream и read_file_mmap
+# (а через них read_json и read_xml) отдают часто читаемые файлы без open/read, диапазоны offset/count -
+# срезами memoryview поверх закэшированных bytes.
+# запись сверяется с файлом на диске по (размер, mtime_ns, inode) при каждом чтении: запись через
+# os.replace даёт новый inode, дозапись - новый размер, так что изменения из других процессов не
+# отдаются устаревшими. операции file_manager, меняющие файлы, сбрасывают записи сразу.
+# ограничен суммой байт (LRU), файлы больше MAX_FILE_SIZE не кэшируются
+
+ENABLED = True
+MAX_BYTES = 64 * 1024 * 1024
+MAX_FILE_SIZE = 256 * 1024
+
+_lock = threading.Lock()
+_entries = OrderedDict()  # полный путь -> (содержимое, подпись); порядок - от давно не использованных
+_size = 0  # байт в _entries
+_stats = {"hits": 0, "misses": 0, "stale": 0, "fills": 0, "invalidations": 0, "evictions": 0}
+
+
+def configure(enabled: bool = True, max_bytes: int = MAX_BYTES, max_file_size: int = MAX_FILE_SIZE):
+    global ENABLED, MAX_BYTES, MAX_FILE_SIZE
+    ENABLED = enabled
+    MAX_BYTES = max_bytes
+    MAX_FILE_SIZE = max_file_size
+    clear()
+
+
+def clear():
+    global _size
+    with _lock:
+        _entries.clear()
+        _size = 0
+
+
+def key(full_path: str) -> str:
+    return os.path.normcase(os.path.abspath(full_path))
+
+
+def signature(st: os.stat_result) -> tuple[int, int, int]:
+    return st.st_size, st.st_mtime_ns, st.st_ino
+
+
+def fits(size: int) -> bool:
+    return ENABLED and size <= min(MAX_FILE_SIZE, MAX_BYTES)
+
+
+def get(full_path: str, st: os.stat_result) -> bytes | None:
+    # содержимое, если файл на диске (st - его os.stat) не менялся с момента заполнения
+    path = key(full_path)
+    with _lock:
+        entry = _entries.get(path)
+        if entry is None:
+            _stats["misses"] += 1
+            return None
+        if entry[1] != signature(st):
+            _drop(path)
+            _stats["stale"] += 1
+            _stats["misses"] += 1
+            return None
+        _entries.move_to_end(path)
+        _stats["hits"] += 1
+        return entry[0]
+
+
+def put(full_path: str, data: bytes, sig: tuple[int, int, int]):
+    # sig - подпись той версии файла, из которой прочитано data
+    global _size
+    if not fits(len(data)):
+        return
+    path = key(full_path)
+    with _lock:
+        if path in _entries:
+            _drop(path)
+        _entries[path] = (data, sig)
+        _size += len(data)
+        _stats["fills"] += 1
+        while _size > MAX_BYTES:
+            _drop(next(iter(_entries)))
+            _stats["evictions"] += 1
+
+
+def _drop(path: str):
+    global _size
+    _size -= len(_entries.pop(path)[0])
+
+
+def invalidate(*full_paths: str):
+    with _lock:
+        for full_path in full_paths:
+            path = key(full_path)
+            if path in _entries:
+                _drop(path)
+                _stats["invalidations"] += 1
+
+
+def invalidate_tree(directory: str):
+    # все файлы под директорией (удаление, перемещение, распаковка)
+    start = key(directory).rstrip(os.sep) + os.sep
+    with _lock:
+        for path in [p for p in _entries if p.startswith(start)]:
+            _drop(path)
+            _stats["invalidations"] += 1
+
+
+def stats() -> dict:
+    with _lock:
+        result = dict(_stats, entries=len(_entries), bytes=_size)
+    lookups = result["hits"] + result["misses"]
+    result["hit_ratio"] = round(result["hits"] / lookups, 4) if lookups else 0.0
+    return result
+
+
+def reset_stats():
+    with _lock:
+        for name in _stats:
+            _stats[name] = 0
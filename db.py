@@ -1,23 +1,139 @@
+import os
+import posixpath
 import sqlite3
+import sys
+import threading
 from contextlib import contextmanager
+import metrics
+import meta_cache
 
 DB_PATH = "file_manager.db"
 
+# уровень PRAGMA synchronous: в режиме WAL NORMAL не даёт порчи бд,
+# при сбое питания теряются только последние транзакции, зато нет fsync на каждый commit
+SYNCHRONOUS = "NORMAL"
+BUSY_TIMEOUT = 5.0  # секунд ожидания блокировки бд другим соединением/процессом
+STATEMENT_CACHE_SIZE = 256  # кэш подготовленных запросов на соединение
+
+_SYNCHRONOUS_LEVELS = ("OFF", "NORMAL", "FULL", "EXTRA")
+
+# пул: одно постоянное соединение на поток
+_local = threading.local()
+_connections = {}  # поток -> соединение, для close_db_connections
+_connections_lock = threading.Lock()
+_generation = 0  # растёт при close_db_connections, старые соединения потоков становятся недействительными
+
+
+def _connect() -> sqlite3.Connection:
+    if SYNCHRONOUS not in _SYNCHRONOUS_LEVELS:
+        raise ValueError(f"Недопустимый уровень synchronous: {SYNCHRONOUS}")
+    # check_same_thread=False только чтобы close_db_connections мог закрыть чужое соединение,
+    # рабочие запросы идут строго из своего потока
+    conn = sqlite3.connect(DB_PATH, timeout=BUSY_TIMEOUT,
+                           cached_statements=STATEMENT_CACHE_SIZE, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute(f"PRAGMA synchronous = {SYNCHRONOUS}")
+    conn.execute("PRAGMA foreign_keys = ON")
+    return conn
+
+
+def _thread_connection() -> sqlite3.Connection:
+    conn = getattr(_local, "conn", None)
+    key = (os.getpid(), DB_PATH, _generation)
+    # после fork, смены DB_PATH или close_db_connections соединение открывается заново
+    if conn is not None and _local.key == key:
+        return conn
+    conn = _connect()
+    _local.conn = conn
+    _local.key = key
+    _local.depth = 0
+    _local.on_commit = []
+    _local.data_version = None
+    with _connections_lock:
+        # соединения завершившихся потоков закрываем сразу
+        for thread in [t for t in _connections if not t.is_alive()]:
+            _connections.pop(thread).close()
+        old = _connections.get(threading.current_thread())
+        if old is not None and old is not conn:
+            try:
+                old.close()
+            except sqlite3.ProgrammingError:
+                pass
+        _connections[threading.current_thread()] = conn
+    return conn
+
+
 @contextmanager
 def get_db_connection():
-    conn = sqlite3.connect(DB_PATH)
-    conn.execute("PRAGMA foreign_keys = ON")
+    # соединение потока из пула; commit только на выходе из самого внешнего блока,
+    # вложенные вызовы работают в той же транзакции
+    conn = _thread_connection()
+    _local.depth += 1
     try:
         yield conn
-        conn.commit()
+        if _local.depth == 1:
+            with metrics.timer(metrics.DB_COMMIT):
+                conn.commit()
+            callbacks, _local.on_commit = _local.on_commit, []
+            for callback in callbacks:
+                callback()
     except Exception:
-        conn.rollback()
+        if _local.depth == 1:
+            conn.rollback()
+            _local.on_commit = []
         raise
     finally:
-        conn.close()
+        _local.depth -= 1
 
-def init_db():
+
+def on_commit(callback):
+    # callback() после commit самой внешней транзакции потока, при откате не вызывается.
+    # вне транзакции вызывается сразу
+    if getattr(_local, "depth", 0) == 0:
+        callback()
+    else:
+        _local.on_commit.append(callback)
+
+
+@contextmanager
+def transaction():
+    # единица работы: все вызовы helper'ов внутри блока (с conn=... или без)
+    # идут в одной транзакции с одним commit в конце.
+    # BEGIN IMMEDIATE сразу берёт блокировку записи, чтобы не ловить busy при повышении блокировки
     with get_db_connection() as conn:
+        if _local.depth == 1 and not conn.in_transaction:
+            conn.execute("BEGIN IMMEDIATE")
+        yield conn
+
+
+@contextmanager
+def _session(conn: sqlite3.Connection | None):
+    # helper'ы принимают соединение открытой транзакции, иначе берут своё из пула
+    if conn is not None:
+        yield conn
+    else:
+        with get_db_connection() as conn:
+            yield conn
+
+
+def close_db_connections():
+    # закрытие всех соединений пула (при выходе из программы)
+    global _generation
+    meta_cache.clear()
+    with _connections_lock:
+        _generation += 1
+        for conn in _connections.values():
+            try:
+                conn.close()
+            except sqlite3.ProgrammingError:
+                pass
+        _connections.clear()
+
+def init_db():
+    # базовая схема + миграции до текущей версии, в одной транзакции
+    # (BEGIN IMMEDIATE: параллельно стартующие процессы не применят миграцию дважды)
+    meta_cache.clear()  # кэш метаданных мог остаться от другой бд (DB_PATH)
+    with transaction() as conn:
         cur = conn.cursor()
         # пользователи
         cur.execute("""
@@ -51,7 +167,198 @@ def init_db():
                 FOREIGN KEY (user_id) REFERENCES Users(id)
             )
         """)
+        _migrate(conn)
+
+
+def _migration_1_indexes(conn: sqlite3.Connection):
+    # старые бд могли накопить дубли (owner_id, location) - оставляем последнюю запись
+    conn.execute("""
+        DELETE FROM Files WHERE id NOT IN (
+            SELECT MAX(id) FROM Files GROUP BY owner_id, location
+        )
+    """)
+    # поиск файла по пути на каждом чтении/записи + диапазоны путей для операций с директориями
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_files_owner_location ON Files(owner_id, location)")
+    # get_user_files: ORDER BY created_at в пределах владельца
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_files_owner_created ON Files(owner_id, created_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_operations_user_timestamp ON Operations(user_id, timestamp)")
+    # ON DELETE SET NULL ищет ссылки на удаляемый файл - без индекса полный просмотр Operations
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_operations_file ON Operations(file_id)")
+
+
+def _migration_2_blobs(conn: sqlite3.Connection):
+    # контентно-адресуемое хранилище: тело файла хранится один раз по sha256,
+    # записи Files ссылаются на blob, refcount ведут триггеры - в той же транзакции, что и изменение Files
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS Blobs (
+            hash TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            refcount INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    conn.execute("ALTER TABLE Files ADD COLUMN blob_hash TEXT REFERENCES Blobs(hash) ON DELETE SET NULL")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_files_blob ON Files(blob_hash)")
+    # кандидаты на сборку мусора
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_blobs_unreferenced ON Blobs(refcount) WHERE refcount <= 0")
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS files_blob_insert AFTER INSERT ON Files
+        WHEN NEW.blob_hash IS NOT NULL
+        BEGIN
+            UPDATE Blobs SET refcount = refcount + 1 WHERE hash = NEW.blob_hash;
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS files_blob_delete AFTER DELETE ON Files
+        WHEN OLD.blob_hash IS NOT NULL
+        BEGIN
+            UPDATE Blobs SET refcount = refcount - 1 WHERE hash = OLD.blob_hash;
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS files_blob_update AFTER UPDATE OF blob_hash ON Files
+        WHEN NEW.blob_hash IS NOT OLD.blob_hash
+        BEGIN
+            UPDATE Blobs SET refcount = refcount - 1 WHERE hash = OLD.blob_hash;
+            UPDATE Blobs SET refcount = refcount + 1 WHERE hash = NEW.blob_hash;
+        END
+    """)
+    # новый размер = новое содержимое: файл больше не совпадает со своим blob (copy-on-write)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS files_content_changed AFTER UPDATE OF size ON Files
+        WHEN OLD.blob_hash IS NOT NULL AND NEW.blob_hash IS OLD.blob_hash
+        BEGIN
+            UPDATE Files SET blob_hash = NULL WHERE id = NEW.id;
+        END
+    """)
+
+
+def _migration_3_directories(conn: sqlite3.Connection):
+    # директории - записи дерева (parent_id), файл ссылается на свою директорию.
+    # путь файла больше не хранится: перемещение директории - обновление одной записи,
+    # удаление поддерева - каскад по индексам
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS Directories (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            owner_id INTEGER NOT NULL REFERENCES Users(id),
+            parent_id INTEGER REFERENCES Directories(id) ON DELETE CASCADE,
+            name TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    # поиск директории по имени в родителе, листинг и каскадное удаление детей
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_directories_parent_name ON Directories(parent_id, name)")
+    # корень пользователя (parent_id NULL) - один на владельца
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_directories_root ON Directories(owner_id) WHERE parent_id IS NULL")
+    conn.execute("ALTER TABLE Files ADD COLUMN dir_id INTEGER REFERENCES Directories(id) ON DELETE CASCADE")
+
+    # перенос путей: разбор location, директории создаются по ходу.
+    # после нормализации разделителей (старые пути с \\) дубли возможны - остаётся последняя запись
+    seen = set()
+    dir_ids = {}
+    rows = conn.execute(
+        "SELECT id, owner_id, location FROM Files WHERE owner_id IS NOT NULL ORDER BY id DESC"
+    ).fetchall()
+    for file_id, owner_id, location in rows:
+        try:
+            dirs, filename = _split_location(location or "")
+        except ValueError:
+            continue  # запись без пути - недостижима и раньше
+        key = (owner_id, tuple(dirs))
+        if key not in dir_ids:
+            dir_ids[key] = _resolve_dir(dirs, owner_id, conn, create=True)
+        if (dir_ids[key], filename) in seen:
+            conn.execute("DELETE FROM Files WHERE id = ?", (file_id,))
+            continue
+        seen.add((dir_ids[key], filename))
+        conn.execute("UPDATE Files SET dir_id = ?, filename = ? WHERE id = ?", (dir_ids[key], filename, file_id))
+
+    conn.execute("DROP INDEX IF EXISTS idx_files_owner_location")
+    # файл по имени в директории + листинг и каскадное удаление
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_files_dir_name ON Files(dir_id, filename)")
+    if sqlite3.sqlite_version_info >= (3, 35, 0):
+        conn.execute("ALTER TABLE Files DROP COLUMN location")
+    # на старом SQLite колонка остаётся, но больше не заполняется и не читается
+
+
+def _migration_4_usage(conn: sqlite3.Connection):
+    # занятое место и число файлов пользователя, ведут триггеры Files в той же транзакции,
+    # что и изменение записи (в том числе каскадное удаление поддерева директории).
+    # quota - своя квота пользователя, NULL - общий лимит file_manager.USER_QUOTA
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS Usage (
+            owner_id INTEGER PRIMARY KEY REFERENCES Users(id),
+            bytes INTEGER NOT NULL DEFAULT 0,
+            files INTEGER NOT NULL DEFAULT 0,
+            quota INTEGER
+        )
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS files_usage_insert AFTER INSERT ON Files
+        WHEN NEW.owner_id IS NOT NULL
+        BEGIN
+            INSERT OR IGNORE INTO Usage (owner_id) VALUES (NEW.owner_id);
+            UPDATE Usage SET bytes = bytes + COALESCE(NEW.size, 0), files = files + 1
+            WHERE owner_id = NEW.owner_id;
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS files_usage_delete AFTER DELETE ON Files
+        WHEN OLD.owner_id IS NOT NULL
+        BEGIN
+            UPDATE Usage SET bytes = bytes - COALESCE(OLD.size, 0), files = files - 1
+            WHERE owner_id = OLD.owner_id;
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS files_usage_update AFTER UPDATE OF size, owner_id ON Files
+        BEGIN
+            UPDATE Usage SET bytes = bytes - COALESCE(OLD.size, 0), files = files - 1
+            WHERE owner_id = OLD.owner_id;
+            INSERT OR IGNORE INTO Usage (owner_id) SELECT NEW.owner_id WHERE NEW.owner_id IS NOT NULL;
+            UPDATE Usage SET bytes = bytes + COALESCE(NEW.size, 0), files = files + 1
+            WHERE owner_id = NEW.owner_id;
+        END
+    """)
+    reconcile_usage(conn=conn)
+
 
+def _migration_5_sessions(conn: sqlite3.Connection):
+    # сессии входа: хранится sha256 токена, а не сам токен; просроченные удаляются по индексу expires_at
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS Sessions (
+            token_hash TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL REFERENCES Users(id) ON DELETE CASCADE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            expires_at REAL NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_expires ON Sessions(expires_at)")
+
+
+def _migration_6_operations_timestamp(conn: sqlite3.Connection):
+    # ротация журнала: диапазон старых записей по времени без полного просмотра Operations
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_operations_timestamp ON Operations(timestamp)")
+
+
+# миграции схемы по порядку, версия схемы = число применённых миграций (PRAGMA user_version)
+MIGRATIONS = [
+    _migration_1_indexes,
+    _migration_2_blobs,
+    _migration_3_directories,
+    _migration_4_usage,
+    _migration_5_sessions,
+    _migration_6_operations_timestamp,
+]
+
+
+def _migrate(conn: sqlite3.Connection):
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        migration(conn)
+        conn.execute(f"PRAGMA user_version = {int(number)}")
+
+
+@metrics.timed(metrics.DB_QUERY)
 def add_user(username: str, password_hash: str):
     # prepared statement
     with get_db_connection() as conn:
@@ -61,6 +368,7 @@ def add_user(username: str, password_hash: str):
             (username, password_hash)
         )
 
+@metrics.timed(metrics.DB_QUERY)
 def get_user(username: str):
     with get_db_connection() as conn:
         cur = conn.cursor()
@@ -71,67 +379,632 @@ def get_user(username: str):
         row = cur.fetchone()
         return row
 
-def add_file(filename: str, size: int, location: str, owner_id: int) -> int:
-    # запись о файле prepared, возвращает id
-    with get_db_connection() as conn:
+def _split_location(location: str) -> tuple[list[str], str]:
+    # путь файла -> (имена директорий от корня пользователя, имя файла); разделители \\ и / равнозначны
+    path = posixpath.normpath(location.replace("\\", "/")) if location else ""
+    parts = [part for part in path.split("/") if part not in ("", ".")]
+    if not parts:
+        raise ValueError(f"Пустой путь: {location!r}")
+    return parts[:-1], parts[-1]
+
+
+def _dir_parts(path: str) -> list[str]:
+    # путь директории -> имена от корня пользователя, корень - []
+    path = posixpath.normpath(path.replace("\\", "/")) if path else ""
+    return [part for part in path.split("/") if part not in ("", ".")]
+
+
+def _cache_key(dirs: list[str], filename: str, owner_id: int) -> tuple[int, str]:
+    return owner_id, "/".join(dirs + [filename])
+
+
+def _forget(keys=(), file_ids=(), owner_id: int | None = None, prefix: str | None = None):
+    # сброс кэша метаданных: сразу и ещё раз после commit - другой поток мог закэшировать запись
+    # в том виде, в каком она была до этой транзакции
+    if not meta_cache.ENABLED:
+        return
+    keys, file_ids = list(keys), list(file_ids)
+    meta_cache.invalidate(keys, file_ids, owner_id, prefix)
+    on_commit(lambda: meta_cache.invalidate(keys, file_ids, owner_id, prefix))
+
+
+def _sync_shared_cache(conn: sqlite3.Connection):
+    # хранилище общее с другими процессами: их изменения не проходят через _forget этого процесса.
+    # PRAGMA data_version соединения меняется после каждого чужого commit - тогда кэш сбрасывается целиком
+    version = conn.execute("PRAGMA data_version").fetchone()[0]
+    if version != _local.data_version:
+        meta_cache.clear()
+        _local.data_version = version
+
+
+def _child_dir(parent_id: int | None, name: str, owner_id: int, conn: sqlite3.Connection, create: bool) -> int | None:
+    # поиск по уникальному индексу (parent_id, name); корень пользователя - parent_id NULL
+    if parent_id is None:
+        query, params = "SELECT id FROM Directories WHERE owner_id = ? AND parent_id IS NULL", (owner_id,)
+    else:
+        query, params = "SELECT id FROM Directories WHERE parent_id = ? AND name = ?", (parent_id, name)
+    row = conn.execute(query, params).fetchone()
+    if row is None and create:
+        # OR IGNORE: директорию могли создать параллельно
+        conn.execute(
+            "INSERT OR IGNORE INTO Directories (owner_id, parent_id, name) VALUES (?, ?, ?)",
+            (owner_id, parent_id, name)
+        )
+        row = conn.execute(query, params).fetchone()
+    return row[0] if row else None
+
+
+def _resolve_dir(parts: list[str], owner_id: int, conn: sqlite3.Connection, create: bool = False) -> int | None:
+    # id директории по именам от корня, по одному индексированному запросу на уровень;
+    # create=True создаёт недостающие директории
+    dir_id = _child_dir(None, "", owner_id, conn, create)
+    for name in parts:
+        if dir_id is None:
+            return None
+        dir_id = _child_dir(dir_id, name, owner_id, conn, create)
+    return dir_id
+
+
+@metrics.timed(metrics.DB_QUERY)
+def update_password_hash(user_id: int, password_hash: str, conn: sqlite3.Connection | None = None):
+    with _session(conn) as conn:
+        conn.execute("UPDATE Users SET password_hash = ? WHERE id = ?", (password_hash, user_id))
+
+
+@metrics.timed(metrics.DB_QUERY)
+def add_session(token_hash: str, user_id: int, expires_at: float, conn: sqlite3.Connection | None = None):
+    with _session(conn) as conn:
+        conn.execute(
+            "INSERT INTO Sessions (token_hash, user_id, expires_at) VALUES (?, ?, ?)",
+            (token_hash, user_id, expires_at)
+        )
+
+
+@metrics.timed(metrics.DB_QUERY)
+def get_session(token_hash: str, conn: sqlite3.Connection | None = None) -> tuple[int, str, float] | None:
+    # (id пользователя, логин, срок действия) или None
+    with _session(conn) as conn:
+        return conn.execute("""
+            SELECT s.user_id, u.username, s.expires_at
+            FROM Sessions s JOIN Users u ON u.id = s.user_id
+            WHERE s.token_hash = ?
+        """, (token_hash,)).fetchone()
+
+
+@metrics.timed(metrics.DB_QUERY)
+def delete_session(token_hash: str, conn: sqlite3.Connection | None = None):
+    with _session(conn) as conn:
+        conn.execute("DELETE FROM Sessions WHERE token_hash = ?", (token_hash,))
+
+
+@metrics.timed(metrics.DB_QUERY)
+def purge_sessions(now: float, conn: sqlite3.Connection | None = None) -> int:
+    # удаление просроченных сессий, возвращает их число
+    with _session(conn) as conn:
+        return conn.execute("DELETE FROM Sessions WHERE expires_at <= ?", (now,)).rowcount
+
+
+@metrics.timed(metrics.DB_QUERY)
+def add_file(filename: str, size: int, location: str, owner_id: int, conn: sqlite3.Connection | None = None) -> int:
+    # запись о файле prepared, возвращает id. Имя файла берётся из location,
+    # недостающие родительские директории создаются
+    dirs, filename = _split_location(location)
+    with _session(conn) as conn:
         cur = conn.cursor()
         cur.execute(
-            "INSERT INTO Files (filename, size, location, owner_id) VALUES (?, ?, ?, ?)",
-            (filename, size, location, owner_id)
+            "INSERT INTO Files (filename, size, owner_id, dir_id) VALUES (?, ?, ?, ?)",
+            (filename, size, owner_id, _resolve_dir(dirs, owner_id, conn, create=True))
         )
+        _forget([_cache_key(dirs, filename, owner_id)])
         return cur.lastrowid
 
-def get_file_id(location: str, owner_id: int) -> int | None:
-    # получение id файла по пути и владельцу с проверкой доступа
-    with get_db_connection() as conn:
+def _file_meta(location: str, owner_id: int, conn: sqlite3.Connection | None) -> tuple[int, int] | None:
+    # (id, размер) записи файла: из кэша метаданных без обращения к таблицам, иначе запросом.
+    # кэш только для чтений вне транзакции: изменяющая операция всегда берёт id из бд
+    dirs, filename = _split_location(location)
+    key = _cache_key(dirs, filename, owner_id)
+    cacheable = meta_cache.ENABLED and conn is None and not getattr(_local, "depth", 0)
+    if cacheable:
+        if meta_cache.SHARED:
+            _sync_shared_cache(_thread_connection())
+        cached = meta_cache.get(key)
+        if cached is not None:
+            return cached
+        seen = meta_cache.version(key)
+    with _session(conn) as conn:
+        dir_id = _resolve_dir(dirs, owner_id, conn)
+        if dir_id is None:
+            return None
         cur = conn.cursor()
         cur.execute(
-            "SELECT id FROM Files WHERE location = ? AND owner_id = ?",
-            (location, owner_id)
+            "SELECT id, size FROM Files WHERE dir_id = ? AND filename = ?",
+            (dir_id, filename)
         )
         row = cur.fetchone()
-        return row[0] if row else None
+    if row is None:
+        return None
+    if cacheable:
+        meta_cache.put(key, row[0], row[1], seen)
+    return row[0], row[1]
+
+@metrics.timed(metrics.DB_QUERY)
+def get_file_id(location: str, owner_id: int, conn: sqlite3.Connection | None = None) -> int | None:
+    # получение id файла по пути и владельцу с проверкой доступа
+    meta = _file_meta(location, owner_id, conn)
+    return meta[0] if meta else None
 
-def update_file_size(file_id: int, size: int):
+@metrics.timed(metrics.DB_QUERY)
+def get_file_meta(location: str, owner_id: int, conn: sqlite3.Connection | None = None) -> tuple[int, int] | None:
+    # (id, размер из Files) по пути и владельцу, None - записи нет
+    return _file_meta(location, owner_id, conn)
+
+@metrics.timed(metrics.DB_QUERY)
+def update_file_size(file_id: int, size: int, conn: sqlite3.Connection | None = None):
     # обновление размера файла prepared
-    with get_db_connection() as conn:
+    with _session(conn) as conn:
         cur = conn.cursor()
         cur.execute(
             "UPDATE Files SET size = ? WHERE id = ?",
             (size, file_id)
         )
+        _forget(file_ids=[file_id])
 
-def update_file_location(file_id: int, new_location: str):
-    with get_db_connection() as conn:
+@metrics.timed(metrics.DB_QUERY)
+def update_file_location(file_id: int, new_location: str, conn: sqlite3.Connection | None = None):
+    # перенос файла в другую директорию и/или под другое имя
+    dirs, filename = _split_location(new_location)
+    with _session(conn) as conn:
         cur = conn.cursor()
+        cur.execute("SELECT owner_id FROM Files WHERE id = ?", (file_id,))
+        row = cur.fetchone()
+        if row is None:
+            return
         cur.execute(
-            "UPDATE Files SET location = ? WHERE id = ?",
-            (new_location, file_id)
+            "UPDATE Files SET dir_id = ?, filename = ? WHERE id = ?",
+            (_resolve_dir(dirs, row[0], conn, create=True), filename, file_id)
         )
+        _forget([_cache_key(dirs, filename, row[0])], [file_id])
 
-def delete_file_record(file_id: int):
+@metrics.timed(metrics.DB_QUERY)
+def delete_file_record(file_id: int, conn: sqlite3.Connection | None = None):
     # удаление записи о файле prepared, cascade удалит operations
-    with get_db_connection() as conn:
+    with _session(conn) as conn:
         cur = conn.cursor()
         cur.execute(
             "DELETE FROM Files WHERE id = ?",
             (file_id,)
         )
+        _forget(file_ids=[file_id])
 
-def log_operation(operation_type: str, file_id: int | None, user_id: int):
+@metrics.timed(metrics.DB_QUERY)
+def log_operation(operation_type: str, file_id: int | None, user_id: int, conn: sqlite3.Connection | None = None):
     # логирование операции в бд prepared, file_id
-    with get_db_connection() as conn:
+    with _session(conn) as conn:
         cur = conn.cursor()
         cur.execute(
             "INSERT INTO Operations (operation_type, file_id, user_id) VALUES (?, ?, ?)",
             (operation_type, file_id, user_id)
         )
 
-def get_user_files(owner_id: int):
+@metrics.timed(metrics.DB_QUERY)
+def get_file_blob(file_id: int, conn: sqlite3.Connection | None = None) -> str | None:
+    with _session(conn) as conn:
+        row = conn.execute("SELECT blob_hash FROM Files WHERE id = ?", (file_id,)).fetchone()
+        return row[0] if row else None
+
+
+@metrics.timed(metrics.DB_QUERY)
+def set_file_blob(file_id: int, blob_hash: str | None, conn: sqlite3.Connection | None = None):
+    # refcount blob'ов меняют триггеры
+    with _session(conn) as conn:
+        conn.execute("UPDATE Files SET blob_hash = ? WHERE id = ?", (blob_hash, file_id))
+
+
+@metrics.timed(metrics.DB_QUERY)
+def add_blob(blob_hash: str, size: int, conn: sqlite3.Connection | None = None):
+    with _session(conn) as conn:
+        conn.execute("INSERT OR IGNORE INTO Blobs (hash, size) VALUES (?, ?)", (blob_hash, size))
+
+
+@metrics.timed(metrics.DB_QUERY)
+def pop_unreferenced_blobs(conn: sqlite3.Connection | None = None) -> list[str]:
+    # удаление записей blob'ов без ссылок, возвращает их хэши для удаления файлов
+    with _session(conn) as conn:
+        hashes = [row[0] for row in conn.execute("SELECT hash FROM Blobs WHERE refcount <= 0")]
+        conn.executemany("DELETE FROM Blobs WHERE hash = ? AND refcount <= 0", [(h,) for h in hashes])
+        return hashes
+
+
+# параметров в одном IN (...) - с запасом ниже лимита SQLite на число переменных
+_IN_BATCH = 500
+
+
+@metrics.timed(metrics.DB_QUERY)
+def get_file_ids(locations: list[str], owner_id: int, conn: sqlite3.Connection | None = None) -> dict[str, int]:
+    # id файлов по списку путей: пути группируются по директориям, каждая директория
+    # разрешается один раз, имена в ней ищутся пачками. {путь: id} только для найденных
+    by_dir = {}
+    for location in locations:
+        dirs, filename = _split_location(location)
+        by_dir.setdefault(tuple(dirs), {})[filename] = location
+    result = {}
+    with _session(conn) as conn:
+        for dirs, names in by_dir.items():
+            dir_id = _resolve_dir(list(dirs), owner_id, conn)
+            if dir_id is None:
+                continue
+            filenames = list(names)
+            for i in range(0, len(filenames), _IN_BATCH):
+                batch = filenames[i:i + _IN_BATCH]
+                marks = ", ".join("?" * len(batch))
+                rows = conn.execute(
+                    f"SELECT filename, id FROM Files WHERE dir_id = ? AND filename IN ({marks})",
+                    (dir_id, *batch)
+                )
+                result.update((names[filename], file_id) for filename, file_id in rows)
+    return result
+
+
+@metrics.timed(metrics.DB_QUERY)
+def record_files(files: list[tuple[str, int]], owner_id: int,
+                 conn: sqlite3.Connection | None = None) -> list[tuple[str, int]]:
+    # пакетная запись (путь, размер): существующие обновляются, новые добавляются через executemany.
+    # возвращает [(тип операции, id файла)] в порядке files для log_operations
+    with _session(conn) as conn:
+        existing = get_file_ids([location for location, _ in files], owner_id, conn)
+        dir_ids = {}
+        new = []
+        for location, size in files:
+            if location in existing:
+                continue
+            dirs, filename = _split_location(location)
+            if tuple(dirs) not in dir_ids:
+                dir_ids[tuple(dirs)] = _resolve_dir(dirs, owner_id, conn, create=True)
+            new.append((filename, size, owner_id, dir_ids[tuple(dirs)]))
+        conn.executemany(
+            "UPDATE Files SET size = ? WHERE id = ?",
+            [(size, existing[location]) for location, size in files if location in existing]
+        )
+        conn.executemany(
+            "INSERT INTO Files (filename, size, owner_id, dir_id) VALUES (?, ?, ?, ?)",
+            new
+        )
+        _forget(_cache_key(*_split_location(location), owner_id) for location, _ in files)
+        created = get_file_ids([location for location, _ in files if location not in existing], owner_id, conn)
+    return [("modify", existing[location]) if location in existing else ("create", created[location])
+            for location, _ in files]
+
+
+@metrics.timed(metrics.DB_QUERY)
+def delete_file_records(file_ids: list[int], conn: sqlite3.Connection | None = None):
+    # пакетное удаление записей о файлах одним executemany
+    with _session(conn) as conn:
+        conn.executemany("DELETE FROM Files WHERE id = ?", [(file_id,) for file_id in file_ids])
+        _forget(file_ids=file_ids)
+
+
+@metrics.timed(metrics.DB_QUERY)
+def log_operations(operations: list[tuple[str, int | None]], user_id: int,
+                   conn: sqlite3.Connection | None = None):
+    # пакетное логирование [(тип операции, id файла)] одним executemany
+    with _session(conn) as conn:
+        conn.executemany(
+            "INSERT INTO Operations (operation_type, file_id, user_id) VALUES (?, ?, ?)",
+            [(operation_type, file_id, user_id) for operation_type, file_id in operations]
+        )
+
+
+@metrics.timed(metrics.DB_QUERY)
+def add_directory(subdir: str, owner_id: int, conn: sqlite3.Connection | None = None) -> int:
+    # запись директории (и недостающих родительских), возвращает id
+    with _session(conn) as conn:
+        return _resolve_dir(_dir_parts(subdir), owner_id, conn, create=True)
+
+
+@metrics.timed(metrics.DB_QUERY)
+def delete_directory_record(subdir: str, owner_id: int, conn: sqlite3.Connection | None = None):
+    # удаление директории со всем поддеревом: ON DELETE CASCADE по индексам parent_id и dir_id,
+    # триггеры blob'ов и ссылки Operations срабатывают для каждой удалённой записи Files
+    with _session(conn) as conn:
+        dir_id = _resolve_dir(_dir_parts(subdir), owner_id, conn)
+        if dir_id is not None:
+            conn.execute("DELETE FROM Directories WHERE id = ?", (dir_id,))
+            _forget(owner_id=owner_id, prefix="/".join(_dir_parts(subdir)))
+
+
+@metrics.timed(metrics.DB_QUERY)
+def move_directory_record(src_subdir: str, dest_subdir: str, owner_id: int,
+                          conn: sqlite3.Connection | None = None):
+    # перемещение/переименование директории - одна запись: новый родитель и имя,
+    # пути всех вложенных файлов меняются вместе с ней
+    dest_parts = _dir_parts(dest_subdir)
+    if not dest_parts:
+        raise ValueError("Нельзя переместить директорию на место корня")
+    with _session(conn) as conn:
+        dir_id = _resolve_dir(_dir_parts(src_subdir), owner_id, conn)
+        if dir_id is None:
+            return  # в индексе нет ни одной записи из этой директории
+        parent_id = _resolve_dir(dest_parts[:-1], owner_id, conn, create=True)
+        # на диске места назначения нет (проверяет вызывающий) - запись о нём устарела
+        conn.execute(
+            "DELETE FROM Directories WHERE parent_id = ? AND name = ? AND id != ?",
+            (parent_id, dest_parts[-1], dir_id)
+        )
+        conn.execute(
+            "UPDATE Directories SET parent_id = ?, name = ? WHERE id = ?",
+            (parent_id, dest_parts[-1], dir_id)
+        )
+        # пути всех файлов под обеими директориями в кэше устарели
+        _forget(owner_id=owner_id, prefix="/".join(_dir_parts(src_subdir)))
+        _forget(owner_id=owner_id, prefix="/".join(dest_parts))
+
+
+@metrics.timed(metrics.DB_QUERY)
+def insert_operations(rows: list[tuple[str, str, int | None, int]], conn: sqlite3.Connection | None = None):
+    # отложенная запись журнала [(время, тип операции, id файла, id пользователя)]:
+    # файл к моменту записи мог быть удалён - тогда file_id NULL, как и при ON DELETE SET NULL
+    with _session(conn) as conn:
+        conn.executemany("""
+            INSERT INTO Operations (timestamp, operation_type, file_id, user_id)
+            VALUES (?, ?, (SELECT id FROM Files WHERE id = ?), ?)
+        """, rows)
+
+
+@metrics.timed(metrics.DB_QUERY)
+def rotate_operations(before: str, archive_path: str | None = None, batch_size: int = 10000) -> int:
+    # удаление записей журнала старше before ('YYYY-MM-DD HH:MM:SS', UTC) пачками, каждая - своя
+    # короткая транзакция. archive_path - перед удалением записи копируются в отдельную бд.
+    # возвращает число удалённых записей
+    removed = 0
     with get_db_connection() as conn:
+        if archive_path:
+            conn.execute("ATTACH DATABASE ? AS archive", (archive_path,))
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS archive.Operations (
+                    id INTEGER PRIMARY KEY,
+                    timestamp TIMESTAMP,
+                    operation_type TEXT,
+                    file_id INTEGER,
+                    user_id INTEGER
+                )
+            """)
+    try:
+        while True:
+            with transaction() as conn:
+                last_id = conn.execute("""
+                    SELECT MAX(id) FROM (
+                        SELECT id FROM Operations WHERE timestamp < ? ORDER BY timestamp LIMIT ?
+                    )
+                """, (before, batch_size)).fetchone()[0]
+                if last_id is None:
+                    return removed
+                if archive_path:
+                    conn.execute("""
+                        INSERT OR IGNORE INTO archive.Operations
+                        SELECT id, timestamp, operation_type, file_id, user_id FROM main.Operations
+                        WHERE timestamp < ? AND id <= ?
+                    """, (before, last_id))
+                removed += conn.execute(
+                    "DELETE FROM Operations WHERE timestamp < ? AND id <= ?", (before, last_id)
+                ).rowcount
+    finally:
+        if archive_path:
+            with get_db_connection() as conn:
+                conn.execute("DETACH DATABASE archive")
+
+
+@metrics.timed(metrics.DB_QUERY)
+def get_usage(owner_id: int, conn: sqlite3.Connection | None = None) -> tuple[int, int | None]:
+    # (занято байт, своя квота или None) - одна строка по первичному ключу
+    with _session(conn) as conn:
+        row = conn.execute("SELECT bytes, quota FROM Usage WHERE owner_id = ?", (owner_id,)).fetchone()
+        return (row[0], row[1]) if row else (0, None)
+
+
+@metrics.timed(metrics.DB_QUERY)
+def get_usage_stats(owner_id: int, conn: sqlite3.Connection | None = None) -> tuple[int, int, int | None]:
+    # (байт, файлов, своя квота или None)
+    with _session(conn) as conn:
+        row = conn.execute("SELECT bytes, files, quota FROM Usage WHERE owner_id = ?", (owner_id,)).fetchone()
+        return tuple(row) if row else (0, 0, None)
+
+
+@metrics.timed(metrics.DB_QUERY)
+def set_quota(owner_id: int, quota: int | None, conn: sqlite3.Connection | None = None):
+    # своя квота пользователя в байтах, None - общий лимит
+    with _session(conn) as conn:
+        conn.execute("INSERT OR IGNORE INTO Usage (owner_id) VALUES (?)", (owner_id,))
+        conn.execute("UPDATE Usage SET quota = ? WHERE owner_id = ?", (quota, owner_id))
+
+
+@metrics.timed(metrics.DB_QUERY)
+def reconcile_usage(owner_id: int | None = None, conn: sqlite3.Connection | None = None) -> dict[int, tuple]:
+    # пересчёт счётчиков Usage с нуля по Files (всех пользователей или одного), квоты сохраняются.
+    # возвращает {owner_id: ((было байт, файлов), (стало байт, файлов))} для разошедшихся счётчиков
+    where, params = ("WHERE owner_id = ?", (owner_id,)) if owner_id is not None else ("WHERE owner_id IS NOT NULL", ())
+    with _session(conn) as conn:
+        actual = {row[0]: (row[1], row[2]) for row in conn.execute(
+            f"SELECT owner_id, COALESCE(SUM(size), 0), COUNT(*) FROM Files {where} GROUP BY owner_id", params
+        )}
+        stored = {row[0]: (row[1], row[2]) for row in conn.execute(
+            f"SELECT owner_id, bytes, files FROM Usage {where}", params
+        )}
+        drift = {}
+        for owner in actual.keys() | stored.keys():
+            new = actual.get(owner, (0, 0))
+            old = stored.get(owner)
+            if old == new:
+                continue
+            drift[owner] = (old or (0, 0), new)
+            conn.execute("INSERT OR IGNORE INTO Usage (owner_id) VALUES (?)", (owner,))
+            conn.execute("UPDATE Usage SET bytes = ?, files = ? WHERE owner_id = ?", (*new, owner))
+        return drift
+
+
+# сортировки листинга директории: выражение ключа; keyset-курсор - (ключ, name) последней строки
+LIST_SORTS = {"name": "name", "size": "size"}
+
+
+@metrics.timed(metrics.DB_QUERY)
+def list_directory_page(subdir: str, owner_id: int, limit: int, after: tuple | None = None,
+                        sort: str = "name", reverse: bool = False, pattern: str | None = None,
+                        conn: sqlite3.Connection | None = None) -> list[tuple] | None:
+    # страница содержимого директории из индекса: [(name, is_dir, size, file_id)],
+    # после курсора after, не больше limit строк. pattern - GLOB по имени (* ? [...], с учётом регистра).
+    # None - директории нет в индексе
+    if sort not in LIST_SORTS:
+        raise ValueError(f"Неизвестная сортировка: {sort}")
+    key = LIST_SORTS[sort]
+    direction, compare = ("DESC", "<") if reverse else ("ASC", ">")
+    conditions, params = [], []
+    if pattern:
+        conditions.append("name GLOB ?")
+        params.append(pattern)
+    if after is not None:
+        conditions.append(f"({key}, name) {compare} (?, ?)")
+        params.extend(after)
+    where = "WHERE " + " AND ".join(conditions) if conditions else ""
+    with _session(conn) as conn:
+        dir_id = _resolve_dir(_dir_parts(subdir), owner_id, conn)
+        if dir_id is None:
+            return None
+        # в каждой ветке своя страница по индексу (parent_id, name) / (dir_id, filename),
+        # общая сортировка - только по 2 * limit строкам, а не по всей директории
+        order = f"ORDER BY {key} {direction}, name {direction} LIMIT ?"
+        return conn.execute(f"""
+            SELECT * FROM (
+                SELECT * FROM (
+                    SELECT name, 1 AS is_dir, 0 AS size, NULL AS file_id FROM Directories WHERE parent_id = ?
+                ) {where} {order}
+            )
+            UNION ALL
+            SELECT * FROM (
+                SELECT * FROM (
+                    SELECT filename AS name, 0 AS is_dir, COALESCE(size, 0) AS size, id AS file_id
+                    FROM Files WHERE dir_id = ?
+                ) {where} {order}
+            )
+            {order}
+        """, (dir_id, *params, limit, dir_id, *params, limit, limit)).fetchall()
+
+
+@metrics.timed(metrics.DB_QUERY)
+def list_directory_names(subdir: str, owner_id: int, conn: sqlite3.Connection | None = None) -> set[str] | None:
+    # все имена директории в индексе (поддиректории и файлы), None - директории нет в индексе
+    with _session(conn) as conn:
+        dir_id = _resolve_dir(_dir_parts(subdir), owner_id, conn)
+        if dir_id is None:
+            return None
+        rows = conn.execute(
+            "SELECT name FROM Directories WHERE parent_id = ? UNION ALL SELECT filename FROM Files WHERE dir_id = ?",
+            (dir_id, dir_id)
+        ).fetchall()
+        return {name for name, in rows}
+
+
+def _dir_paths(dir_ids: set[int], conn: sqlite3.Connection) -> dict[int, str]:
+    # пути директорий от корня: подъём по parent_id только от нужных директорий
+    result = {}
+    ids = list(dir_ids)
+    for i in range(0, len(ids), _IN_BATCH):
+        batch = ids[i:i + _IN_BATCH]
+        marks = ", ".join("?" * len(batch))
+        rows = conn.execute(f"""
+            WITH RECURSIVE up(start, parent_id, path) AS (
+                SELECT id, parent_id, name FROM Directories WHERE id IN ({marks})
+                UNION ALL
+                SELECT up.start, d.parent_id, d.name || '/' || up.path
+                FROM Directories d JOIN up ON d.id = up.parent_id
+            )
+            SELECT start, path FROM up WHERE parent_id IS NULL
+        """, batch)
+        result.update((start, path.lstrip("/")) for start, path in rows)
+    return result
+
+
+@metrics.timed(metrics.DB_QUERY)
+def get_user_files_page(owner_id: int, limit: int, after: tuple | None = None,
+                        conn: sqlite3.Connection | None = None) -> tuple[list[tuple], tuple | None]:
+    # страница файлов владельца, новые первыми: [(filename, size, created_at, location)] и курсор
+    # (created_at, id) последней строки для следующей страницы (None - страниц больше нет).
+    # keyset по индексу (owner_id, created_at): каждая страница стоит O(limit), а не O(смещения)
+    query = "SELECT id, filename, size, created_at, dir_id FROM Files WHERE owner_id = ?"
+    params = [owner_id]
+    if after is not None:
+        query += " AND (created_at, id) < (?, ?)"
+        params.extend(after)
+    query += " ORDER BY created_at DESC, id DESC LIMIT ?"
+    params.append(limit)
+    with _session(conn) as conn:
+        rows = conn.execute(query, params).fetchall()
+        paths = _dir_paths({row[4] for row in rows if row[4] is not None}, conn)
+    page = [(filename, size, created_at, f"{paths[dir_id]}/{filename}".lstrip("/"))
+            for _, filename, size, created_at, dir_id in rows if dir_id in paths]
+    cursor = (rows[-1][3], rows[-1][0]) if len(rows) == limit else None
+    return page, cursor
+
+
+def iter_user_files(owner_id: int, page_size: int = 1000):
+    # все файлы владельца генератором, по странице за запрос; между страницами бд не занята
+    after = None
+    while True:
+        page, after = get_user_files_page(owner_id, page_size, after)
+        yield from page
+        if after is None:
+            return
+
+
+# пути директорий владельца от корня: рекурсия по parent_id, каждый шаг - поиск по индексу
+_DIR_PATHS = """
+    WITH RECURSIVE dir_paths(id, path) AS (
+        SELECT id, '' FROM Directories WHERE owner_id = ? AND parent_id IS NULL
+        UNION ALL
+        SELECT d.id, CASE WHEN p.path = '' THEN d.name ELSE p.path || '/' || d.name END
+        FROM Directories d JOIN dir_paths p ON d.parent_id = p.id
+    )
+"""
+_FILE_PATH = "CASE WHEN p.path = '' THEN f.filename ELSE p.path || '/' || f.filename END"
+
+
+@metrics.timed(metrics.DB_QUERY)
+def get_user_files(owner_id: int, conn: sqlite3.Connection | None = None):
+    with _session(conn) as conn:
         cur = conn.cursor()
         cur.execute(
-            "SELECT filename, size, created_at, location FROM Files WHERE owner_id = ? ORDER BY created_at DESC",
+            _DIR_PATHS + f"""
+            SELECT f.filename, f.size, f.created_at, {_FILE_PATH}
+            FROM Files f JOIN dir_paths p ON f.dir_id = p.id
+            ORDER BY f.created_at DESC
+            """,
             (owner_id,)
         )
-        return cur.fetchall()
\ No newline at end of file
+        return cur.fetchall()
+
+
+@metrics.timed(metrics.DB_QUERY)
+def get_unblobbed_files(owner_id: int, conn: sqlite3.Connection | None = None) -> list[tuple[int, str]]:
+    # [(id, путь)] файлов владельца, ещё не переведённых в хранилище blob'ов
+    with _session(conn) as conn:
+        return conn.execute(
+            _DIR_PATHS + f"""
+            SELECT f.id, {_FILE_PATH}
+            FROM Files f JOIN dir_paths p ON f.dir_id = p.id
+            WHERE f.blob_hash IS NULL
+            """,
+            (owner_id,)
+        ).fetchall()
+
+
+if __name__ == "__main__":
+    # python db.py reconcile [DB_PATH] - пересчёт счётчиков занятого места
+    if len(sys.argv) < 2 or sys.argv[1] != "reconcile":
+        raise SystemExit("Использование: python db.py reconcile [DB_PATH]")
+    if len(sys.argv) > 2:
+        DB_PATH = sys.argv[2]
+    init_db()
+    with transaction() as conn:
+        drift = reconcile_usage(conn=conn)
+    for owner, (old, new) in sorted(drift.items()):
+        print(f"Пользователь {owner}: было {old[0]:,} байт / {old[1]} файлов, стало {new[0]:,} байт / {new[1]} файлов")
+    print(f"Исправлено счётчиков: {len(drift)}")
+    close_db_connections()
@@ -0,0 +1,102 @@
+import asyncio
+import functools
+import multiprocessing
+import os
+import threading
+import weakref
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+# отдельные пулы потоков для async API:
+# io - диск и бд (потоки в основном ждут), cpu - сжатие, разбор JSON/XML (zlib отпускает GIL),
+# process - bcrypt в отдельных процессах
+IO_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+CPU_WORKERS = os.cpu_count() or 1
+# пул процессов для тяжёлого CPU (bcrypt): работа идёт в другом процессе и не отнимает
+# ядро и GIL у event loop и потоков io. функции и аргументы должны сериализоваться pickle
+PROCESS_WORKERS = max(1, min(4, os.cpu_count() or 1))
+
+# backpressure: сколько задач одного вида может ждать и выполняться одновременно,
+# остальные вызовы ждут в event loop, а не копятся в очереди пула
+MAX_PENDING_IO = IO_WORKERS * 4
+MAX_PENDING_CPU = CPU_WORKERS * 2
+MAX_PENDING_PROCESS = PROCESS_WORKERS * 4
+
+IO = "io"
+CPU = "cpu"
+PROCESS = "process"
+
+_executors = {}
+_executors_lock = threading.Lock()
+# семафоры привязаны к своему event loop
+_semaphores = weakref.WeakKeyDictionary()
+
+
+def _process_context():
+    # fork процесса с потоками (пулы, соединения бд) небезопасен: рабочие процессы
+    # запускаются через forkserver, где его нет - через spawn
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+
+
+def get_executor(kind: str):
+    with _executors_lock:
+        executor = _executors.get(kind)
+        if executor is None:
+            if kind == PROCESS:
+                executor = ProcessPoolExecutor(max_workers=PROCESS_WORKERS, mp_context=_process_context())
+            else:
+                workers = IO_WORKERS if kind == IO else CPU_WORKERS
+                executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"sfm-{kind}")
+            _executors[kind] = executor
+        return executor
+
+
+def _semaphore(loop, kind: str) -> asyncio.Semaphore:
+    per_loop = _semaphores.setdefault(loop, {})
+    if kind not in per_loop:
+        limit = {IO: MAX_PENDING_IO, CPU: MAX_PENDING_CPU, PROCESS: MAX_PENDING_PROCESS}[kind]
+        per_loop[kind] = asyncio.Semaphore(limit)
+    return per_loop[kind]
+
+
+async def run(kind: str, fn, *args, **kwargs):
+    # выполнение fn в пуле kind. Отмена задачи снимает fn из очереди пула, если она ещё не началась;
+    # уже запущенная функция дорабатывает, место в лимите освобождается только после неё
+    loop = asyncio.get_running_loop()
+    semaphore = _semaphore(loop, kind)
+    await semaphore.acquire()
+    try:
+        future = get_executor(kind).submit(functools.partial(fn, *args, **kwargs))
+    except BaseException:
+        semaphore.release()
+        raise
+
+    def release(_):
+        try:
+            loop.call_soon_threadsafe(semaphore.release)
+        except RuntimeError:
+            pass  # event loop уже закрыт
+
+    future.add_done_callback(release)
+    return await asyncio.wrap_future(future)
+
+
+async def run_io(fn, *args, **kwargs):
+    return await run(IO, fn, *args, **kwargs)
+
+
+async def run_cpu(fn, *args, **kwargs):
+    return await run(CPU, fn, *args, **kwargs)
+
+
+async def run_process(fn, *args, **kwargs):
+    return await run(PROCESS, fn, *args, **kwargs)
+
+
+def shutdown(wait: bool = True):
+    # остановка пулов при выходе из программы; не начатые задачи отменяются
+    with _executors_lock:
+        executors = list(_executors.values())
+        _executors.clear()
+    for executor in executors:
+        executor.shutdown(wait=wait, cancel_futures=True)
@@ -0,0 +1,123 @@
+import os
+import errno
+import shutil
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# копирование содержимого файла средствами ядра, от самого быстрого способа к самому медленному:
+# reflink (FICLONE, btrfs/XFS: новый файл делит блоки со старым, копирование почти мгновенное),
+# copy_file_range (копирование внутри ядра, на NFS/CIFS - на стороне сервера),
+# sendfile (ядро, без копирования через буферы Python), обычное буферизованное копирование.
+# недоступный способ (другая ФС, старое ядро, Windows) пропускается
+
+FICLONE = 0x40049409  # _IOW(0x94, 9, int)
+COPY_CHUNK = 1024 * 1024 * 1024  # максимум за один системный вызов
+BUFFER_SIZE = 1024 * 1024
+
+REFLINK = "reflink"
+COPY_FILE_RANGE = "copy_file_range"
+SENDFILE = "sendfile"
+BUFFERED = "buffered"
+
+# ошибки "этот способ здесь не работает" - пробуем следующий
+_FALLBACK_ERRNOS = {errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTTY,
+                    errno.EBADF, errno.EPERM, errno.ENOTSUP, errno.ETXTBSY}
+
+
+def _reflink(src_fd: int, dst_fd: int, size: int):
+    fcntl.ioctl(dst_fd, FICLONE, src_fd)
+
+
+def _copy_file_range(src_fd: int, dst_fd: int, size: int):
+    offset = 0
+    while offset < size:
+        copied = os.copy_file_range(src_fd, dst_fd, min(COPY_CHUNK, size - offset), offset, offset)
+        if copied == 0:
+            break
+        offset += copied
+
+
+def _sendfile(src_fd: int, dst_fd: int, size: int):
+    offset = 0
+    while offset < size:
+        sent = os.sendfile(dst_fd, src_fd, offset, min(COPY_CHUNK, size - offset))
+        if sent == 0:
+            break
+        offset += sent
+
+
+def _buffered(src_fd: int, dst_fd: int, size: int):
+    os.lseek(src_fd, 0, os.SEEK_SET)
+    while True:
+        chunk = os.read(src_fd, BUFFER_SIZE)
+        if not chunk:
+            break
+        view = memoryview(chunk)
+        while view:
+            view = view[os.write(dst_fd, view):]
+
+
+_METHODS = {
+    REFLINK: _reflink,
+    COPY_FILE_RANGE: _copy_file_range,
+    SENDFILE: _sendfile,
+    BUFFERED: _buffered,
+}
+
+
+def available_methods() -> list[str]:
+    methods = []
+    if fcntl is not None and hasattr(fcntl, "ioctl") and os.name == "posix":
+        methods.append(REFLINK)
+    if hasattr(os, "copy_file_range"):
+        methods.append(COPY_FILE_RANGE)
+    if hasattr(os, "sendfile") and os.name == "posix":
+        methods.append(SENDFILE)
+    methods.append(BUFFERED)
+    return methods
+
+
+def copy_data(src: str, dst: str, methods: list[str] | None = None) -> str:
+    # копирование содержимого src в dst (dst создаётся или перезаписывается), возвращает способ
+    with open(src, "rb", buffering=0) as fsrc, open(dst, "wb", buffering=0) as fdst:
+        src_fd, dst_fd = fsrc.fileno(), fdst.fileno()
+        size = os.fstat(src_fd).st_size
+        last_error = None
+        for method in methods or available_methods():
+            try:
+                _METHODS[method](src_fd, dst_fd, size)
+                return method
+            except OSError as e:
+                if e.errno not in _FALLBACK_ERRNOS:
+                    raise
+                last_error = e
+                # способ мог успеть скопировать часть - начинаем заново следующим
+                os.ftruncate(dst_fd, 0)
+                os.lseek(dst_fd, 0, os.SEEK_SET)
+        raise last_error
+
+
+def copy(src: str, dst: str) -> str:
+    # как shutil.copy: содержимое и права доступа
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    copy_data(src, dst)
+    shutil.copymode(src, dst)
+    return dst
+
+
+def copy2(src: str, dst: str) -> str:
+    # как shutil.copy2: содержимое и метаданные; copy_function для shutil.move/copytree
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    copy_data(src, dst)
+    shutil.copystat(src, dst)
+    return dst
+
+
+def move(src: str, dst: str) -> str:
+    # shutil.move: в пределах одной ФС - rename, между ФС - копирование через ядро
+    return shutil.move(src, dst, copy_function=copy2)
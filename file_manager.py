@@ -1,160 +1,799 @@
 import os
 import shutil
 import asyncio
-from lock_manager import file_lock
+import mmap
+import tempfile
+import threading
+from typing import NamedTuple
+import lock_manager
+import executors
+import audit_log
+import blob_store
+import fast_copy
 import db
+import metrics
+import content_cache
 
 MAX_FILE_SIZE = 10 * 1024 * 1024  # 10 MB
+CHUNK_SIZE = 1024 * 1024  # размер куска для потоковых чтения и записи
+LIST_PAGE_SIZE = 1000  # записей на страницу листинга
+USER_QUOTA = 1024 * 1024 * 1024  # 1 GB на пользователя, если в Usage не задана своя квота; None - без лимита
 
-def is_safe_path(path: str, base_dir: str) -> bool:
+def is_safe_path(path: str, base_dir: str, allow_base: bool = False) -> bool:
     """
     # от Path Traversal:
     проверка что путь не выходит за base_dir включая абсолютные пути)
     """
     try:
-        base = os.path.abspath(base_dir) + os.sep
+        base = os.path.abspath(base_dir)
         full = os.path.abspath(path)
-        return full.startswith(base)
+        # allow_base: сама base_dir тоже допустима (корень пользователя для списка и архивации)
+        return (allow_base and full == base) or full.startswith(base + os.sep)
     except (ValueError, OSError):
         return False
 
+def _size_error(max_size: int) -> ValueError:
+    return ValueError(f"Размер файла превышает лимит {max_size // (1024*1024)} MB")
+
+def _quota_error(quota: int) -> ValueError:
+    return ValueError(f"Превышена квота пользователя: {quota:,} байт")
+
+def _quota(user_id: int, conn=None) -> tuple[int, int | None]:
+    # (занято байт, квота) за O(1): счётчик Usage по первичному ключу. квота None - без лимита
+    used, quota = db.get_usage(user_id, conn)
+    return used, USER_QUOTA if quota is None else quota
+
+def _check_quota(user_id: int, conn) -> None:
+    # проверка после изменения записей Files в транзакции: счётчики уже учли операцию (триггеры),
+    # при превышении транзакция откатывается до того, как изменения станут видны на диске
+    used, quota = _quota(user_id, conn)
+    if quota is not None and used > quota:
+        raise _quota_error(quota)
+
+def _to_bytes(chunk) -> bytes:
+    return chunk.encode("utf-8") if isinstance(chunk, str) else chunk
+
+def _iter_chunks(source):
+    # источник данных для записи: bytes/str целиком, файлоподобный объект (read) или итератор кусков
+    if isinstance(source, (bytes, bytearray, memoryview, str)):
+        yield _to_bytes(source)
+    elif hasattr(source, "read"):
+        while True:
+            chunk = source.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            yield _to_bytes(chunk)
+    else:
+        for chunk in source:
+            yield _to_bytes(chunk)
+
+def _iter_async_chunks(source, loop, cancelled):
+    # async итератор как обычный: для потока executor'а, куски берутся в event loop.
+    # после отмены вызывающей задачи запись прерывается на следующем куске
+    iterator = source.__aiter__()
+    while True:
+        if cancelled.is_set():
+            raise asyncio.CancelledError()
+        try:
+            chunk = asyncio.run_coroutine_threadsafe(iterator.__anext__(), loop).result()
+        except StopAsyncIteration:
+            return
+        yield chunk
+
+def _open_temp(full_path: str):
+    # временный файл в той же директории: os.replace в пределах одной файловой системы атомарен
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(full_path),
+                                    prefix="." + os.path.basename(full_path) + ".", suffix=".tmp")
+    return os.fdopen(fd, "wb"), tmp_path
+
+def _discard_temp(tmp_path: str):
+    try:
+        os.remove(tmp_path)
+    except FileNotFoundError:
+        pass
+
+def _record_write(path: str, size: int, user_id: int, conn) -> int:
+    # запись о файле и лог операции в транзакции conn, возвращает id файла
+    file_id = db.get_file_id(path, user_id, conn)
+    if file_id is not None:
+        op_type = "modify"
+        db.update_file_size(file_id, size, conn)
+    else:
+        op_type = "create"
+        file_id = db.add_file(os.path.basename(path), size, path, user_id, conn)
+    _check_quota(user_id, conn)
+    audit_log.record(op_type, file_id, user_id, conn)
+    return file_id
+
+class _Changed(Exception):
+    # файл заменили или дописали после того, как его версию запомнил rewrite_file_stream
+    pass
+
+def _version(full_path: str) -> tuple[int, int, int] | None:
+    try:
+        return content_cache.signature(os.stat(full_path))
+    except FileNotFoundError:
+        return None
+
+@metrics.timed()
+def write_file_stream(path: str, source, user_id: int, user_dir: str, mode: str = 'w',
+                      max_size: int = MAX_FILE_SIZE, expected: tuple | None = None) -> int:
+    # потоковая запись: source - bytes/str, файлоподобный объект или итератор кусков
+    # w: данные пишутся во временный файл без блокировки, лимит проверяется по ходу записи,
+    #    под блокировкой только os.replace и бд - читатель видит либо старый файл, либо новый целиком
+    # a: дозапись на месте под блокировкой пути, при ошибке частично дописанное обрезается.
+    #    транзакция (блокировка записи всей бд) - только на итоговую запись размера
+    # в режиме blob_store новое содержимое сразу попадает в хранилище blob'ов (хэш считается по ходу записи)
+    # expected (только w) - версия файла (_version), которую заменяет запись; другая под блокировкой - _Changed
+    # возвращает итоговый размер файла
+
+    full_path = os.path.join(user_dir, path)
+    if not is_safe_path(full_path, user_dir):
+        raise ValueError("Обнаружено попытка обхода пути (path traversal)")
+    chunks = _iter_chunks(source)
+
+    if mode == 'a':
+        with lock_manager.exclusive(user_id, path):
+            # общий с другими копиями inode на месте не меняем (copy-on-write)
+            blob_store.unshare(full_path)
+            # ранний отказ по квоте, точная проверка - в транзакции (_record_write)
+            used, quota = _quota(user_id)
+            with open(full_path, "ab") as f:
+                start = f.tell()
+                written = 0
+                try:
+                    for chunk in chunks:
+                        written += len(chunk)
+                        if written > max_size:
+                            raise _size_error(max_size)
+                        if quota is not None and used + written > quota:
+                            raise _quota_error(quota)
+                        f.write(chunk)
+                    f.flush()
+                    with db.transaction() as conn:
+                        _record_write(path, start + written, user_id, conn)
+                except BaseException:
+                    f.truncate(start)
+                    raise
+                finally:
+                    content_cache.invalidate(full_path)
+        metrics.count(metrics.BYTES_WRITTEN, written, "append")
+        blob_store.collect_garbage()
+        return start + written
+
+    hasher = blob_store.new_hasher() if blob_store.ENABLED else None
+    # ранний отказ по квоте ещё при записи во временный файл: новый файл заменит старый,
+    # поэтому старый размер не считается. точная проверка - в транзакции (_record_write)
+    used, quota = _quota(user_id)
+    if quota is not None:
+        old_size = os.path.getsize(full_path) if os.path.isfile(full_path) else 0
+    f, tmp_path = _open_temp(full_path)
+    try:
+        with f:
+            size = 0
+            for chunk in chunks:
+                size += len(chunk)
+                if size > max_size:
+                    raise _size_error(max_size)
+                if quota is not None and used - old_size + size > quota:
+                    raise _quota_error(quota)
+                f.write(chunk)
+                if hasher is not None:
+                    hasher.update(chunk)
+        with lock_manager.exclusive(user_id, path), db.transaction() as conn:
+            if expected is not None and _version(full_path) != expected:
+                raise _Changed()
+            file_id = _record_write(path, size, user_id, conn)
+            os.replace(tmp_path, full_path)
+            content_cache.invalidate(full_path)
+            if hasher is not None:
+                db.set_file_blob(file_id, blob_store.ingest(full_path, conn, hasher.hexdigest(), size), conn)
+    except BaseException:
+        _discard_temp(tmp_path)
+        raise
+    metrics.count(metrics.BYTES_WRITTEN, size, "write")
+    blob_store.collect_garbage()
+    return size
+
+async def async_write_file_stream(path: str, source, user_id: int, user_dir: str, mode: str = 'w',
+                                  max_size: int = MAX_FILE_SIZE) -> int:
+    # асинхронный write_file_stream, source может быть и async итератором кусков
+    cancelled = threading.Event()
+    if hasattr(source, "__aiter__"):
+        source = _iter_async_chunks(source, asyncio.get_running_loop(), cancelled)
+    try:
+        return await executors.run_io(write_file_stream, path, source, user_id, user_dir, mode, max_size)
+    except asyncio.CancelledError:
+        cancelled.set()
+        raise
+
+@metrics.timed()
+def rewrite_file_stream(path: str, edit, user_id: int, user_dir: str, max_size: int = MAX_FILE_SIZE) -> int:
+    # правка файла потоком: edit(read) - куски нового содержимого, read() - куски текущего
+    # (read_file_stream, можно вызывать несколько раз). чтение идёт без блокировки записи, поэтому
+    # версия файла запоминается до него и сверяется под exclusive перед os.replace: если файл
+    # успели изменить, правка повторяется по новой версии и ничьи изменения не теряются
+    full_path = os.path.join(user_dir, path)
+    if not is_safe_path(full_path, user_dir):
+        raise ValueError("Обнаружено попытка обхода пути (path traversal)")
+
+    def read():
+        return read_file_stream(path, user_id, user_dir)
+
+    while True:
+        version = _version(full_path)
+        try:
+            return write_file_stream(path, edit(read), user_id, user_dir, max_size=max_size, expected=version)
+        except _Changed:
+            continue
+@metrics.timed()
 def write_file(path: str, content: bytes | str, user_id: int, user_dir: str, mode: str = 'w') -> None:
     # безопасная запись и модификация файла
     # проверка пути
     # проверка размера
-    # атомарно: бд и диск под file_lock
+    # атомарно: бд и диск под exclusive блокировкой пути, все записи в бд одной транзакцией
     # логирование
 
-    full_path = os.path.join(user_dir, path)
-    if not is_safe_path(full_path, user_dir):
-        raise ValueError("Обнаружено попытка обхода пути (path traversal)")
     if isinstance(content, str):
         content = content.encode("utf-8")
-    size = len(content)
-    if size > MAX_FILE_SIZE:
-        raise ValueError(f"Размер файла превышает лимит {MAX_FILE_SIZE // (1024*1024)} MB")
-    open_mode = 'ab' if mode == 'a' else 'wb'
-    with file_lock:
-        file_id = db.get_file_id(path, user_id)
-        if file_id is not None:
-            op_type = "modify"
-            if mode == 'a':
-                size += os.path.getsize(full_path) if os.path.exists(full_path) else 0
-            db.update_file_size(file_id, size)
-        else:
-            op_type = "create"
-            file_id = db.add_file(os.path.basename(path), size, path, user_id)
-        # Запись на диск
-        with open(full_path, open_mode) as f:
-            f.write(content)
-        db.log_operation(op_type, file_id, user_id)
+    if len(content) > MAX_FILE_SIZE:
+        raise _size_error(MAX_FILE_SIZE)
+    write_file_stream(path, content, user_id, user_dir, mode)
 
 async def async_write_file(path: str, content: bytes | str, user_id: int, user_dir: str, mode: str = 'w') -> None:
     # асинхронный write_file
-    loop = asyncio.get_running_loop()
-    await loop.run_in_executor(None, write_file, path, content, user_id, user_dir, mode)
-
-def read_file(path: str, user_id: int, user_dir: str, offset: int = 0, count: int = None) -> bytes | str:
-    # безопасное чтение файла c роверкой пути и доступа через бд и file_lock
-    # offset и count
-    # на возврат bytes или decode to str если текст
+    await executors.run_io(write_file, path, content, user_id, user_dir, mode)
 
+def _open_for_read(path: str, user_id: int, user_dir: str):
+    # под shared блокировкой только проверка доступа через бд и открытие файла.
+    # запись подменяет файл через os.replace, поэтому открытый дескриптор
+    # дочитывает свою версию уже без блокировки.
+    # файл из content_cache - сразу его содержимое (bytes) вместо открытого файла
     full_path = os.path.join(user_dir, path)
     if not is_safe_path(full_path, user_dir):
         raise ValueError("Обнаружено попытка обхода пути")
-    with file_lock:
+    with lock_manager.shared(user_id, path):
         file_id = db.get_file_id(path, user_id)
         if file_id is None:
             raise FileNotFoundError("Файл не найден или нет доступа. Убедитесь в правильном имени (с расширением).")
-        with open(full_path, "rb") as f:
-            f.seek(offset)
-            data = f.read(count) if count else f.read()
+        if content_cache.ENABLED:
+            cached = content_cache.get(full_path, os.stat(full_path))
+            if cached is not None:
+                return cached
+        # без буферизации: куски читаются сразу в итоговые bytes, без промежуточного буфера
+        return open(full_path, "rb", buffering=0)
+
+def _read_small(source) -> bytes | None:
+    # содержимое маленького файла целиком: из кэша или чтением (файл закрывается) с записью в кэш.
+    # None - файл больше порога content_cache, source остаётся открытым
+    if isinstance(source, bytes):
+        return source
+    st = os.fstat(source.fileno())
+    if not content_cache.fits(st.st_size):
+        return None
+    with source:
+        data = source.readall()
+        sig = content_cache.signature(st)
+        # дозапись на месте во время чтения - прочитанное не соответствует подписи, не кэшируем
+        if len(data) == st.st_size and content_cache.signature(os.fstat(source.fileno())) == sig:
+            content_cache.put(source.name, data, sig)
+    return data
+
+def _range(data: bytes, offset: int, count: int | None) -> memoryview:
+    # диапазон закэшированного содержимого без копирования
+    return memoryview(data)[offset:offset + count if count else None]
+
+@metrics.timed()
+def read_file(path: str, user_id: int, user_dir: str, offset: int = 0, count: int = None) -> bytes | memoryview:
+    # безопасное чтение файла c роверкой пути и доступа через бд под shared блокировкой
+    # offset и count
+    # на возврат bytes; диапазон из content_cache - memoryview поверх закэшированных bytes без копирования
+    # (bytes(...) или str(..., "utf-8") - у вызывающего, если нужно)
+
+    source = _open_for_read(path, user_id, user_dir)
+    content = _read_small(source)
+    if content is not None:
+        view = _range(content, offset, count)
+        # целиком - те же bytes из кэша
+        data = content if len(view) == len(content) else view
+        metrics.count(metrics.BYTES_READ, len(data), "cache")
+        return data
+    with source as f:
+        f.seek(offset)
+        data = f.readall() if not count else _read_exact(f, count)
+    metrics.count(metrics.BYTES_READ, len(data), "read")
+    return data
+
+def _read_exact(f, count: int) -> bytes:
+    # небуферизованный read может вернуть меньше запрошенного, дочитываем до count или конца файла
+    data = f.read(count)
+    if len(data) == count or not data:
         return data
+    parts = [data]
+    left = count - len(data)
+    while left:
+        chunk = f.read(left)
+        if not chunk:
+            break
+        parts.append(chunk)
+        left -= len(chunk)
+    return b"".join(parts)
 
-async def async_read_file(path: str, user_id: int, user_dir: str, offset: int = 0, count: int = None) -> bytes | str:
+async def async_read_file(path: str, user_id: int, user_dir: str, offset: int = 0, count: int = None) -> bytes | memoryview:
     # асинхронный read_file
-    loop = asyncio.get_running_loop()
-    return await loop.run_in_executor(None, read_file, path, user_id, user_dir, offset, count)
+    return await executors.run_io(read_file, path, user_id, user_dir, offset, count)
+
+def _iter_file(f, offset: int, count: int | None, chunk_size: int):
+    with f:
+        f.seek(offset)
+        left = count
+        while left is None or left > 0:
+            chunk = f.read(chunk_size if left is None else min(chunk_size, left))
+            if not chunk:
+                break
+            if left is not None:
+                left -= len(chunk)
+            metrics.count(metrics.BYTES_READ, len(chunk), "stream")
+            yield chunk
+
+def _iter_view(view: memoryview, chunk_size: int):
+    # куски закэшированного файла - срезы memoryview, без копирования
+    for start in range(0, len(view), chunk_size):
+        chunk = view[start:start + chunk_size]
+        metrics.count(metrics.BYTES_READ, len(chunk), "cache")
+        yield chunk
+
+@metrics.timed()
+def read_file_stream(path: str, user_id: int, user_dir: str, offset: int = 0, count: int = None,
+                     chunk_size: int = CHUNK_SIZE):
+    # потоковое чтение кусками по chunk_size: в памяти не больше одного куска.
+    # проверки и открытие файла сразу при вызове, данные читаются по мере итерации.
+    # маленький файл (content_cache) читается сразу целиком, куски - memoryview поверх него
+    source = _open_for_read(path, user_id, user_dir)
+    content = _read_small(source)
+    if content is not None:
+        return _iter_view(_range(content, offset, count), chunk_size)
+    return _iter_file(source, offset, count or None, chunk_size)
+
+async def async_read_file_stream(path: str, user_id: int, user_dir: str, offset: int = 0, count: int = None,
+                                 chunk_size: int = CHUNK_SIZE):
+    # асинхронный read_file_stream: async генератор, каждый кусок читается в пуле io
+    chunks = await executors.run_io(read_file_stream, path, user_id, user_dir, offset, count, chunk_size)
+    try:
+        while True:
+            chunk = await executors.run_io(next, chunks, None)
+            if chunk is None:
+                break
+            yield chunk
+    finally:
+        try:
+            chunks.close()
+        except ValueError:
+            pass  # отменены посреди чтения куска: генератор закроет файл сам при сборке мусора
 
+@metrics.timed()
+def read_file_mmap(path: str, user_id: int, user_dir: str, offset: int = 0, count: int = None) -> memoryview:
+    # диапазон файла как memoryview поверх mmap: без копирования в память процесса,
+    # страницы подгружаются по мере обращения. mmap живёт, пока жив memoryview (release() - отпустить сразу)
+    source = _open_for_read(path, user_id, user_dir)
+    content = _read_small(source)
+    if content is not None:
+        # маленький файл - срез закэшированных bytes вместо отображения
+        view = memoryview(b"") if count == 0 else _range(content, offset, count)
+        metrics.count(metrics.BYTES_READ, len(view), "cache")
+        return view
+    with source as f:
+        size = os.fstat(f.fileno()).st_size
+        if offset >= size or count == 0:
+            return memoryview(b"")
+        length = size - offset if not count else min(count, size - offset)
+        # смещение mmap должно быть кратно ALLOCATIONGRANULARITY, лишнее начало отрезаем срезом
+        aligned = offset - offset % mmap.ALLOCATIONGRANULARITY
+        mapped = mmap.mmap(f.fileno(), length + offset - aligned, access=mmap.ACCESS_READ, offset=aligned)
+    metrics.count(metrics.BYTES_READ, length, "mmap")
+    return memoryview(mapped)[offset - aligned:]
 
+@metrics.timed()
 def delete_file(path: str, user_id: int, user_dir: str) -> None:
     full_path = os.path.join(user_dir, path)
     if not is_safe_path(full_path, user_dir):
         raise ValueError("Обнаружено попытка обхода пути")
-    with file_lock:
-        file_id = db.get_file_id(path, user_id)
+    with lock_manager.exclusive(user_id, path), db.transaction() as conn:
+        file_id = db.get_file_id(path, user_id, conn)
         if file_id is None:
             raise FileNotFoundError("Файл не найден или нет доступа")
 
         # Сначала логируем удаление (пока file_id ещё есть)
-        db.log_operation("delete", file_id, user_id)
+        audit_log.record("delete", file_id, user_id, conn)
 
         # Удаляем с диска (если файл уже удалён — просто игнорируем)
         try:
             os.remove(full_path)
         except FileNotFoundError:
             pass  # файл уже отсутствует — ничего страшного
+        content_cache.invalidate(full_path)
 
         # Удаляем запись из Files (Operations.file_id станет NULL автоматически)
-        db.delete_file_record(file_id)
+        db.delete_file_record(file_id, conn)
+    # blob без ссылок удаляется с диска
+    blob_store.collect_garbage()
 
+@metrics.timed()
 def copy_file(src_path: str, dest_path: str, user_id: int, user_dir: str) -> None:
     # те же меры безопасности
     full_src = os.path.join(user_dir, src_path)
     full_dest = os.path.join(user_dir, dest_path)
     if not (is_safe_path(full_src, user_dir) and is_safe_path(full_dest, user_dir)):
         raise ValueError("Обнаружено попытка обхода пути")
-    with file_lock:
-        file_id = db.get_file_id(src_path, user_id)
+    with lock_manager.locked(user_id, shared=[src_path], exclusive=[dest_path]), db.transaction() as conn:
+        file_id = db.get_file_id(src_path, user_id, conn)
         if file_id is None:
             raise FileNotFoundError("Источник не найден")
-        shutil.copy(full_src, full_dest)
-        size = os.path.getsize(full_dest)
-        new_file_id = db.add_file(os.path.basename(dest_path), size, dest_path, user_id)
-        db.log_operation("create", new_file_id, user_id)
+        blob_hash = None
+        if blob_store.ENABLED:
+            # копия - только ссылка на тот же blob и новая запись, данные не копируются
+            blob_hash = db.get_file_blob(file_id, conn)
+            if blob_hash is None:
+                blob_hash = blob_store.ingest(full_src, conn)
+                db.set_file_blob(file_id, blob_hash, conn)
+        # запись (и проверка квоты) до копирования на диск.
+        # путь уникален для владельца: копия поверх существующего файла обновляет его запись
+        new_file_id = _record_write(dest_path, os.path.getsize(full_src), user_id, conn)
+        if blob_hash is not None:
+            blob_store.link_copy(full_src, full_dest)
+            db.set_file_blob(new_file_id, blob_hash, conn)
+        else:
+            # через временный файл: существующий dest может делить inode с другими копиями
+            f, tmp_path = _open_temp(full_dest)
+            f.close()
+            try:
+                fast_copy.copy(full_src, tmp_path)   # reflink / copy_file_range, если ФС умеет
+                os.replace(tmp_path, full_dest)
+            except BaseException:
+                _discard_temp(tmp_path)
+                raise
+            metrics.count(metrics.BYTES_WRITTEN, os.path.getsize(full_dest), "copy")
+        content_cache.invalidate(full_dest)
+    blob_store.collect_garbage()
 
+@metrics.timed()
 def move_file(src_path: str, dest_path: str, user_id: int, user_dir: str) -> None:
     full_src = os.path.join(user_dir, src_path)
     full_dest = os.path.join(user_dir, dest_path)
     if not (is_safe_path(full_src, user_dir) and is_safe_path(full_dest, user_dir)):
         raise ValueError("Обнаружено попытка обхода пути")
-    with file_lock:
-        file_id = db.get_file_id(src_path, user_id)
+    with lock_manager.exclusive(user_id, src_path, dest_path), db.transaction() as conn:
+        file_id = db.get_file_id(src_path, user_id, conn)
         if file_id is None:
             raise FileNotFoundError("Источник не найден")
-        shutil.move(full_src, full_dest)
-        db.update_file_location(file_id, dest_path)   # теперь точно обновляется
-        db.log_operation("modify", file_id, user_id)
+        # файл в месте назначения будет перезаписан - его запись удаляем, путь уникален для владельца
+        replaced_id = db.get_file_id(dest_path, user_id, conn)
+        if replaced_id is not None and replaced_id != file_id:
+            audit_log.record("delete", replaced_id, user_id, conn)
+            db.delete_file_record(replaced_id, conn)
+        fast_copy.move(full_src, full_dest)   # между ФС - копирование через ядро
+        content_cache.invalidate(full_src, full_dest)
+        db.update_file_location(file_id, dest_path, conn)   # теперь точно обновляется
+        audit_log.record("modify", file_id, user_id, conn)
+    blob_store.collect_garbage()
+
+BATCH_OPS = ("write", "copy", "move", "delete")
+
+
+class BatchResult(NamedTuple):
+    op: str
+    path: str  # у copy/move - путь назначения
+    error: str | None  # None - операция выполнена
 
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+class BatchError(ValueError):
+    # пакет с atomic=True отменён целиком, results - итог по каждой операции
+    def __init__(self, message: str, results: list[BatchResult]):
+        super().__init__(message)
+        self.results = results
+
+
+class _BatchItem:
+    __slots__ = ("op", "path", "src", "content", "staged", "size", "digest", "error")
+
+    def __init__(self, operation):
+        fields = operation if isinstance(operation, dict) else {}
+        self.op = fields.get("op")
+        self.path = fields.get("path")
+        self.src = fields.get("from") if self.op in ("copy", "move") else None
+        self.content = fields.get("content") if self.op == "write" else None
+        self.staged = self.size = self.digest = self.error = None
+
+    def validate(self, user_dir: str):
+        if self.op not in BATCH_OPS:
+            raise ValueError(f"Неизвестная операция: {self.op}")
+        if self.op == "write" and self.content is None:
+            raise ValueError("Для write нужно content")
+        for path in (self.path, self.src) if self.op in ("copy", "move") else (self.path,):
+            if not isinstance(path, str):
+                raise ValueError(f"Для {self.op} нужны пути path" + (" и from" if self.op in ("copy", "move") else ""))
+            if not is_safe_path(os.path.join(user_dir, path), user_dir):
+                raise ValueError("Обнаружено попытка обхода пути")
+        # один вид пути для бд, блокировок и состояния пакета
+        self.path = lock_manager.normalize_path(self.path)
+        if self.src is not None:
+            self.src = lock_manager.normalize_path(self.src)
+
+    def stage(self, staging: str):
+        # данные write - во временный файл до взятия блокировки, как в write_file_stream
+        hasher = blob_store.new_hasher() if blob_store.ENABLED else None
+        fd, self.staged = tempfile.mkstemp(dir=staging, suffix=".tmp")
+        size = 0
+        with os.fdopen(fd, "wb") as f:
+            for chunk in _iter_chunks(self.content):
+                size += len(chunk)
+                if size > MAX_FILE_SIZE:
+                    raise _size_error(MAX_FILE_SIZE)
+                f.write(chunk)
+                if hasher is not None:
+                    hasher.update(chunk)
+        self.content = None
+        self.size = size
+        self.digest = hasher.hexdigest() if hasher is not None else None
+
+
+class _Batch:
+    # выполнение пакета в одной транзакции: какие пути существуют с учётом уже выполненных операций,
+    # отложенные записи Files (пишутся пачкой при flush) и журнал отмены изменений на диске
+    def __init__(self, user_id: int, user_dir: str, conn, staging: str, paths: list[str]):
+        self.user_id = user_id
+        self.user_dir = user_dir
+        self.conn = conn
+        self.staging = staging
+        self.ids = db.get_file_ids(paths, user_id, conn)  # путь -> id записи Files
+        self.present = set(self.ids)  # пути с файлом (запись в Files уже есть или отложена)
+        self.pending = {}  # путь -> (размер, хэш blob'а): записан на диск, в Files ещё нет
+        self.deleted = {}  # путь -> id записи к удалению
+        self.operations = []  # для журнала операций
+        self.undo = []  # (функция, аргументы...) в порядке выполнения
+
+    def _full(self, path: str) -> str:
+        return os.path.join(self.user_dir, path)
+
+    def _backup(self, path: str):
+        # заменяемый или удаляемый файл уходит в staging и при отмене возвращается на место
+        full = self._full(path)
+        if os.path.isdir(full):
+            raise ValueError(f"{path} - директория")
+        if os.path.lexists(full):
+            backup = os.path.join(self.staging, f"backup-{len(self.undo)}")
+            os.replace(full, backup)
+            self.undo.append((os.replace, backup, full))
+            content_cache.invalidate(full)
+
+    def _place(self, path: str, staged: str):
+        full = self._full(path)
+        if not os.path.isdir(os.path.dirname(full)):
+            raise FileNotFoundError(f"Директория для {path} не найдена")
+        self._backup(path)
+        os.replace(staged, full)
+        self.undo.append((_discard_temp, full))
+        content_cache.invalidate(full)
+        self.pending[path] = (os.path.getsize(full), None)
+        self.present.add(path)
+
+    def _sync(self, paths, need_ids: bool):
+        # отложенное пишется в бд, если путь ждёт удаления старой записи или нужен id его записи
+        if any(path in self.deleted or (need_ids and path in self.pending) for path in paths):
+            self.flush()
+
+    def apply(self, item: _BatchItem):
+        if item.op in ("copy", "move", "delete"):
+            source = item.src if item.op != "delete" else item.path
+            if source not in self.present:
+                raise FileNotFoundError("Источник не найден" if item.op != "delete" else "Файл не найден или нет доступа")
+        if item.op in ("write", "copy"):
+            self._sync((item.path,), need_ids=False)
+        else:
+            self._sync((item.path, item.src), need_ids=True)
+        if item.op == "write":
+            self._place(item.path, item.staged)
+            self.pending[item.path] = (item.size, item.digest)
+        elif item.op == "copy":
+            fd, tmp_path = tempfile.mkstemp(dir=self.staging, suffix=".tmp")
+            os.close(fd)
+            fast_copy.copy(self._full(item.src), tmp_path)
+            item.size = os.path.getsize(tmp_path)
+            self._place(item.path, tmp_path)
+        elif item.op == "delete":
+            self._backup(item.path)
+            self._forget(item.path)
+        elif item.src != item.path:
+            file_id = self.ids[item.src]
+            if item.path in self.ids:
+                self._forget(item.path)
+                self.flush()  # запись назначения удаляется до переноса: путь уникален для владельца
+            full_dest = self._full(item.path)
+            self._backup(item.path)
+            fast_copy.move(self._full(item.src), full_dest)
+            self.undo.append((fast_copy.move, full_dest, self._full(item.src)))
+            db.update_file_location(file_id, item.path, self.conn)
+            self.operations.append(("modify", file_id))
+            self.ids[item.path] = self.ids.pop(item.src)
+            self.present.discard(item.src)
+            self.present.add(item.path)
+
+    def _forget(self, path: str):
+        file_id = self.ids.pop(path)
+        self.operations.append(("delete", file_id))
+        self.deleted[path] = file_id
+        self.present.discard(path)
+
+    def flush(self, check_quota: bool = False):
+        # отложенные записи Files одним executemany, затем журнал (до удаления записей, на которые он ссылается)
+        if self.pending:
+            paths = list(self.pending)
+            operations = db.record_files([(path, self.pending[path][0]) for path in paths], self.user_id, self.conn)
+            for path, (_, file_id) in zip(paths, operations):
+                self.ids[path] = file_id
+                if blob_store.ENABLED:
+                    size, digest = self.pending[path]
+                    blob_hash = blob_store.ingest(self._full(path), self.conn, digest, size if digest else None)
+                    db.set_file_blob(file_id, blob_hash, self.conn)
+            self.operations.extend(operations)
+            self.pending.clear()
+        if self.operations:
+            audit_log.record_many(self.operations, self.user_id, self.conn)
+            self.operations = []
+        if self.deleted:
+            db.delete_file_records(list(self.deleted.values()), self.conn)
+            self.deleted.clear()
+        if check_quota:
+            _check_quota(self.user_id, self.conn)
+
+    def rollback_disk(self, mark: int = 0):
+        # изменения на диске после отметки mark - в обратном порядке
+        while len(self.undo) > mark:
+            fn, *args = self.undo.pop()
+            try:
+                fn(*args)
+            except OSError:
+                pass
+
+    def reload(self, paths: list[str]):
+        # после ROLLBACK TO: состояние путей неудавшейся операции снова из бд
+        self.pending.clear()
+        self.deleted.clear()
+        self.operations = []
+        for path in paths:
+            self.ids.pop(path, None)
+            self.present.discard(path)
+        self.ids.update(db.get_file_ids(paths, self.user_id, self.conn))
+        self.present.update(path for path in paths if path in self.ids)
+
+
+@metrics.timed()
+def run_batch(operations: list[dict], user_id: int, user_dir: str, atomic: bool = True) -> list[BatchResult]:
+    # пакет файловых операций под одной блокировкой и в одной транзакции (один commit):
+    #   {"op": "write", "path": ..., "content": bytes/str/файлоподобный/итератор кусков}
+    #   {"op": "copy" | "move", "from": ..., "path": ...}
+    #   {"op": "delete", "path": ...}
+    # операции выполняются по порядку и видят результат предыдущих. все пути проверяются заранее,
+    # данные write пишутся во временные файлы до блокировки, записи Files и журнал - пачками.
+    # atomic=True - всё или ничего: при первой ошибке бд откатывается, диск возвращается как был,
+    # исключение BatchError с итогами по операциям. atomic=False - ошибочные операции пропускаются
+    # (каждая откатывается отдельно через SAVEPOINT), остальные выполняются.
+    # возвращает BatchResult по каждой операции в порядке operations
+    items = [_BatchItem(operation) for operation in operations]
+    for item in items:
+        try:
+            item.validate(user_dir)
+        except ValueError as e:
+            item.error = str(e)
+
+    def results(failed: int | None = None, message: str | None = None) -> list[BatchResult]:
+        if failed is None:
+            return [BatchResult(item.op, item.path, item.error) for item in items]
+        return [BatchResult(item.op, item.path, message if i == failed else item.error or "Отменено")
+                for i, item in enumerate(items)]
+
+    invalid = [i for i, item in enumerate(items) if item.error is not None]
+    if atomic and invalid:
+        i = invalid[0]
+        raise BatchError(f"Операция {i + 1}: {items[i].error}", results(i, items[i].error))
+    valid = [item for item in items if item.error is None]
+    if not valid:
+        return results()
+
+    staging = tempfile.mkdtemp(dir=user_dir, prefix=".batch-", suffix=".tmp")
+    try:
+        for i, item in enumerate(items):
+            if item.op == "write" and item.error is None:
+                try:
+                    item.stage(staging)
+                except ValueError as e:
+                    if atomic:
+                        raise BatchError(f"Операция {i + 1} ({item.op} {item.path}): {e}", results(i, str(e))) from None
+                    item.error = str(e)
+        valid = [item for item in items if item.error is None]
+        shared = [item.src for item in valid if item.op == "copy"]
+        exclusive = [path for item in valid for path in (item.path, item.src if item.op == "move" else None) if path]
+        paths = list(dict.fromkeys(path for item in valid for path in (item.path, item.src) if path))
+
+        with lock_manager.locked(user_id, shared=shared, exclusive=exclusive), db.transaction() as conn:
+            batch = _Batch(user_id, user_dir, conn, staging, paths)
+            try:
+                for i, item in enumerate(items):
+                    if item.error is not None:
+                        continue
+                    if atomic:
+                        try:
+                            batch.apply(item)
+                        except (ValueError, OSError) as e:
+                            raise BatchError(f"Операция {i + 1} ({item.op} {item.path}): {e}",
+                                             results(i, str(e))) from None
+                        continue
+                    mark = len(batch.undo)
+                    conn.execute("SAVEPOINT batch_item")
+                    try:
+                        batch.apply(item)
+                        batch.flush(check_quota=True)
+                    except (ValueError, OSError) as e:
+                        conn.execute("ROLLBACK TO batch_item")
+                        batch.rollback_disk(mark)
+                        batch.reload([path for path in (item.path, item.src) if path])
+                        item.error = str(e)
+                    conn.execute("RELEASE batch_item")
+                if atomic:
+                    try:
+                        batch.flush(check_quota=True)
+                    except ValueError as e:
+                        raise BatchError(f"Пакет отменён: {e}", results(len(items), str(e))) from None
+            except BaseException:
+                batch.rollback_disk()
+                raise
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+    for item in items:
+        if item.error is None and item.op in ("write", "copy"):
+            metrics.count(metrics.BYTES_WRITTEN, item.size or 0, item.op)
+    blob_store.collect_garbage()
+    return results()
+
+
+async def async_run_batch(operations: list[dict], user_id: int, user_dir: str, atomic: bool = True) -> list[BatchResult]:
+    # асинхронный run_batch
+    return await executors.run_io(run_batch, operations, user_id, user_dir, atomic)
+
+@metrics.timed()
 def create_directory(subdir: str, user_id: int, user_dir: str) -> None:
     # те же меры безопасности
     full_path = os.path.join(user_dir, subdir)
     if not is_safe_path(full_path, user_dir):
         raise ValueError("Обнаружено попытка обхода пути")
-    with file_lock:
+    with lock_manager.exclusive(user_id, subdir), db.transaction() as conn:
+        db.add_directory(subdir, user_id, conn)
         os.makedirs(full_path, exist_ok=True)
-        db.log_operation("dir_create", None, user_id)
+        audit_log.record("dir_create", None, user_id, conn)
 
+@metrics.timed()
 def delete_directory(subdir: str, user_id: int, user_dir: str, recursive: bool = False) -> None:
     full_path = os.path.join(user_dir, subdir)
     if not is_safe_path(full_path, user_dir):
         raise ValueError("Обнаружено попытка обхода пути")
-    with file_lock:
+    with lock_manager.exclusive(user_id, subdir), db.transaction() as conn:
+        # ← КАСКАДНОЕ УДАЛЕНИЕ ИЗ БД: запись директории, её поддиректории и файлы
+        db.delete_directory_record(subdir, user_id, conn)
         if recursive:
             shutil.rmtree(full_path)   # удаляем всё с диска
-            # ← КАСКАДНОЕ УДАЛЕНИЕ ИЗ БД
-            with db.get_db_connection() as conn:
-                cur = conn.cursor()
-                cur.execute("DELETE FROM Files WHERE location LIKE ? AND owner_id = ?",
-                            (f"{subdir}/%", user_id))
-                cur.execute("DELETE FROM Files WHERE location = ? AND owner_id = ?",
-                            (subdir, user_id))  # на случай если есть запись с точным путём
         else:
             os.rmdir(full_path)
+        content_cache.invalidate_tree(full_path)
 
-        db.log_operation("dir_delete", None, user_id)
+        audit_log.record("dir_delete", None, user_id, conn)
+    blob_store.collect_garbage()
 
 
+@metrics.timed()
 def move_directory(src_subdir: str, dest_subdir: str, user_id: int, user_dir: str) -> None:
     full_src = os.path.join(user_dir, src_subdir)
     full_dest = os.path.join(user_dir, dest_subdir)
@@ -165,31 +804,117 @@ def move_directory(src_subdir: str, dest_subdir: str, user_id: int, user_dir: st
     if not os.path.isdir(full_src):
         raise ValueError("Источник не является директорией")
 
-    with file_lock:
-        shutil.move(full_src, full_dest)
-
-        # Правильное обновление путей в БД
-        with db.get_db_connection() as conn:
-            cur = conn.cursor()
-            # Обновляем все файлы внутри перемещённой директории
-            cur.execute("""
-                UPDATE Files 
-                SET location = REPLACE(location, ?, ?)
-                WHERE location LIKE ? AND owner_id = ?
-            """, (src_subdir + '/', dest_subdir + '/', src_subdir + '/%', user_id))
-            # Обновляем запись самой директории (если она была как файл с путём src_subdir)
-            cur.execute("""
-                UPDATE Files 
-                SET location = ? 
-                WHERE location = ? AND owner_id = ?
-            """, (dest_subdir, src_subdir, user_id))
-
-        db.log_operation("dir_move", None, user_id)
+    # в существующую директорию источник переносится внутрь, как это делает shutil.move
+    if os.path.isdir(full_dest):
+        dest_subdir = os.path.join(dest_subdir, os.path.basename(os.path.normpath(full_src)))
+        full_dest = os.path.join(user_dir, dest_subdir)
 
-def list_directory(subdir: str, user_id: int, user_dir: str) -> list:
-    # те же меры безопасности
+    with lock_manager.exclusive(user_id, src_subdir, dest_subdir), db.transaction() as conn:
+        # пути вложенных файлов в БД не хранятся - меняется только запись директории
+        db.move_directory_record(src_subdir, dest_subdir, user_id, conn)
+
+        fast_copy.move(full_src, full_dest)
+        content_cache.invalidate_tree(full_src)
+        content_cache.invalidate_tree(full_dest)
+        audit_log.record("dir_move", None, user_id, conn)
+
+class DirEntry(NamedTuple):
+    name: str
+    is_dir: bool
+    size: int | None  # у директорий None
+    mtime: float | None  # None - записи в индексе нет на диске
+    file_id: int | None  # None - директория
+
+
+def _stat_entry(full_path: str, name: str, is_dir: bool, size: int | None, file_id: int | None) -> DirEntry:
+    try:
+        mtime = os.stat(os.path.join(full_path, name)).st_mtime
+    except FileNotFoundError:
+        mtime = None
+    return DirEntry(name, is_dir, size, mtime, file_id)
+
+
+def _sort_key(entry: DirEntry, sort: str) -> tuple:
+    # курсор keyset-пагинации в том же виде, что и в db.list_directory_page
+    return (entry.name if sort == "name" else entry.size or 0, entry.name)
+
+
+def _is_staging(name: str) -> bool:
+    # временные файлы и директории самого менеджера (_open_temp, run_batch, extract_zip) - не в индекс
+    return name.startswith(".") and name.endswith(".tmp")
+
+
+_indexed_dirs = set()  # (пользователь, директория), уже сверенные с диском в этом процессе
+
+
+def _index_directory(subdir: str, user_id: int, full_path: str):
+    # один раз за время работы процесса: записи директории на диске вне индекса (созданные до него
+    # или в обход менеджера) добавляются в Directories и Files. дальше страница листинга - только
+    # limit строк индекса. под exclusive на директорию: внутри неё никто не создаёт и не удаляет
+    key = (user_id, lock_manager.normalize_path(subdir))
+    if key in _indexed_dirs:
+        return
+    with lock_manager.exclusive(user_id, subdir):
+        if key in _indexed_dirs:
+            return
+        dirs, files = [], []
+        try:
+            with os.scandir(full_path) as it:
+                for item in it:
+                    if _is_staging(item.name):
+                        continue
+                    if item.is_dir(follow_symlinks=False):
+                        dirs.append(item.name)
+                    elif item.is_file(follow_symlinks=False):
+                        files.append((item.name, item.stat(follow_symlinks=False).st_size))
+        except FileNotFoundError:
+            return  # на диске нет: листинг только по индексу, если директория в нём есть
+        prefix = key[1] + "/" if key[1] else ""
+        with db.transaction() as conn:
+            db.add_directory(subdir, user_id, conn)
+            indexed = db.list_directory_names(subdir, user_id, conn)
+            for name in dirs:
+                if name not in indexed:
+                    db.add_directory(prefix + name, user_id, conn)
+            missing = [(prefix + name, size) for name, size in files if name not in indexed]
+            if missing:
+                db.record_files(missing, user_id, conn)
+        _indexed_dirs.add(key)
+
+
+@metrics.timed()
+def list_directory_page(subdir: str, user_id: int, user_dir: str, after: tuple | None = None,
+                        limit: int = LIST_PAGE_SIZE, sort: str = "name", reverse: bool = False,
+                        pattern: str | None = None) -> tuple[list[DirEntry], tuple | None]:
+    # страница листинга: записи и курсор для следующей страницы (None - это последняя).
+    # sort - "name" или "size", pattern - glob по имени (с учётом регистра)
     full_path = os.path.join(user_dir, subdir)
-    if not is_safe_path(full_path, user_dir):
+    if not is_safe_path(full_path, user_dir, allow_base=True):
         raise ValueError("Обнаружено попытка обхода пути")
-    with file_lock:
-        return os.listdir(full_path)
\ No newline at end of file
+    if sort not in db.LIST_SORTS:
+        raise ValueError(f"Неизвестная сортировка: {sort}")
+    _index_directory(subdir, user_id, full_path)
+    with lock_manager.shared(user_id, subdir):
+        rows = db.list_directory_page(subdir, user_id, limit, after, sort, reverse, pattern)
+        if rows is None:
+            raise FileNotFoundError(f"Директория {subdir} не найдена")
+        # stat только для записей страницы
+        entries = [_stat_entry(full_path, name, bool(is_dir), None if is_dir else size, file_id)
+                   for name, is_dir, size, file_id in rows]
+    cursor = _sort_key(entries[-1], sort) if len(entries) == limit else None
+    return entries, cursor
+
+
+def iter_directory(subdir: str, user_id: int, user_dir: str, sort: str = "name", reverse: bool = False,
+                   pattern: str | None = None, page_size: int = LIST_PAGE_SIZE):
+    # листинг генератором: страница за страницей, блокировка берётся только на время чтения страницы
+    after = None
+    while True:
+        entries, after = list_directory_page(subdir, user_id, user_dir, after, page_size, sort, reverse, pattern)
+        yield from entries
+        if after is None:
+            return
+
+
+def list_directory(subdir: str, user_id: int, user_dir: str) -> list:
+    return [entry.name for entry in iter_directory(subdir, user_id, user_dir)]
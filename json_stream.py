@@ -0,0 +1,570 @@
+import codecs
+import json
+import re
+from json.decoder import scanstring
+from json.scanner import make_scanner
+
+# потоковая обработка JSON без построения всего дерева объектов в памяти.
+# документ - поток событий (тип, значение):
+#   ("start_map", None) ("key", имя) ... ("end_map", None)
+#   ("start_array", None) ... ("end_array", None)
+#   ("value", значение)
+# события читаются из кусков текста/байт (iter_events), фильтруются и правятся генераторами
+# (drop_nulls, apply_patch) и снова превращаются в текст (iter_text) - в памяти только текущий кусок,
+# одно значение и стек вложенности.
+# вложенный объект или массив, целиком попавший в окно чтения, разбирается сразу через C-сканер json
+# и приходит одним событием value со значением dict/list (одна запись большого массива - одно событие).
+# expand разворачивает такие значения в события там, где нужно пройти внутрь
+
+SOURCE_CHUNK = 1024 * 1024  # символов в окне чтения при разборе строки целиком
+TEXT_CHUNK = 64 * 1024  # символов в куске текста на выходе iter_chunks
+
+START = ("start_map", "start_array")
+END = ("end_map", "end_array")
+
+_WS = re.compile(r"[ \t\n\r]*")
+_NUMBER = re.compile(r"-?(?:0|[1-9][0-9]*)(\.[0-9]+)?([eE][-+]?[0-9]+)?")
+_NUMBER_CHARS = re.compile(r"[-+0-9.eE]*")
+# как json.loads: NaN и Infinity тоже принимаются
+_LITERALS = (("true", True), ("false", False), ("null", None), ("NaN", float("nan")),
+             ("Infinity", float("inf")), ("-Infinity", float("-inf")))
+_scan_once = make_scanner(json.JSONDecoder())
+
+# что ожидает разборщик
+_VALUE, _KEY, _COLON, _COMMA, _DONE = range(5)
+
+
+def _error(message: str, position: int) -> ValueError:
+    return ValueError(f"{message} (символ {position})")
+
+
+def _text_chunks(source):
+    # str/bytes целиком или итератор кусков str/bytes (например read_file_stream)
+    if isinstance(source, (str, bytes, bytearray, memoryview)):
+        view = source if isinstance(source, str) else memoryview(source)
+        source = (view[i:i + SOURCE_CHUNK] for i in range(0, len(view), SOURCE_CHUNK))
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    for chunk in source:
+        if isinstance(chunk, str):
+            yield chunk
+        else:
+            text = decoder.decode(chunk)
+            if text:
+                yield text
+    tail = decoder.decode(b"", final=True)
+    if tail:
+        yield tail
+
+
+class _Buffer:
+    # окно текста: прочитанное отбрасывается при подгрузке следующего куска
+    def __init__(self, source):
+        self.chunks = _text_chunks(source)
+        self.buf = ""
+        self.pos = 0
+        self.offset = 0  # позиция начала buf в документе
+        self.eof = False
+
+    def more(self) -> bool:
+        # подгрузить кусок; pos остаётся на том же символе документа
+        for chunk in self.chunks:
+            self.offset += self.pos
+            self.buf = self.buf[self.pos:] + chunk
+            self.pos = 0
+            return True
+        self.eof = True
+        return False
+
+    def peek(self) -> str:
+        # следующий значимый символ (пробелы пропускаются), "" - конец документа
+        while True:
+            self.pos = _WS.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.more():
+                return ""
+
+    def error(self, message: str) -> ValueError:
+        return _error(message, self.offset + self.pos)
+
+    def string(self) -> str:
+        # pos на открывающей кавычке; строка должна целиком поместиться в окно
+        search = 1  # от pos: где искать закрывающую кавычку
+        while True:
+            if self.buf.find('"', self.pos + search) != -1:
+                try:
+                    value, end = scanstring(self.buf, self.pos + 1, True)
+                    self.pos = end
+                    return value
+                except json.JSONDecodeError as e:
+                    # кавычка оказалась экранированной или кусок разрезал escape-последовательность
+                    incomplete = e.msg.startswith("Unterminated") or e.pos >= len(self.buf) - 6
+                    if self.eof or not incomplete:
+                        raise _error(f"Неверная строка: {e.msg}", self.offset + e.pos)
+            search = max(1, len(self.buf) - self.pos - 6)
+            if not self.more():
+                raise self.error("Незакрытая строка")
+
+    def number(self) -> int | float:
+        # число целиком в окне: кусок мог разрезать его после "2" в "2.5"
+        while _NUMBER_CHARS.match(self.buf, self.pos).end() == len(self.buf) and self.more():
+            pass
+        if self.buf.startswith("-I", self.pos):
+            return self.literal()
+        match = _NUMBER.match(self.buf, self.pos)
+        if match is None or match.end() != _NUMBER_CHARS.match(self.buf, self.pos).end():
+            raise self.error("Неверное число")
+        self.pos = match.end()
+        if match.group(1) or match.group(2):
+            return float(match.group())
+        return int(match.group())
+
+    def literal(self):
+        while len(self.buf) - self.pos < 9 and self.more():
+            pass
+        for text, value in _LITERALS:
+            if self.buf.startswith(text, self.pos):
+                self.pos += len(text)
+                return value
+        raise self.error("Неожиданный символ")
+
+
+def iter_events(source):
+    # события документа из str/bytes или итератора кусков; ошибка формата - ValueError
+    reader = _Buffer(source)
+    stack = []  # "{" / "[" открытых контейнеров
+    state = _VALUE
+    after_comma = False  # закрывающая скобка сразу после запятой недопустима
+    while True:
+        c = reader.peek()
+        if not c:
+            break
+        if state == _DONE:
+            raise reader.error("Лишние данные после JSON")
+        if state == _COMMA:
+            closing = "}" if stack[-1] == "{" else "]"
+            if c == ",":
+                reader.pos += 1
+                state = _KEY if stack[-1] == "{" else _VALUE
+                after_comma = True
+            elif c == closing:
+                reader.pos += 1
+                stack.pop()
+                yield ("end_map" if closing == "}" else "end_array"), None
+                state = _COMMA if stack else _DONE
+            else:
+                raise reader.error(f"Ожидалась , или {closing}")
+            continue
+        if state == _KEY:
+            if c == "}" and not after_comma:
+                reader.pos += 1
+                stack.pop()
+                yield "end_map", None
+                state = _COMMA if stack else _DONE
+            elif c == '"':
+                yield "key", reader.string()
+                state = _COLON
+            else:
+                raise reader.error("Ожидалось имя свойства в кавычках")
+            continue
+        if state == _COLON:
+            if c != ":":
+                raise reader.error("Ожидалось :")
+            reader.pos += 1
+            state = _VALUE
+            continue
+        # _VALUE
+        if c in "{[" and stack:
+            # вложенный контейнер целиком в окне - одним значением; не уместился - по событиям
+            try:
+                value, reader.pos = _scan_once(reader.buf, reader.pos)
+            except (json.JSONDecodeError, StopIteration):
+                pass
+            else:
+                yield "value", value
+                state = _COMMA
+                continue
+        if c == "{":
+            reader.pos += 1
+            stack.append("{")
+            yield "start_map", None
+            state, after_comma = _KEY, False
+            continue
+        if c == "[":
+            reader.pos += 1
+            stack.append("[")
+            yield "start_array", None
+            state, after_comma = _VALUE, False
+            continue
+        if c == "]" and stack and stack[-1] == "[" and not after_comma:
+            reader.pos += 1
+            stack.pop()
+            yield "end_array", None
+            state = _COMMA if stack else _DONE
+            continue
+        if c == '"':
+            value = reader.string()
+        elif c == "-" or c.isdigit():
+            value = reader.number()
+        elif c in "tfnNI":
+            value = reader.literal()
+        else:
+            raise reader.error("Ожидалось значение")
+        yield "value", value
+        state = _COMMA if stack else _DONE
+    if state != _DONE:
+        raise reader.error("Неожиданный конец JSON")
+
+
+def value_events(value):
+    # события готового значения Python
+    if isinstance(value, dict):
+        yield "start_map", None
+        for key, item in value.items():
+            yield "key", str(key)
+            yield from value_events(item)
+        yield "end_map", None
+    elif isinstance(value, (list, tuple)):
+        yield "start_array", None
+        for item in value:
+            yield from value_events(item)
+        yield "end_array", None
+    else:
+        yield "value", value
+
+
+def build(event: str, value, events):
+    # значение Python из первого события и продолжения потока; читает ровно до конца значения
+    if event == "value":
+        return value
+    root = {} if event == "start_map" else []
+    stack = [root]
+    key = None
+    for event, value in events:
+        if event == "key":
+            key = value
+            continue
+        if event in END:
+            stack.pop()
+            if not stack:
+                return root
+            continue
+        item = value if event == "value" else ({} if event == "start_map" else [])
+        parent = stack[-1]
+        if isinstance(parent, list):
+            parent.append(item)
+        else:
+            parent[key] = item
+        if event != "value":
+            stack.append(item)
+    raise ValueError("Неожиданный конец JSON")
+
+
+def annotate(events):
+    # (путь, событие, значение): путь - кортеж ключей и индексов до значения,
+    # у key - путь свойства, у end_* - путь самого контейнера
+    path = []
+    arrays = []
+    for event, value in events:
+        if event == "key":
+            path[-1] = value
+            yield tuple(path), event, value
+        elif event in END:
+            path.pop()
+            arrays.pop()
+            yield tuple(path), event, value
+        else:
+            if arrays and arrays[-1]:
+                path[-1] += 1
+            yield tuple(path), event, value
+            if event == "start_map":
+                path.append(None)
+                arrays.append(False)
+            elif event == "start_array":
+                path.append(-1)
+                arrays.append(True)
+
+
+def _plain(annotated):
+    for _, event, value in annotated:
+        yield event, value
+
+
+def _skip(event: str, annotated):
+    # пропустить значение, начатое событием event
+    if event not in START:
+        return
+    depth = 1
+    for _, event, _ in annotated:
+        if event in START:
+            depth += 1
+        elif event in END:
+            depth -= 1
+            if not depth:
+                return
+
+
+def parse_pointer(pointer: str) -> tuple[str, ...]:
+    # JSON Pointer (RFC 6901): "" - весь документ, "/a/0/b~1c" -> ("a", "0", "b/c")
+    if pointer == "":
+        return ()
+    if not pointer.startswith("/"):
+        raise ValueError(f"Путь JSON должен начинаться с /: {pointer}")
+    return tuple(token.replace("~1", "/").replace("~0", "~") for token in pointer[1:].split("/"))
+
+
+def _pointer(tokens: tuple) -> str:
+    return "".join("/" + token.replace("~", "~0").replace("/", "~1") for token in tokens) or "/"
+
+
+def _matches(path: tuple, tokens: tuple) -> bool:
+    # индексы массивов в пути - int, в указателе - строки
+    if len(path) != len(tokens):
+        return False
+    for part, token in zip(path, tokens):
+        if part != token and (type(part) is not int or str(part) != token):
+            return False
+    return True
+
+
+def iter_items(events, pointer: str = ""):
+    # записи контейнера по указателю: элементы массива или пары (ключ, значение) объекта,
+    # в памяти только текущая запись
+    tokens = parse_pointer(pointer)
+    depth = len(tokens)
+    found = False
+    annotated = annotate(expand(events, [tokens]))
+    for path, event, value in annotated:
+        if len(path) == depth and event in START and _matches(path, tokens):
+            found = True
+        elif found and len(path) == depth + 1 and event != "key":
+            item = build(event, value, _plain(annotated))
+            yield item if type(path[-1]) is int else (path[-1], item)
+        elif found and len(path) == depth and event in END:
+            return
+    if not found:
+        raise ValueError(f"Массив или объект не найден: {pointer or '/'}")
+
+
+def without_nulls(value):
+    # значение без свойств null на любой глубине (null в массивах сохраняются - индексы не сдвигаются)
+    if isinstance(value, dict):
+        return {k: without_nulls(v) for k, v in value.items() if v is not None}
+    if isinstance(value, list):
+        return [without_nulls(v) for v in value]
+    return value
+
+
+def drop_nulls(events):
+    # поток без свойств со значением null, как without_nulls
+    pending_key = None
+    for event, value in events:
+        if event == "key":
+            pending_key = value
+            continue
+        if event == "value" and isinstance(value, (dict, list)):
+            value = without_nulls(value)
+        if pending_key is not None:
+            if event == "value" and value is None:
+                pending_key = None
+                continue
+            yield "key", pending_key
+            pending_key = None
+        yield event, value
+
+
+def iter_text(events, indent: int | None = None):
+    # текст документа кусками, как json.dumps(..., indent=indent, ensure_ascii=False)
+    counts = []  # число записанных элементов каждого открытого контейнера
+    item_separator = "," if indent is not None else ", "
+    step = " " * indent if indent is not None else ""
+    dumps = json.JSONEncoder(ensure_ascii=False).encode
+    dumps_indented = json.JSONEncoder(ensure_ascii=False, indent=indent).encode
+    after_key = False
+    for event, value in events:
+        if event in END:
+            written = counts.pop()
+            close = "}" if event == "end_map" else "]"
+            yield close if not written or indent is None else "\n" + step * len(counts) + close
+            continue
+        if counts and not after_key:
+            # новый элемент контейнера: свойство объекта (key) или элемент массива
+            prefix = item_separator if counts[-1] else ""
+            if indent is not None:
+                prefix += "\n" + step * len(counts)
+            counts[-1] += 1
+        else:
+            prefix = ""
+        after_key = False
+        if event == "key":
+            yield prefix + dumps(value) + ": "
+            after_key = True
+        elif event == "value":
+            if indent is not None and isinstance(value, (dict, list)) and value:
+                text = dumps_indented(value).replace("\n", "\n" + step * len(counts))
+            else:
+                text = dumps(value)
+            yield prefix + text
+        else:
+            yield prefix + ("{" if event == "start_map" else "[")
+            counts.append(0)
+
+
+def iter_lines(pieces):
+    # строки текста из кусков (перевод строки внутри строк JSON всегда экранирован)
+    tail = ""
+    for piece in pieces:
+        if "\n" not in piece:
+            tail += piece
+            continue
+        lines = (tail + piece).split("\n")
+        tail = lines.pop()
+        yield from lines
+    yield tail
+
+
+def iter_chunks(pieces, size: int = TEXT_CHUNK):
+    # куски UTF-8 для записи: мелкие куски текста склеиваются до size символов
+    parts = []
+    length = 0
+    for piece in pieces:
+        parts.append(piece)
+        length += len(piece)
+        if length >= size:
+            yield "".join(parts).encode("utf-8")
+            parts, length = [], 0
+    if parts:
+        yield "".join(parts).encode("utf-8")
+
+
+def expand(events, pointers: list[tuple]):
+    # значения dict/list, внутри которых (или на месте которых) лежат пути pointers, - в события
+    pointers = [tokens for tokens in pointers if tokens]
+    if not pointers:
+        yield from events
+        return
+    for path, event, value in annotate(events):
+        if event == "value" and isinstance(value, (dict, list)) and any(
+                len(path) <= len(tokens) and _matches(path, tokens[:len(path)]) for tokens in pointers):
+            yield from value_events(value)
+        else:
+            yield event, value
+
+
+def _drain(events):
+    for _ in events:
+        pass
+
+
+def _patch_op(events, op: str, tokens: tuple, value=None):
+    # одна операция JSON Patch над потоком: add / remove / replace / test
+    events = expand(events, [tokens])
+    if not tokens:
+        if op == "remove":
+            raise ValueError("Нельзя удалить весь документ")
+        if op == "test":
+            first = next(iter(events), None)
+            actual = build(first[0], first[1], events) if first else None
+            if actual != value:
+                raise ValueError("Проверка test не прошла: /")
+            yield from value_events(actual)
+            return
+        yield from value_events(value)
+        _drain(events)  # исходный документ дочитывается: предыдущие операции проверяют его до конца
+        return
+    parent, last = tokens[:-1], tokens[-1]
+    depth = len(tokens)
+    done = False
+    length = 0  # элементов в массиве-родителе (для add в конец по индексу)
+    annotated = annotate(events)
+    for path, event, item in annotated:
+        if done:
+            yield event, item
+            continue
+        if op == "add" and len(path) == depth and type(path[-1]) is int and event not in END \
+                and _matches(path[:-1], parent):
+            length = path[-1] + 1
+        if len(path) == depth and _matches(path, tokens) and event not in END \
+                and (event == "key" or type(path[-1]) is int):
+            # существующее значение по пути (для свойства объекта - его key)
+            if event == "key":
+                if op != "remove":
+                    yield event, item
+                _, event, item = next(annotated)
+            if op == "test":
+                actual = build(event, item, _plain(annotated))
+                if actual != value:
+                    raise ValueError(f"Проверка test не прошла: {_pointer(tokens)}")
+                yield from value_events(actual)
+            elif op == "add" and type(path[-1]) is int:
+                # вставка в массив перед существующим элементом
+                yield from value_events(value)
+                yield event, item
+            else:
+                _skip(event, annotated)
+                if op != "remove":
+                    yield from value_events(value)
+            done = True
+            continue
+        elif op == "add" and len(path) == depth - 1 and event in END and _matches(path, parent):
+            # конец родителя: новое свойство объекта или элемент в конец массива
+            if event == "end_map":
+                yield "key", last
+            elif last != "-" and not (last.isdigit() and int(last) == length):
+                raise ValueError(f"Индекс за пределами массива: {_pointer(tokens)}")
+            yield from value_events(value)
+            done = True
+        yield event, item
+    if not done:
+        raise ValueError(f"Путь не найден: {_pointer(parent if op == 'add' else tokens)}")
+
+
+PATCH_OPS = ("add", "remove", "replace", "move", "copy", "test")
+
+
+def apply_patch(source, operations: list[dict]):
+    # события документа после операций JSON Patch (RFC 6902), за один проход по source().
+    # source() - новый поток событий исходного документа при каждом вызове: move и copy
+    # сначала отдельным проходом достают значение по from, остальные операции - фильтры потока
+    events = source()
+    for index, operation in enumerate(operations):
+        op = operation.get("op")
+        if op not in PATCH_OPS:
+            raise ValueError(f"Неизвестная операция JSON Patch: {op}")
+        if "path" not in operation:
+            raise ValueError(f"В операции {op} нет path")
+        tokens = parse_pointer(operation["path"])
+        if op in ("move", "copy"):
+            if "from" not in operation:
+                raise ValueError(f"В операции {op} нет from")
+            origin = parse_pointer(operation["from"])
+            if op == "move" and tokens[:len(origin)] == origin and tokens != origin:
+                raise ValueError("Нельзя переместить значение внутрь самого себя")
+            value = _value_at(apply_patch(source, operations[:index]), origin, operation["from"])
+            if op == "move":
+                if tokens == origin:
+                    continue
+                events = _patch_op(events, "remove", origin)
+            events = _patch_op(events, "add", tokens, value)
+        elif op == "remove":
+            events = _patch_op(events, op, tokens)
+        else:
+            if "value" not in operation:
+                raise ValueError(f"В операции {op} нет value")
+            events = _patch_op(events, op, tokens, operation["value"])
+    return events
+
+
+def _value_at(events, tokens: tuple, pointer: str):
+    if not tokens:
+        first = next(events)
+        return build(first[0], first[1], events)
+    annotated = annotate(expand(events, [tokens]))
+    for path, event, value in annotated:
+        if len(path) == len(tokens) and event not in END and _matches(path, tokens):
+            if event == "key":
+                _, event, value = next(annotated)
+            elif type(path[-1]) is not int:
+                continue
+            return build(event, value, _plain(annotated))
+    raise ValueError(f"Путь не найден: {pointer}")
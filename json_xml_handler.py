@@ -1,82 +1,214 @@
 import json
-from xml.dom import minidom
+import os
+import itertools
 import xml.etree.ElementTree as ET
 
 try:
-    from defusedxml.ElementTree import parse, tostring, fromstring
+    from defusedxml import DefusedXmlException
+    from defusedxml.ElementTree import parse, fromstring
 except ImportError:
-    from xml.etree.ElementTree import parse, tostring, fromstring
+    DefusedXmlException = ET.ParseError
+    from xml.etree.ElementTree import parse, fromstring
 
-from file_manager import write_file, read_file
+import metrics
+import json_stream
+import xml_stream
+from file_manager import read_file, write_file_stream, rewrite_file_stream, read_file_stream, is_safe_path
 
+# документы от этого размера обрабатываются потоково (json_stream): без дерева объектов в памяти.
+# меньшие - целиком через json, это быстрее
+JSON_STREAM_THRESHOLD = 1024 * 1024
+JSON_PAGE_LINES = 100  # строк на страницу read_json_page
+# предел размера записываемого документа: форматирование с отступами и правки раздувают исходный,
+# поэтому он больше file_manager.MAX_FILE_SIZE для обычных файлов
+MAX_DOCUMENT_SIZE = 64 * 1024 * 1024
 
+
+def _events(source):
+    # события документа; ошибки разбора - с тем же префиксом, что и у json.loads выше
+    try:
+        yield from json_stream.iter_events(source)
+    except ValueError as e:
+        raise ValueError(f"Неверный JSON: {e}") from None
+
+
+def _file_size(path: str, user_dir: str) -> int:
+    # только для выбора способа чтения, права и существование проверяет read_file
+    full_path = os.path.join(user_dir, path)
+    try:
+        return os.path.getsize(full_path) if is_safe_path(full_path, user_dir) else 0
+    except OSError:
+        return 0
+
+
+@metrics.timed()
 def write_json(path: str, json_str: str, user_id: int, user_dir: str, ignore_null: bool = False, write_indented: bool = True) -> None:
+    indent = 2 if write_indented else None
+    if len(json_str) >= JSON_STREAM_THRESHOLD:
+        events = _events(json_str)
+        if ignore_null:
+            events = json_stream.drop_nulls(events)
+        write_file_stream(path, json_stream.iter_chunks(json_stream.iter_text(events, indent)), user_id, user_dir,
+                          max_size=MAX_DOCUMENT_SIZE)
+        return
+
     try:
         data = json.loads(json_str)
         if ignore_null:
-            data = {k: v for k, v in data.items() if v is not None}
+            data = json_stream.without_nulls(data)
     except json.JSONDecodeError as e:
         raise ValueError(f"Неверный JSON: {e}")
 
-    indent = 2 if write_indented else None
     content = json.dumps(data, indent=indent, ensure_ascii=False).encode("utf-8")
-    write_file(path, content, user_id, user_dir)
+    write_file_stream(path, content, user_id, user_dir, max_size=MAX_DOCUMENT_SIZE)
 
 
+@metrics.timed()
 def read_json(path: str, user_id: int, user_dir: str) -> str:
+    if _file_size(path, user_dir) >= JSON_STREAM_THRESHOLD:
+        return "\n".join(iter_json_lines(path, user_id, user_dir))
     content_bytes = read_file(path, user_id, user_dir)
     content = content_bytes.decode("utf-8")
     data = json.loads(content)
     return json.dumps(data, indent=2, ensure_ascii=False)
 
 
-def write_xml(path: str, xml_str: str, user_id: int, user_dir: str) -> None:
+def iter_json_lines(path: str, user_id: int, user_dir: str):
+    # строки форматированного документа по мере чтения файла
+    events = _events(read_file_stream(path, user_id, user_dir))
+    return json_stream.iter_lines(json_stream.iter_text(events, 2))
+
+
+@metrics.timed()
+def read_json_page(path: str, user_id: int, user_dir: str, start: int = 0,
+                   count: int = JSON_PAGE_LINES) -> tuple[list[str], int | None]:
+    # страница форматированного документа: строки [start, start + count) и начало следующей
+    # страницы (None - последняя). файл читается только до конца страницы
+    lines = iter_json_lines(path, user_id, user_dir)
     try:
-        # защита от XXE с помощью defusedxml
-        root = fromstring(xml_str.encode("utf-8"))
-    except Exception as e:
-        raise ValueError(f"Неверный или небезопасный XML: {e}")
+        page = list(itertools.islice(lines, start, start + count + 1))
+    finally:
+        lines.close()
+    if len(page) > count:
+        return page[:count], start + count
+    return page, None
+
+
+def iter_json_items(path: str, user_id: int, user_dir: str, pointer: str = ""):
+    # записи массива (или пары ключ-значение объекта) по JSON Pointer, по одной в памяти
+    return json_stream.iter_items(_events(read_file_stream(path, user_id, user_dir)), pointer)
+
+
+@metrics.timed()
+def patch_json(path: str, operations: list[dict], user_id: int, user_dir: str, write_indented: bool = True) -> None:
+    # JSON Patch (RFC 6902): старый документ потоком проходит через операции во временный файл,
+    # который атомарно заменяет исходный. при любой ошибке файл не меняется, при замене файла
+    # во время правки она повторяется по новой версии (rewrite_file_stream)
+    indent = 2 if write_indented else None
+
+    def edit(read):
+        events = json_stream.apply_patch(lambda: _events(read()), operations)
+        return json_stream.iter_chunks(json_stream.iter_text(events, indent))
+
+    rewrite_file_stream(path, edit, user_id, user_dir, MAX_DOCUMENT_SIZE)
+
+
+def update_json(path: str, updates: dict[str, object], user_id: int, user_dir: str, write_indented: bool = True) -> None:
+    # запись значений по путям: {"/a/b": 1} - свойство создаётся или заменяется
+    operations = [{"op": "add", "path": pointer, "value": value} for pointer, value in updates.items()]
+    patch_json(path, operations, user_id, user_dir, write_indented)
+
+
+def _xml_events(source):
+    # события документа (xml_stream): защита от XXE и ошибки разбора - одним ValueError
+    try:
+        yield from xml_stream.iter_events(source)
+    except (ET.ParseError, DefusedXmlException) as e:
+        raise ValueError(f"Неверный или небезопасный XML: {e}") from None
 
-    rough = tostring(root, encoding="unicode")
-    reparsed = minidom.parseString(rough)
-    pretty = reparsed.toprettyxml(indent="  ").encode("utf-8")
-    write_file(path, pretty, user_id, user_dir)
 
+def _xml_chunks(events):
+    return json_stream.iter_chunks(xml_stream.iter_text(events))
 
+
+def _write_xml_events(path: str, events, user_id: int, user_dir: str) -> None:
+    # форматирование потоком во временный файл, который атомарно заменяет исходный
+    write_file_stream(path, _xml_chunks(events), user_id, user_dir, max_size=MAX_DOCUMENT_SIZE)
+
+
+def _rewrite_xml(path: str, edit, user_id: int, user_dir: str) -> None:
+    # правка документа: edit(source) - события нового документа, source() - события текущего.
+    # файл, заменённый во время правки, правится заново (rewrite_file_stream)
+    def chunks(read):
+        return _xml_chunks(edit(lambda: _xml_events(read())))
+
+    rewrite_file_stream(path, chunks, user_id, user_dir, MAX_DOCUMENT_SIZE)
+
+
+@metrics.timed()
+def write_xml(path: str, xml_str: str, user_id: int, user_dir: str) -> None:
+    # разбор один раз (defusedxml iterparse), форматирование и запись - потоком без дерева в памяти
+    _write_xml_events(path, _xml_events(xml_str), user_id, user_dir)
+
+
+@metrics.timed()
 def read_xml(path: str, user_id: int, user_dir: str) -> str:
-    content_bytes = read_file(path, user_id, user_dir)
-    content = content_bytes.decode("utf-8")
-    root = fromstring(content)
-    rough = tostring(root, encoding="unicode")
-    reparsed = minidom.parseString(rough)
-    return reparsed.toprettyxml(indent="  ")
+    return "".join(xml_stream.iter_text(_xml_events(read_file_stream(path, user_id, user_dir))))
 
 
-def edit_xml_add_element(path: str, xpath: str, new_element_name: str, new_value: str, user_id: int, user_dir: str) -> None:
-    content_bytes = read_file(path, user_id, user_dir)
-    content = content_bytes.decode("utf-8")
+def iter_xml_lines(path: str, user_id: int, user_dir: str):
+    # строки форматированного документа по мере чтения файла
+    events = _xml_events(read_file_stream(path, user_id, user_dir))
+    return json_stream.iter_lines(xml_stream.iter_text(events))
 
-    # безопасный парсинг с защитой от XXE
-    root = fromstring(content)
 
-    # обработка XPath
-    if xpath.strip() in (".", "", "/"):
-        parent = root
-    else:
+@metrics.timed()
+def read_xml_page(path: str, user_id: int, user_dir: str, start: int = 0,
+                  count: int = JSON_PAGE_LINES) -> tuple[list[str], int | None]:
+    # как read_json_page: строки [start, start + count) и начало следующей страницы
+    lines = iter_xml_lines(path, user_id, user_dir)
+    try:
+        page = list(itertools.islice(lines, start, start + count + 1))
+    finally:
+        lines.close()
+    if len(page) > count:
+        return page[:count], start + count
+    return page, None
+
+
+@metrics.timed()
+def edit_xml_add_element(path: str, xpath: str, new_element_name: str, new_value: str, user_id: int, user_dir: str) -> None:
+    # new_element_name последним потомком элемента root.find(xpath), а если его нет - root.find(".//" + xpath)
+    new_elem = xml_stream.new_element(new_element_name, new_value)
+
+    try:
+        # потоковая правка; xml_stream выбирает тот же элемент, что и find, или отказывается (Unsupported)
+        try:
+            _rewrite_xml(path, lambda source: xml_stream.append_element(source(), xpath, new_elem), user_id, user_dir)
+        except xml_stream.NotFound:
+            _rewrite_xml(path, lambda source: xml_stream.append_element(source(), xpath, new_elem, descendant=True),
+                         user_id, user_dir)
+    except xml_stream.NotFound:
+        raise ValueError(f"Не найден элемент по XPath: {xpath}") from None
+    except xml_stream.Unsupported:
+        rewrite_file_stream(path, lambda read: _xml_chunks(_append_in_memory(read, xpath, new_elem)),
+                            user_id, user_dir, MAX_DOCUMENT_SIZE)
+
+
+def _append_in_memory(read, xpath: str, new_elem: ET.Element):
+    # XPath вне потокового подмножества (.., функции, [tag]...): документ целиком, как раньше
+    try:
+        root = fromstring(b"".join(read()))
+    except (ET.ParseError, DefusedXmlException) as e:
+        raise ValueError(f"Неверный или небезопасный XML: {e}")
+    try:
         parent = root.find(xpath)
         if parent is None:
             parent = root.find(f".//{xpath}")
-        if parent is None:
-            raise ValueError(f"Не найден элемент по XPath: {xpath}")
-
-    # новый элемент
-    new_elem = ET.Element(new_element_name)
-    new_elem.text = new_value
+    except Exception:
+        # ElementPath на некорректном выражении бросает что придётся: SyntaxError, KeyError, TypeError
+        raise ValueError(f"Неверный XPath: {xpath}") from None
+    if parent is None:
+        raise ValueError(f"Не найден элемент по XPath: {xpath}")
     parent.append(new_elem)
-
-    rough = tostring(root, encoding="unicode")
-    reparsed = minidom.parseString(rough)
-    pretty_xml = reparsed.toprettyxml(indent="  ").encode("utf-8")
-
-    write_file(path, pretty_xml, user_id, user_dir)
-    print("Элемент добавлен в XML!")
\ No newline at end of file
+    return xml_stream.element_events(root)
@@ -1,4 +1,262 @@
-from threading import Lock
+import errno
+import os
+import posixpath
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+import metrics
+import meta_cache
 
-# глобальная блокировка для атомарного доступа к файлам и бд. защита от race conditions
-file_lock = Lock()
\ No newline at end of file
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+# блокировки файлов и директорий пользователей. защита от race conditions
+# ключ блокировки - (пользователь, нормализованный путь), ключи раскладываются по полосам (striping),
+# чтобы не хранить отдельный объект на каждый путь
+
+STRIPES = 64  # число полос, больше - меньше ложных конфликтов между разными путями
+LOCK_FILE = ".locks"  # файл межпроцессных блокировок в корне хранилища, байт N - полоса N
+
+SHARED = "shared"
+EXCLUSIVE = "exclusive"
+
+
+class RWLock:
+    # блокировка читатели/писатель: много читателей или один писатель.
+    # ждущий писатель не пропускает новых читателей, чтобы поток чтений не морил запись голодом
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+
+    def acquire_shared(self):
+        with self._cond:
+            while self._writer or self._waiting_writers:
+                self._cond.wait()
+            self._readers += 1
+
+    def release_shared(self):
+        with self._cond:
+            self._readers -= 1
+            if self._readers == 0:
+                self._cond.notify_all()
+
+    def acquire_exclusive(self):
+        with self._cond:
+            self._waiting_writers += 1
+            try:
+                while self._writer or self._readers:
+                    self._cond.wait()
+            finally:
+                self._waiting_writers -= 1
+            self._writer = True
+
+    def release_exclusive(self):
+        with self._cond:
+            self._writer = False
+            self._cond.notify_all()
+
+
+def normalize_path(path: str) -> str:
+    # единый вид пути для ключа: прямые слэши, без "." / ".." и крайних разделителей, корень - ""
+    path = posixpath.normpath(path.replace("\\", "/")) if path else ""
+    return "" if path == "." else path.strip("/")
+
+
+def _ancestors(path: str) -> list[str]:
+    # все родительские директории пути, начиная с корня пользователя ""
+    result = [""]
+    parts = path.split("/")[:-1] if path else []
+    for i in range(len(parts)):
+        result.append("/".join(parts[:i + 1]))
+    return result
+
+
+class LockManager:
+    # иерархические блокировки: операция над путём берёт shared на все его родительские директории
+    # и свою блокировку на сам путь. Поэтому exclusive на директорию (удаление/перемещение)
+    # ждёт все операции внутри неё и блокирует новые.
+    # Полосы захватываются строго по возрастанию номера - порядок общий для всех операций,
+    # поэтому операции с двумя путями (copy/move) не могут взаимно заблокироваться
+    def __init__(self, stripes: int = STRIPES):
+        self._locks = [RWLock() for _ in range(stripes)]
+
+    def _stripe(self, user_id: int, path: str) -> int:
+        # crc32 а не hash(): номер полосы должен совпадать во всех процессах
+        return zlib.crc32(f"{user_id}:{path}".encode("utf-8")) % len(self._locks)
+
+    def _plan(self, user_id: int, shared, exclusive) -> list[tuple[int, str]]:
+        # полоса -> режим; если на одну полосу попали shared и exclusive, берём exclusive один раз
+        modes = {}
+        for paths, mode in ((shared, SHARED), (exclusive, EXCLUSIVE)):
+            for path in paths:
+                path = normalize_path(path)
+                for parent in _ancestors(path):
+                    modes.setdefault(self._stripe(user_id, parent), SHARED)
+                stripe = self._stripe(user_id, path)
+                if mode == EXCLUSIVE:
+                    modes[stripe] = EXCLUSIVE
+                else:
+                    modes.setdefault(stripe, SHARED)
+        return sorted(modes.items())
+
+    def _acquire(self, stripe: int, mode: str):
+        if mode == EXCLUSIVE:
+            self._locks[stripe].acquire_exclusive()
+        else:
+            self._locks[stripe].acquire_shared()
+
+    def _release(self, stripe: int, mode: str):
+        if mode == EXCLUSIVE:
+            self._locks[stripe].release_exclusive()
+        else:
+            self._locks[stripe].release_shared()
+
+    @contextmanager
+    def locked(self, user_id: int, shared=(), exclusive=()):
+        acquired = []
+        # метрики: ожидание - до захвата всех полос, удержание - от захвата до освобождения
+        timing = metrics.ENABLED
+        held = None
+        if timing:
+            mode = EXCLUSIVE if exclusive else SHARED
+            start = time.perf_counter()
+        try:
+            for stripe, stripe_mode in self._plan(user_id, shared, exclusive):
+                self._acquire(stripe, stripe_mode)
+                acquired.append((stripe, stripe_mode))
+            if timing:
+                held = time.perf_counter()
+                metrics.observe(metrics.LOCK_WAIT, mode, held - start)
+            yield
+        finally:
+            for stripe, stripe_mode in reversed(acquired):
+                self._release(stripe, stripe_mode)
+            if held is not None:
+                metrics.observe(metrics.LOCK_HOLD, mode, time.perf_counter() - held)
+
+
+class ProcessLockManager(LockManager):
+    # межпроцессные блокировки для нескольких рабочих процессов над одним хранилищем.
+    # полоса N - байт N файла блокировок (fcntl byte-range). Блокировки fcntl принадлежат процессу,
+    # а не потоку, поэтому сначала берётся внутрипроцессная полоса, а блокировку на байт держит
+    # только первый вошедший поток и снимает последний вышедший
+    def __init__(self, base_dir: str, stripes: int = STRIPES):
+        super().__init__(stripes)
+        self._path = os.path.join(base_dir, LOCK_FILE)
+        self._pid = None
+        self._fd = None
+        self._reset_lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        # после fork блокировки родителя не наследуются: начинаем с чистого состояния и своего fd
+        self._locks = [RWLock() for _ in self._locks]
+        self._holders = [0] * len(self._locks)
+        self._stripe_mutex = [threading.Lock() for _ in self._locks]
+        self._seek_lock = threading.Lock()
+        if self._fd is not None:
+            os.close(self._fd)
+        os.makedirs(os.path.dirname(self._path) or ".", exist_ok=True)
+        self._fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o600)
+        self._pid = os.getpid()
+
+    def _os_lock(self, stripe: int, mode: str):
+        if fcntl is not None:
+            while True:
+                try:
+                    fcntl.lockf(self._fd, fcntl.LOCK_EX if mode == EXCLUSIVE else fcntl.LOCK_SH, 1, stripe)
+                    return
+                except OSError as e:
+                    # для ядра все потоки процесса - один владелец, поэтому детектор взаимоблокировок
+                    # может сработать ложно при упорядоченном захвате; просто повторяем
+                    if e.errno != errno.EDEADLK:
+                        raise
+                time.sleep(0.001)
+        # в Windows нет разделяемых байтовых блокировок, shared берётся как exclusive
+        while True:
+            with self._seek_lock:
+                os.lseek(self._fd, stripe, os.SEEK_SET)
+                try:
+                    msvcrt.locking(self._fd, msvcrt.LK_NBLCK, 1)
+                    return
+                except OSError:
+                    pass
+            time.sleep(0.005)
+
+    def _os_unlock(self, stripe: int):
+        if fcntl is not None:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, stripe)
+            return
+        with self._seek_lock:
+            os.lseek(self._fd, stripe, os.SEEK_SET)
+            msvcrt.locking(self._fd, msvcrt.LK_UNLCK, 1)
+
+    def _acquire(self, stripe: int, mode: str):
+        super()._acquire(stripe, mode)
+        try:
+            with self._stripe_mutex[stripe]:
+                if self._holders[stripe] == 0:
+                    self._os_lock(stripe, mode)
+                self._holders[stripe] += 1
+        except BaseException:
+            super()._release(stripe, mode)
+            raise
+
+    def _release(self, stripe: int, mode: str):
+        try:
+            with self._stripe_mutex[stripe]:
+                self._holders[stripe] -= 1
+                if self._holders[stripe] == 0:
+                    self._os_unlock(stripe)
+        finally:
+            super()._release(stripe, mode)
+
+    @contextmanager
+    def locked(self, user_id: int, shared=(), exclusive=()):
+        if self._pid != os.getpid():
+            with self._reset_lock:
+                if self._pid != os.getpid():
+                    self._reset()
+        with super().locked(user_id, shared=shared, exclusive=exclusive):
+            yield
+
+
+_manager = LockManager()
+
+
+def configure(backend: str = "thread", base_dir: str | None = None, stripes: int = STRIPES):
+    # выбор реализации: "thread" - только потоки одного процесса,
+    # "process" - несколько процессов над общим base_dir (файл блокировок в base_dir)
+    global _manager
+    if backend == "thread":
+        _manager = LockManager(stripes)
+    elif backend == "process":
+        if base_dir is None:
+            raise ValueError("Для межпроцессных блокировок нужен base_dir")
+        _manager = ProcessLockManager(base_dir, stripes)
+    else:
+        raise ValueError(f"Неизвестный тип блокировок: {backend}")
+    # с другими процессами кэш метаданных сверяется с бд (см. meta_cache)
+    meta_cache.SHARED = backend == "process"
+    meta_cache.clear()
+
+
+def locked(user_id: int, shared=(), exclusive=()):
+    # блокировка нескольких путей пользователя разом: shared - чтение, exclusive - запись
+    return _manager.locked(user_id, shared=shared, exclusive=exclusive)
+
+
+def shared(user_id: int, *paths: str):
+    # блокировка на чтение (read_file, list_directory)
+    return _manager.locked(user_id, shared=paths)
+
+
+def exclusive(user_id: int, *paths: str):
+    # блокировка на запись (write/delete/move, операции над директориями)
+    return _manager.locked(user_id, exclusive=paths)
@@ -3,24 +3,65 @@ import shutil
 import psutil
 import asyncio
 import db
-import auth
-from file_manager import (
-    write_file, read_file, delete_file, copy_file, move_file,
-    create_directory, delete_directory, move_directory, list_directory, async_write_file, async_read_file
+import lock_manager
+import executors
+import audit_log
+import blob_store
+import metrics
+import meta_cache
+import content_cache
+from async_api import (
+    async_register_user, async_login_session, async_logout,
+    async_write_file, async_read_file, async_delete_file, async_copy_file, async_move_file,
+    async_create_directory, async_delete_directory, async_move_directory, async_list_directory_page,
+    async_write_json, async_read_json_page, async_write_xml, async_read_xml_page, async_edit_xml_add_element,
+    async_create_archive, async_extract_zip, async_get_user_files_page, async_get_usage
 )
-from json_xml_handler import write_json, read_json, write_xml, read_xml, edit_xml_add_element
-from zip_manager import create_archive, extract_zip
 
 BASE_DIR = "./storage"
+# хранение одинаковых файлов один раз (blob_store); существующее хранилище переводится
+# командой python blob_store.py
+CONTENT_ADDRESSED = False
+# журнал операций: sync - в транзакции самой операции (без отдельного commit),
+# group - общий commit журнала для одновременных операций, async - в фоне без ожидания
+AUDIT_MODE = "sync"
+AUDIT_RETENTION_DAYS = 365  # старые записи журнала переносятся в архив
+AUDIT_ARCHIVE = "operations-archive.db"
+# метрики операций, блокировок и бд (пункт меню 18); METRICS_FILE - файл в формате Prometheus
+METRICS = False
+METRICS_FILE = None
+# кэш путь -> id файла в памяти процесса (meta_cache): записей не больше META_CACHE_SIZE,
+# запись живёт не дольше META_CACHE_TTL секунд. изменения других процессов сбрасывают кэш сразу
+META_CACHE_SIZE = 100_000
+META_CACHE_TTL = 30.0
+# содержимое файлов до CONTENT_CACHE_FILE_SIZE байт держится в памяти (content_cache),
+# всего не больше CONTENT_CACHE_SIZE байт
+CONTENT_CACHE_SIZE = 64 * 1024 * 1024
+CONTENT_CACHE_FILE_SIZE = 256 * 1024
+PAGE_SIZE = 50  # строк на экран в списках файлов и директорий
+def _format_size(size: int) -> str:
+    if size < 1024:
+        return f"{size} байт"
+    if size < 1024 * 1024:
+        return f"{size / 1024:.2f} КБ"
+    return f"{size / (1024 * 1024):.2f} МБ"
 
 async def main():
     os.makedirs(BASE_DIR, exist_ok=True)
+    # межпроцессные блокировки: несколько экземпляров могут работать с одним хранилищем
+    lock_manager.configure("process", BASE_DIR)
     db.init_db()
+    blob_store.configure(BASE_DIR, enabled=CONTENT_ADDRESSED)
+    audit_log.configure(AUDIT_MODE, AUDIT_RETENTION_DAYS, AUDIT_ARCHIVE)
+    metrics.configure(METRICS, METRICS_FILE)
+    meta_cache.configure(True, META_CACHE_SIZE, META_CACHE_TTL)
+    content_cache.configure(True, CONTENT_CACHE_SIZE, CONTENT_CACHE_FILE_SIZE)
 
     logged_in = False
     current_user_id = None
     user_dir = None
     current_username = None
+    session_token = None
 
     while True:
         if not logged_in:
@@ -34,7 +75,7 @@ async def main():
                 username = input("Логин (мин. 3 символа): ").strip()
                 password = input("Пароль (мин. 6 символов): ").strip()
                 try:
-                    auth.register_user(username, password)
+                    await async_register_user(username, password)
                     print("Пользователь успешно зарегистрирован.")
                 except ValueError as e:
                     print(f"Ошибка: {e}")
@@ -43,7 +84,7 @@ async def main():
                 username = input("Логин: ").strip()
                 password = input("Пароль: ").strip()
                 try:
-                    user_id = auth.login_user(username, password)
+                    user_id, session_token = await async_login_session(username, password)
                     current_user_id = user_id
                     current_username = username
                     user_dir = os.path.join(BASE_DIR, username)
@@ -77,6 +118,7 @@ async def main():
         print("15. Переместить файл")
         print("16. Добавить элемент в XML")
         print("17. Выход")
+        print("18. Метрики производительности")
         choice = input("\nВыберите действие: ").strip()
 
         if choice == "1":
@@ -95,8 +137,7 @@ async def main():
             count = int(input("Count (all): ").strip() or 0) or None
             try:
                 content = await async_read_file(path, current_user_id, user_dir, offset, count)
-                if isinstance(content, bytes):
-                    content = content.decode("utf-8", errors="replace")
+                content = str(content, "utf-8", errors="replace")
                 print(f"\n📄 {path}:\n{content}\n")
             except Exception as e:
                 print(f"Ошибка: {e}")
@@ -104,7 +145,7 @@ async def main():
         elif choice == "3":
             path = input("Путь к файлу: ").strip()
             try:
-                delete_file(path, current_user_id, user_dir)
+                await async_delete_file(path, current_user_id, user_dir)
                 print("Файл успешно удалён и залогирован.")
             except Exception as e:
                 print(f"Ошибка: {e}")
@@ -117,9 +158,9 @@ async def main():
                 if data_type == "j":
                     ignore_null = input("Ignore null (y/n): ").strip().lower() == 'y'
                     write_indented = input("Indented (y/n): ").strip().lower() != 'n'
-                    write_json(path, data_input, current_user_id, user_dir, ignore_null, write_indented)
+                    await async_write_json(path, data_input, current_user_id, user_dir, ignore_null, write_indented)
                 elif data_type == "x":
-                    write_xml(path, data_input, current_user_id, user_dir)
+                    await async_write_xml(path, data_input, current_user_id, user_dir)
                 else:
                     raise ValueError("Используйте j или x")
                 print("JSON или XML записан.")
@@ -130,13 +171,18 @@ async def main():
             data_type = input("Тип (j - JSON, x - XML): ").strip().lower()
             path = input("Путь к файлу: ").strip()
             try:
-                if data_type == "j":
-                    pretty = read_json(path, current_user_id, user_dir)
-                elif data_type == "x":
-                    pretty = read_xml(path, current_user_id, user_dir)
-                else:
+                if data_type not in ("j", "x"):
                     raise ValueError("Используйте j или x")
-                print(f"\n{path}:\n{pretty}\n")
+                # постранично: большой документ не читается и не разбирается целиком
+                read_page = async_read_json_page if data_type == "j" else async_read_xml_page
+                lines, start = await read_page(path, current_user_id, user_dir, 0, PAGE_SIZE)
+                print(f"\n{path}:")
+                while True:
+                    print("\n".join(lines))
+                    if start is None or input("Enter - дальше, q - хватит: ").strip().lower() == "q":
+                        break
+                    lines, start = await read_page(path, current_user_id, user_dir, start, PAGE_SIZE)
+                print()
             except Exception as e:
                 print(f"Ошибка: {e}")
 
@@ -145,41 +191,43 @@ async def main():
             paths = [p.strip() for p in paths_str.split(',')]
             zip_path = input("Имя архива (по умолчанию archive.zip): ").strip() or "archive.zip"
             try:
-                create_archive(paths, zip_path, current_user_id, user_dir)
-                print("Архив создан.")
+                stats = await async_create_archive(paths, zip_path, current_user_id, user_dir)
+                print(f"Архив создан: файлов {stats['files']}, "
+                      f"{stats['bytes_in'] / (1024 * 1024):.2f} МБ -> {stats['bytes_out'] / (1024 * 1024):.2f} МБ, "
+                      f"{stats['mb_per_s']:.1f} МБ/с")
             except Exception as e:
                 print(f"Ошибка: {e}")
 
         elif choice == "7":
             zip_path = input("Путь к архиву: ").strip()
             try:
-                extract_zip(zip_path, current_user_id, user_dir)
+                await async_extract_zip(zip_path, current_user_id, user_dir)
                 print("ZIP разархивирован.")
             except Exception as e:
                 print(f"Ошибка: {e}")
 
         elif choice == "8":
-            files = db.get_user_files(current_user_id)
+            # постранично: в памяти только текущая страница
+            files, after = await async_get_user_files_page(current_user_id, PAGE_SIZE)
             if not files:
                 print("У вас нет файлов")
             else:
                 print("Ваши файлы:")
                 print("-" * 50)
-                for fn, sz, created, loc in files:
-                    print(f"{loc:<30} {sz:>12,} байт | {created}")
+                while True:
+                    for fn, sz, created, loc in files:
+                        print(f"{loc:<30} {sz:>12,} байт | {created}")
+                    if after is None or input("Enter - дальше, q - хватит: ").strip().lower() == "q":
+                        break
+                    files, after = await async_get_user_files_page(current_user_id, PAGE_SIZE, after)
             input("\nНажмите Enter для продолжения...")
 
         elif choice == "9":
-            # инфо о дисках
-            files = db.get_user_files(current_user_id)
-            total_bytes = sum(sz for _, sz, _, _ in files)
-            if total_bytes < 1024:
-                user_size = f"{total_bytes} байт"
-            elif total_bytes < 1024 * 1024:
-                user_size = f"{total_bytes / 1024:.2f} КБ"
-            else:
-                user_size = f"{total_bytes / (1024 * 1024):.2f} МБ"
-            print(f"Размер ваших файлов: {user_size}")
+            # инфо о дисках; занятое место - готовый счётчик, без перебора файлов
+            total_bytes, file_count, quota = await async_get_usage(current_user_id)
+            print(f"Размер ваших файлов: {_format_size(total_bytes)} ({file_count} файлов)")
+            if quota is not None:
+                print(f"Квота: {_format_size(quota)}, свободно {_format_size(max(quota - total_bytes, 0))}")
             print("Диски:")
             for part in psutil.disk_partitions():
                 try:
@@ -192,7 +240,7 @@ async def main():
         elif choice == "10":
             subdir = input("Путь к директории: ").strip()
             try:
-                create_directory(subdir, current_user_id, user_dir)
+                await async_create_directory(subdir, current_user_id, user_dir)
                 print("Директория создана.")
             except Exception as e:
                 print(f"Ошибка: {e}")
@@ -201,7 +249,7 @@ async def main():
             subdir = input("Путь к директории: ").strip()
             recursive = input("Рекурсивно (y/n): ").strip().lower() == 'y'
             try:
-                delete_directory(subdir, current_user_id, user_dir, recursive)
+                await async_delete_directory(subdir, current_user_id, user_dir, recursive)
                 print("Директория удалена.")
             except Exception as e:
                 print(f"Ошибка: {e}")
@@ -210,16 +258,29 @@ async def main():
             src = input("Источник директории: ").strip()
             dest = input("Цель: ").strip()
             try:
-                move_directory(src, dest, current_user_id, user_dir)
+                await async_move_directory(src, dest, current_user_id, user_dir)
                 print("Директория перемещена.")
             except Exception as e:
                 print(f"Ошибка: {e}")
 
         elif choice == "13":
             subdir = input("Путь к директории (пусто для root): ").strip()
+            pattern = input("Фильтр, например *.txt (пусто - все): ").strip() or None
+            sort = "size" if input("Сортировка по размеру (y/n): ").strip().lower() == "y" else "name"
             try:
-                contents = list_directory(subdir, current_user_id, user_dir)
-                print(f"Содержимое {subdir or '/'}:\n{', '.join(contents)}")
+                entries, after = await async_list_directory_page(subdir, current_user_id, user_dir,
+                                                                 limit=PAGE_SIZE, sort=sort, pattern=pattern)
+                print(f"Содержимое {subdir or '/'}:")
+                while True:
+                    for entry in entries:
+                        if entry.is_dir:
+                            print(f"  [DIR] {entry.name}")
+                        else:
+                            print(f"        {entry.name:<30} {entry.size:>12,} байт")
+                    if after is None or input("Enter - дальше, q - хватит: ").strip().lower() == "q":
+                        break
+                    entries, after = await async_list_directory_page(subdir, current_user_id, user_dir, after,
+                                                                     PAGE_SIZE, sort, pattern=pattern)
             except Exception as e:
                 print(f"Ошибка: {e}")
 
@@ -227,7 +288,7 @@ async def main():
             src = input("Источник файла: ").strip()
             dest = input("Цель: ").strip()
             try:
-                copy_file(src, dest, current_user_id, user_dir)
+                await async_copy_file(src, dest, current_user_id, user_dir)
                 print("Файл скопирован.")
             except Exception as e:
                 print(f"Ошибка: {e}")
@@ -236,7 +297,7 @@ async def main():
             src = input("Источник файла: ").strip()
             dest = input("Цель: ").strip()
             try:
-                move_file(src, dest, current_user_id, user_dir)
+                await async_move_file(src, dest, current_user_id, user_dir)
                 print("Файл перемещён.")
             except Exception as e:
                 print(f"Ошибка: {e}")
@@ -247,20 +308,37 @@ async def main():
             elem_name = input("Имя нового элемента: ").strip()
             value = input("Значение: ").strip()
             try:
-                edit_xml_add_element(path, xpath, elem_name, value, current_user_id, user_dir)
+                await async_edit_xml_add_element(path, xpath, elem_name, value, current_user_id, user_dir)
                 print("Элемент добавлен в XML.")
             except Exception as e:
                 print(f"Ошибка: {e}")
 
         elif choice == "17":
             print("Выход из аккаунта")
+            if session_token is not None:
+                await async_logout(session_token)
+                session_token = None
             logged_in = False
             current_user_id = None
             user_dir = None
             current_username = None
 
+        elif choice == "18":
+            print(metrics.dump_text())
+            cache = meta_cache.stats()
+            print(f"Кэш метаданных: {cache['entries']} записей, попаданий {cache['hits']}, "
+                  f"промахов {cache['misses']} ({cache['hit_ratio']:.1%})")
+            cache = content_cache.stats()
+            print(f"Кэш содержимого: {cache['entries']} файлов, {_format_size(cache['bytes'])}, "
+                  f"попаданий {cache['hits']}, промахов {cache['misses']} ({cache['hit_ratio']:.1%})")
+
         else:
             print("Неверный выбор")
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    try:
+        asyncio.run(main())
+    finally:
+        executors.shutdown()
+        audit_log.shutdown()   # остаток очереди журнала - до закрытия соединений
+        db.close_db_connections()
\ No newline at end of file
@@ -0,0 +1,123 @@
+import threading
+import time
+from collections import OrderedDict
+
+# кэш метаданных файлов в памяти процесса: (владелец, путь) -> (id записи Files, размер).
+# db.get_file_id вне транзакции при попадании не читает таблицы; изменяющие операции кэш не используют.
+# ограничен по числу записей (LRU) и по времени жизни (TTL).
+# SHARED (межпроцессные блокировки, lock_manager.configure("process")): перед чтением из кэша
+# db сверяет PRAGMA data_version и сбрасывает кэш после commit'ов других процессов.
+# сбрасывают записи helper'ы db, меняющие Files. заполнение из SELECT, начатого до сброса,
+# отбрасывается: у каждой записи версия (полоса ключа + общая эпоха), put проверяет, что она не менялась
+
+ENABLED = True
+MAX_ENTRIES = 100_000
+TTL = 30.0  # секунд, None - без ограничения (один процесс на хранилище)
+STRIPES = 256  # полос версий ключей
+SHARED = False  # хранилище общее с другими процессами
+
+_lock = threading.Lock()
+_entries = OrderedDict()  # ключ -> (id файла, размер, момент устаревания); порядок - от давно не использованных
+_by_id = {}  # id файла -> ключ: сброс по id без пути (update_file_size, delete_file_record)
+_versions = [0] * STRIPES
+_epoch = 0  # растёт при сбросах, ключи которых неизвестны: по id не из кэша, по директории
+_stats = {"hits": 0, "misses": 0, "fills": 0, "rejected": 0, "invalidations": 0, "evictions": 0, "expired": 0}
+
+
+def configure(enabled: bool = True, max_entries: int = MAX_ENTRIES, ttl: float | None = TTL):
+    global ENABLED, MAX_ENTRIES, TTL
+    ENABLED = enabled
+    MAX_ENTRIES = max_entries
+    TTL = ttl
+    clear()
+
+
+def clear():
+    global _epoch
+    with _lock:
+        _entries.clear()
+        _by_id.clear()
+        _epoch += 1
+
+
+def version(key: tuple) -> tuple[int, int]:
+    # снимается до SELECT и передаётся в put
+    return _epoch, _versions[hash(key) % STRIPES]
+
+
+def get(key: tuple) -> tuple[int, int] | None:
+    # (id файла, размер) или None при промахе
+    with _lock:
+        entry = _entries.get(key)
+        if entry is None:
+            _stats["misses"] += 1
+            return None
+        if entry[2] is not None and entry[2] <= time.monotonic():
+            _drop(key)
+            _stats["expired"] += 1
+            _stats["misses"] += 1
+            return None
+        _entries.move_to_end(key)
+        _stats["hits"] += 1
+        return entry[0], entry[1]
+
+
+def put(key: tuple, file_id: int, size: int, seen: tuple[int, int]):
+    with _lock:
+        if version(key) != seen:
+            # пока шёл запрос, запись сбросили: прочитанное могло устареть
+            _stats["rejected"] += 1
+            return
+        if key in _entries:
+            _drop(key)
+        _entries[key] = (file_id, size, time.monotonic() + TTL if TTL is not None else None)
+        _by_id[file_id] = key
+        _stats["fills"] += 1
+        while len(_entries) > MAX_ENTRIES:
+            _drop(next(iter(_entries)))
+            _stats["evictions"] += 1
+
+
+def _drop(key: tuple):
+    file_id = _entries.pop(key)[0]
+    if _by_id.get(file_id) == key:
+        del _by_id[file_id]
+
+
+def invalidate(keys=(), file_ids=(), owner_id: int | None = None, prefix: str | None = None):
+    # сброс записей: по ключам, по id файлов, по директории владельца (prefix - путь директории)
+    global _epoch
+    with _lock:
+        for key in keys:
+            _versions[hash(key) % STRIPES] += 1
+            if key in _entries:
+                _drop(key)
+            _stats["invalidations"] += 1
+        for file_id in file_ids:
+            key = _by_id.get(file_id)
+            if key is None:
+                _epoch += 1  # путь неизвестен - не должно закэшироваться ничего прочитанного раньше
+                continue
+            _versions[hash(key) % STRIPES] += 1
+            _drop(key)
+            _stats["invalidations"] += 1
+        if owner_id is not None:
+            _epoch += 1
+            start = prefix + "/" if prefix else ""
+            for key in [k for k in _entries if k[0] == owner_id and k[1].startswith(start)]:
+                _drop(key)
+                _stats["invalidations"] += 1
+
+
+def stats() -> dict:
+    with _lock:
+        result = dict(_stats, entries=len(_entries))
+    lookups = result["hits"] + result["misses"]
+    result["hit_ratio"] = round(result["hits"] / lookups, 4) if lookups else 0.0
+    return result
+
+
+def reset_stats():
+    with _lock:
+        for name in _stats:
+            _stats[name] = 0
@@ -0,0 +1,276 @@
+import atexit
+import bisect
+import functools
+import inspect
+import json
+import os
+import tempfile
+import threading
+import time
+
+# метрики горячих путей в памяти процесса: время операций, ожидание и удержание блокировок,
+# запросы к бд, байты чтения/записи. выключены по умолчанию: инструментированный код проверяет
+# один флаг ENABLED и не вызывает ни perf_counter, ни блокировок реестра
+
+ENABLED = False
+# границы корзин гистограмм, секунды (как у клиентов Prometheus, с шагом вниз до 50 мкс)
+BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+           0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PROMETHEUS_PATH = None  # файл в текстовом формате Prometheus (для textfile collector), None - не писать
+PROMETHEUS_INTERVAL = 15.0  # секунд между перезаписями файла
+
+# семейства метрик
+OPERATION = "sfm_operation_seconds"  # публичные операции, метка name
+OPERATION_ERRORS = "sfm_operation_errors_total"
+DB_QUERY = "sfm_db_query_seconds"  # helper'ы db, метка name
+DB_COMMIT = "sfm_db_commit_seconds"
+LOCK_WAIT = "sfm_lock_wait_seconds"  # метка mode: shared/exclusive
+LOCK_HOLD = "sfm_lock_hold_seconds"
+BYTES_READ = "sfm_bytes_read_total"  # метка kind: read/stream/mmap/cache, write/append/copy
+BYTES_WRITTEN = "sfm_bytes_written_total"
+
+_HELP = {
+    OPERATION: "Время публичных операций файлового менеджера",
+    OPERATION_ERRORS: "Операции, завершившиеся исключением",
+    DB_QUERY: "Время helper'ов db (запросы к SQLite)",
+    DB_COMMIT: "Время commit транзакций",
+    LOCK_WAIT: "Ожидание блокировок lock_manager",
+    LOCK_HOLD: "Удержание блокировок lock_manager",
+    BYTES_READ: "Прочитано байт из файлов пользователей",
+    BYTES_WRITTEN: "Записано байт в файлы пользователей",
+}
+
+# имя метки в формате Prometheus, по умолчанию name
+_LABEL_NAMES = {LOCK_WAIT: "mode", LOCK_HOLD: "mode", BYTES_READ: "kind", BYTES_WRITTEN: "kind"}
+
+_lock = threading.Lock()
+_counters = {}  # (семейство, метка) -> число
+_histograms = {}  # (семейство, метка) -> Histogram
+_exporter = None
+
+
+class Histogram:
+    # накопительная гистограмма: число и сумма наблюдений, счётчики по корзинам BUCKETS, максимум
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)  # последняя - больше всех границ
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+        self.buckets[bisect.bisect_left(BUCKETS, value)] += 1
+
+    def quantile(self, q: float) -> float:
+        # оценка сверху: граница корзины, в которую попал q-й квантиль (для последней - максимум)
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank and n:
+                return min(BUCKETS[i], self.max) if i < len(BUCKETS) else self.max
+        return self.max
+
+
+def configure(enabled: bool = True, prometheus_path: str | None = None,
+              prometheus_interval: float = PROMETHEUS_INTERVAL):
+    # включение сбора; prometheus_path - периодически перезаписываемый файл в формате Prometheus
+    global ENABLED, PROMETHEUS_PATH, PROMETHEUS_INTERVAL, _exporter
+    ENABLED = enabled
+    PROMETHEUS_PATH = prometheus_path
+    PROMETHEUS_INTERVAL = prometheus_interval
+    if enabled and prometheus_path and (_exporter is None or not _exporter.is_alive()):
+        _exporter = threading.Thread(target=_export_loop, name="sfm-metrics", daemon=True)
+        _exporter.start()
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+
+def count(family: str, value: int = 1, label: str = ""):
+    if not ENABLED:
+        return
+    key = (family, label)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(family: str, label: str, seconds: float):
+    if not ENABLED:
+        return
+    key = (family, label)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = Histogram()
+        histogram.observe(seconds)
+
+
+class _Timer:
+    __slots__ = ("family", "label", "start")
+
+    def __init__(self, family: str, label: str):
+        self.family = family
+        self.label = label
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        observe(self.family, self.label, time.perf_counter() - self.start)
+        if exc_type is not None and self.family == OPERATION:
+            count(OPERATION_ERRORS, 1, self.label)
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return None
+
+
+_NULL_TIMER = _NullTimer()
+
+
+def timer(family: str, label: str = ""):
+    # with metrics.timer(...): время блока в гистограмму; выключено - общий пустой контекст
+    return _Timer(family, label) if ENABLED else _NULL_TIMER
+
+
+def timed(family: str = OPERATION):
+    # декоратор: время вызова функции (и async функции) в гистограмму family с меткой "модуль.функция"
+    def decorator(fn):
+        label = f"{fn.__module__}.{fn.__name__}"
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                if not ENABLED:
+                    return await fn(*args, **kwargs)
+                with _Timer(family, label):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return fn(*args, **kwargs)
+            with _Timer(family, label):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def snapshot() -> dict:
+    # копия реестра: {"counters": {семейство: {метка: n}}, "histograms": {семейство: {метка: {...}}}}
+    with _lock:
+        counters = dict(_counters)
+        histograms = {key: (h.count, h.sum, h.max, h.quantile(0.5), h.quantile(0.99), list(h.buckets))
+                      for key, h in _histograms.items()}
+    result = {"counters": {}, "histograms": {}}
+    for (family, label), value in sorted(counters.items()):
+        result["counters"].setdefault(family, {})[label] = value
+    for (family, label), (n, total, peak, p50, p99, buckets) in sorted(histograms.items()):
+        result["histograms"].setdefault(family, {})[label] = {
+            "count": n, "sum": total, "max": peak, "p50": p50, "p99": p99, "buckets": buckets,
+        }
+    return result
+
+
+def dump_json() -> str:
+    return json.dumps(snapshot(), ensure_ascii=False, indent=2)
+
+
+def dump_text() -> str:
+    # таблица для человека: по гистограммам число, среднее, p50/p99 и максимум в миллисекундах
+    data = snapshot()
+    lines = []
+    for family, series in data["histograms"].items():
+        lines.append(family)
+        for label, h in series.items():
+            mean = h["sum"] / h["count"] * 1000 if h["count"] else 0.0
+            lines.append(f"  {label or '-':<40}{h['count']:>9}  avg {mean:9.3f}  p50 {h['p50'] * 1000:9.3f}"
+                         f"  p99 {h['p99'] * 1000:9.3f}  max {h['max'] * 1000:9.3f} мс")
+    for family, series in data["counters"].items():
+        lines.append(family)
+        for label, value in series.items():
+            lines.append(f"  {label or '-':<40}{value:>12,}")
+    return "\n".join(lines) if lines else "Метрик нет (сбор выключен или операций не было)"
+
+
+def _labels(family: str, label: str, extra: str = "") -> str:
+    if not label and not extra:
+        return ""
+    key = _LABEL_NAMES.get(family, "name")
+    parts = [f'{key}="{label}"'] if label else []
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}"
+
+
+def dump_prometheus() -> str:
+    # текстовый формат экспозиции Prometheus 0.0.4
+    data = snapshot()
+    lines = []
+    for family, series in data["counters"].items():
+        lines.append(f"# HELP {family} {_HELP.get(family, family)}")
+        lines.append(f"# TYPE {family} counter")
+        for label, value in series.items():
+            lines.append(f"{family}{_labels(family, label)} {value}")
+    for family, series in data["histograms"].items():
+        lines.append(f"# HELP {family} {_HELP.get(family, family)}")
+        lines.append(f"# TYPE {family} histogram")
+        for label, h in series.items():
+            cumulative = 0
+            for bound, n in zip(BUCKETS + (float("inf"),), h["buckets"]):
+                cumulative += n
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                bucket_labels = _labels(family, label, 'le="%s"' % le)
+                lines.append(f"{family}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{family}_sum{_labels(family, label)} {h['sum']}")
+            lines.append(f"{family}_count{_labels(family, label)} {h['count']}")
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus(path: str | None = None):
+    # атомарная перезапись файла: сборщик не увидит наполовину записанный файл
+    path = path or PROMETHEUS_PATH
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(dump_prometheus())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def _export_loop():
+    while ENABLED and PROMETHEUS_PATH:
+        try:
+            write_prometheus()
+        except OSError:
+            pass  # недоступный файл метрик не должен мешать работе
+        time.sleep(PROMETHEUS_INTERVAL)
+
+
+def _export_at_exit():
+    if ENABLED and PROMETHEUS_PATH:
+        try:
+            write_prometheus()
+        except OSError:
+            pass
+
+
+atexit.register(_export_at_exit)
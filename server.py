@@ -0,0 +1,745 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import traceback
+from typing import NamedTuple
+from urllib.parse import parse_qs, unquote, urlsplit
+
+import db
+import lock_manager
+import executors
+import audit_log
+import blob_store
+import metrics
+import meta_cache
+import content_cache
+import file_manager
+import json_xml_handler
+import async_api
+from main import (BASE_DIR, CONTENT_ADDRESSED, AUDIT_MODE, AUDIT_RETENTION_DAYS, AUDIT_ARCHIVE,
+                  METRICS, METRICS_FILE, META_CACHE_SIZE, META_CACHE_TTL,
+                  CONTENT_CACHE_SIZE, CONTENT_CACHE_FILE_SIZE)
+
+# сетевой доступ к файловому менеджеру: HTTP/1.1 поверх asyncio, много клиентов и сессий одновременно.
+# запуск: python server.py [--host 127.0.0.1] [--port 8080] [--base-dir ./storage] [--db file_manager.db]
+#
+# вход - POST /login {"username", "password"} -> {"token"}, дальше заголовок Authorization: Bearer <token>
+#   GET/PUT/DELETE /files/<путь>      скачать (?offset=&count=) / загрузить (?mode=a - дозапись) / удалить
+#   POST /copy, /move, /move-dir      {"from", "to"}
+#   POST /batch                       {"operations": [...], "atomic": true} - file_manager.run_batch
+#   GET/POST/DELETE /dirs/<путь>      страница листинга (?after=&limit=&sort=&reverse=&pattern=) /
+#                                     создать / удалить (?recursive=1)
+#   POST /archive {"paths", "zip"}, POST /extract {"zip"}
+#   GET/PUT/PATCH /json/<путь>        документ потоком / запись (?ignore_null=1&indented=0) / JSON Patch
+#   GET/PUT /xml/<путь>, POST /xml/<путь> {"xpath", "name", "value"} - добавить элемент
+#   GET /usage, GET /metrics (формат Prometheus, без входа), POST /register, POST /logout
+#
+# тела загрузки и скачивания идут потоком (Content-Length или chunked) кусками, без файла в памяти:
+# загрузка сначала целиком принимается в event loop (до SPOOL_MEMORY в памяти, дальше во временный файл)
+# и только потом уходит в пул io, поэтому медленный клиент не занимает поток пула. тело запроса должно
+# приходить без пауз дольше BODY_TIMEOUT и в среднем не медленнее MIN_BODY_RATE, иначе 408.
+# запросы одного соединения можно слать не дожидаясь ответов (pipelining): чтения выполняются
+# параллельно, изменяющие - по очереди, ответы уходят строго по порядку. управление потоком:
+# ответ пишется с drain() (медленный клиент тормозит чтение файла), разбор новых запросов
+# останавливается, когда ответов в очереди соединения PIPELINE_DEPTH, а тело запроса читается
+# из сокета только по мере записи
+
+HOST = "127.0.0.1"
+PORT = 8080
+MAX_HEADER_SIZE = 64 * 1024  # строка запроса и заголовки; это же лимит буфера чтения StreamReader
+MAX_REQUEST_BODY = 1024 * 1024  # тела-команды в JSON
+MAX_DOCUMENT_BODY = file_manager.MAX_FILE_SIZE  # PUT /json, /xml: документ разбирается из строки
+MAX_UPLOAD_BODY = file_manager.MAX_FILE_SIZE  # PUT /files: предел и тела, и размера файла после записи
+PIPELINE_DEPTH = 16  # ответов в очереди соединения, дальше запросы не читаются
+KEEPALIVE_TIMEOUT = 60.0  # секунд ожидания следующего запроса
+BODY_TIMEOUT = 30.0  # секунд ожидания очередного куска тела запроса
+MIN_BODY_RATE = 4 * 1024  # байт/с в среднем по телу запроса, проверяется после BODY_RATE_GRACE секунд
+BODY_RATE_GRACE = 10.0
+SPOOL_MEMORY = 1024 * 1024  # загрузка до этого размера принимается в память, больше - во временный файл
+STREAM_CHUNK = 64 * 1024  # кусок ответа при скачивании и выдаче документов
+WRITE_BUFFER_HIGH = 256 * 1024  # буфер отправки соединения, выше - drain() ждёт клиента
+SAFE_METHODS = ("GET", "HEAD")  # запросы без изменений: выполняются параллельно друг с другом
+
+_REASONS = {100: "Continue", 200: "OK", 201: "Created", 204: "No Content", 400: "Bad Request",
+            401: "Unauthorized", 403: "Forbidden", 404: "Not Found", 405: "Method Not Allowed", 408: "Request Timeout",
+            409: "Conflict", 411: "Length Required", 413: "Payload Too Large",
+            431: "Request Header Fields Too Large", 500: "Internal Server Error", 501: "Not Implemented"}
+
+
+class HttpError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class Response(NamedTuple):
+    status: int
+    headers: list[tuple[str, str]]
+    body: bytes | object = b""  # bytes или async итератор кусков (отдаётся chunked)
+
+
+class Session(NamedTuple):
+    user_id: int
+    username: str
+    user_dir: str
+    token: str
+
+
+class Body:
+    # тело запроса из сокета: Content-Length или chunked. читается по мере потребления,
+    # finished - тело дочитано до конца (соединение готово к следующему запросу)
+    def __init__(self, reader: asyncio.StreamReader, length: int | None, chunked: bool):
+        self._reader = reader
+        self._left = length or 0
+        self._chunked = chunked
+        self._chunk_left = 0
+        self._started = None  # время начала чтения тела
+        self._received = 0
+        self._error = None  # после ошибки чтения тело дальше не читается
+        self.finished = asyncio.Event()
+        if not chunked and not length:
+            self.finished.set()
+
+    async def _wait(self, read):
+        # чтение из сокета с защитой от медленного клиента: пауза не дольше BODY_TIMEOUT,
+        # средняя скорость не ниже MIN_BODY_RATE
+        now = asyncio.get_running_loop().time()
+        if self._started is None:
+            self._started = now
+        try:
+            data = await asyncio.wait_for(read, BODY_TIMEOUT)
+        except asyncio.TimeoutError:
+            self._error = HttpError(408, "Тело запроса не передано вовремя")
+            raise self._error from None
+        except asyncio.IncompleteReadError:
+            self._error = HttpError(400, "Тело запроса оборвано")
+            raise self._error from None
+        self._received += len(data)
+        elapsed = asyncio.get_running_loop().time() - self._started
+        if elapsed > BODY_RATE_GRACE and self._received < MIN_BODY_RATE * elapsed:
+            self._error = HttpError(408, "Тело запроса передаётся слишком медленно")
+            raise self._error
+        return data
+
+    async def read_chunk(self) -> bytes:
+        # следующий кусок, b"" - конец тела
+        if self.finished.is_set():
+            return b""
+        if self._error is not None:
+            raise self._error
+        if not self._chunked:
+            data = await self._wait(self._reader.read(min(self._left, STREAM_CHUNK)))
+            if not data:
+                raise HttpError(400, "Тело запроса оборвано")
+            self._left -= len(data)
+            if not self._left:
+                self.finished.set()
+            return data
+        if not self._chunk_left:
+            line = await self._wait(self._reader.readuntil(b"\r\n"))
+            try:
+                self._chunk_left = int(line.split(b";", 1)[0].strip(), 16)
+            except ValueError:
+                raise HttpError(400, "Неверный размер куска chunked") from None
+            if not self._chunk_left:
+                # трейлеры до пустой строки
+                while await self._wait(self._reader.readuntil(b"\r\n")) != b"\r\n":
+                    pass
+                self.finished.set()
+                return b""
+        data = await self._wait(self._reader.read(min(self._chunk_left, STREAM_CHUNK)))
+        if not data:
+            raise HttpError(400, "Тело запроса оборвано")
+        self._chunk_left -= len(data)
+        if not self._chunk_left:
+            await self._wait(self._reader.readexactly(2))  # CRLF после куска
+        return data
+
+    async def __aiter__(self):
+        while True:
+            chunk = await self.read_chunk()
+            if not chunk:
+                return
+            yield chunk
+
+    async def read_all(self, limit: int) -> bytes:
+        parts = []
+        size = 0
+        async for chunk in self:
+            size += len(chunk)
+            if size > limit:
+                raise HttpError(413, f"Тело запроса больше {limit:,} байт")
+            parts.append(chunk)
+        return b"".join(parts)
+
+
+class Request(NamedTuple):
+    method: str
+    path: str
+    query: dict[str, str]
+    headers: dict[str, str]
+    body: Body
+    keep_alive: bool
+
+
+def _parse_head(head: bytes, reader: asyncio.StreamReader) -> Request:
+    lines = head.decode("latin-1").split("\r\n")
+    try:
+        method, target, version = lines[0].split(" ")
+    except ValueError:
+        raise HttpError(400, "Неверная строка запроса") from None
+    if version not in ("HTTP/1.1", "HTTP/1.0"):
+        raise HttpError(400, f"Неподдерживаемая версия {version}")
+    headers = {}
+    for line in lines[1:]:
+        if not line:
+            continue
+        name, sep, value = line.partition(":")
+        if not sep:
+            raise HttpError(400, "Неверный заголовок")
+        name = name.strip().lower()
+        headers[name] = f"{headers[name]}, {value.strip()}" if name in headers else value.strip()
+    connection = headers.get("connection", "").lower()
+    keep_alive = "close" not in connection and (version == "HTTP/1.1" or "keep-alive" in connection)
+    encoding = headers.get("transfer-encoding", "").lower()
+    if encoding and encoding != "chunked":
+        raise HttpError(501, f"Неподдерживаемый Transfer-Encoding: {encoding}")
+    length = None
+    if not encoding and "content-length" in headers:
+        try:
+            length = int(headers["content-length"])
+        except ValueError:
+            raise HttpError(400, "Неверный Content-Length") from None
+        if length < 0:
+            raise HttpError(400, "Неверный Content-Length")
+    url = urlsplit(target)
+    query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+    return Request(method, unquote(url.path), query, headers, Body(reader, length, bool(encoding)), keep_alive)
+
+
+def _json_response(data, status: int = 200) -> Response:
+    body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+    return Response(status, [("Content-Type", "application/json; charset=utf-8")], body)
+
+
+def _error(status: int, message: str, **extra) -> Response:
+    return _json_response({"error": message, **extra}, status)
+
+
+async def _json_body(request: Request) -> dict:
+    data = await request.body.read_all(MAX_REQUEST_BODY)
+    try:
+        value = json.loads(data or b"{}")
+    except ValueError as e:
+        raise HttpError(400, f"Неверный JSON в теле запроса: {e}") from None
+    if not isinstance(value, dict):
+        raise HttpError(400, "Тело запроса должно быть объектом JSON")
+    return value
+
+
+def _field(data: dict, name: str):
+    if name not in data:
+        raise HttpError(400, f"Нет поля {name}")
+    return data[name]
+
+
+def _flag(query: dict, name: str, default: bool) -> bool:
+    value = query.get(name)
+    return default if value is None else value.lower() in ("1", "true", "yes")
+
+
+def _int(query: dict, name: str, default: int | None) -> int | None:
+    try:
+        return int(query[name]) if name in query else default
+    except ValueError:
+        raise HttpError(400, f"{name} должно быть числом") from None
+
+
+async def _primed(chunks):
+    # первый кусок читается до отправки статуса: ошибки открытия (нет файла, нет доступа)
+    # становятся нормальным ответом 4xx, а не оборванным 200
+    iterator = chunks.__aiter__()
+    try:
+        first = await iterator.__anext__()
+    except StopAsyncIteration:
+        first = None
+
+    async def rest():
+        if first is not None:
+            yield first
+        async for chunk in iterator:
+            yield chunk
+    return rest()
+
+
+def _next_block(pieces) -> bytes:
+    # в потоке пула: куски текста до STREAM_CHUNK байт одним блоком, b"" - конец
+    parts = []
+    size = 0
+    for piece in pieces:
+        data = piece.encode("utf-8")
+        parts.append(data)
+        size += len(data)
+        if size >= STREAM_CHUNK:
+            break
+    return b"".join(parts)
+
+
+async def _pooled_text(make_pieces):
+    # синхронный генератор текста (разбор и форматирование документа) - в пуле cpu, блоками
+    pieces = await executors.run_cpu(make_pieces)
+    try:
+        while True:
+            block = await executors.run_cpu(_next_block, pieces)
+            if not block:
+                return
+            yield block
+    finally:
+        await executors.run_cpu(pieces.close)
+
+
+# обработчики: (запрос, сессия или None, путь после префикса) -> Response
+
+async def _register(request, session, rest):
+    data = await _json_body(request)
+    await async_api.async_register_user(str(_field(data, "username")), str(_field(data, "password")))
+    return _json_response({"registered": data["username"]}, 201)
+
+
+async def _login(request, session, rest):
+    data = await _json_body(request)
+    try:
+        user_id, token = await async_api.async_login_session(str(_field(data, "username")),
+                                                             str(_field(data, "password")))
+    except ValueError as e:
+        raise HttpError(401, str(e)) from None
+    return _json_response({"user_id": user_id, "token": token})
+
+
+async def _logout(request, session, rest):
+    await async_api.async_logout(session.token)
+    return Response(204, [])
+
+
+async def _download(request, session, rest):
+    offset = _int(request.query, "offset", 0)
+    count = _int(request.query, "count", None)
+    chunks = file_manager.async_read_file_stream(rest, session.user_id, session.user_dir, offset, count,
+                                                 STREAM_CHUNK)
+    return Response(200, [("Content-Type", "application/octet-stream")], await _primed(chunks))
+
+
+async def _spool(body: Body, limit: int):
+    # тело целиком до передачи в пул io: поток пула не ждёт кусков от клиента
+    spool = tempfile.SpooledTemporaryFile(SPOOL_MEMORY)
+    try:
+        size = 0
+        async for chunk in body:
+            size += len(chunk)
+            if size > limit:
+                raise HttpError(413, f"Тело запроса больше {limit:,} байт")
+            spool.write(chunk)
+        spool.seek(0)
+    except BaseException:
+        spool.close()
+        raise
+    return spool
+
+
+async def _upload(request, session, rest):
+    mode = request.query.get("mode", "w")
+    if mode not in ("w", "a"):
+        raise HttpError(400, "mode: w или a")
+    with await _spool(request.body, MAX_UPLOAD_BODY) as source:
+        size = await file_manager.async_write_file_stream(rest, source, session.user_id, session.user_dir, mode,
+                                                          MAX_UPLOAD_BODY)
+    return _json_response({"path": rest, "size": size})
+
+
+async def _delete_file(request, session, rest):
+    await async_api.async_delete_file(rest, session.user_id, session.user_dir)
+    return Response(204, [])
+
+
+async def _copy(request, session, rest):
+    data = await _json_body(request)
+    await async_api.async_copy_file(str(_field(data, "from")), str(_field(data, "to")),
+                                    session.user_id, session.user_dir)
+    return Response(204, [])
+
+
+async def _move(request, session, rest):
+    data = await _json_body(request)
+    await async_api.async_move_file(str(_field(data, "from")), str(_field(data, "to")),
+                                    session.user_id, session.user_dir)
+    return Response(204, [])
+
+
+async def _move_dir(request, session, rest):
+    data = await _json_body(request)
+    await async_api.async_move_directory(str(_field(data, "from")), str(_field(data, "to")),
+                                         session.user_id, session.user_dir)
+    return Response(204, [])
+
+
+async def _batch(request, session, rest):
+    data = await _json_body(request)
+    operations = _field(data, "operations")
+    if not isinstance(operations, list):
+        raise HttpError(400, "operations должно быть списком")
+    results = await async_api.async_run_batch(operations, session.user_id, session.user_dir,
+                                              bool(data.get("atomic", True)))
+    return _json_response({"results": [result._asdict() for result in results]})
+
+
+async def _list_dir(request, session, rest):
+    after = request.query.get("after")
+    try:
+        after = tuple(json.loads(after)) if after else None
+    except (ValueError, TypeError):
+        raise HttpError(400, "after - курсор из ответа (next)") from None
+    entries, cursor = await async_api.async_list_directory_page(
+        rest, session.user_id, session.user_dir, after, _int(request.query, "limit", file_manager.LIST_PAGE_SIZE),
+        request.query.get("sort", "name"), _flag(request.query, "reverse", False), request.query.get("pattern"))
+    return _json_response({"entries": [entry._asdict() for entry in entries],
+                           "next": json.dumps(cursor, ensure_ascii=False) if cursor is not None else None})
+
+
+async def _create_dir(request, session, rest):
+    await async_api.async_create_directory(rest, session.user_id, session.user_dir)
+    return Response(201, [])
+
+
+async def _delete_dir(request, session, rest):
+    await async_api.async_delete_directory(rest, session.user_id, session.user_dir,
+                                           _flag(request.query, "recursive", False))
+    return Response(204, [])
+
+
+async def _archive(request, session, rest):
+    data = await _json_body(request)
+    paths = _field(data, "paths")
+    if not isinstance(paths, list):
+        raise HttpError(400, "paths должно быть списком")
+    result = await async_api.async_create_archive([str(path) for path in paths], str(_field(data, "zip")),
+                                                  session.user_id, session.user_dir)
+    return _json_response(result)
+
+
+async def _extract(request, session, rest):
+    data = await _json_body(request)
+    await async_api.async_extract_zip(str(_field(data, "zip")), session.user_id, session.user_dir)
+    return Response(204, [])
+
+
+async def _document_text(request) -> str:
+    data = await request.body.read_all(MAX_DOCUMENT_BODY)
+    try:
+        return data.decode("utf-8")
+    except UnicodeDecodeError:
+        raise HttpError(400, "Документ должен быть в UTF-8") from None
+
+
+async def _read_json(request, session, rest):
+    def lines():
+        return (line + "\n" for line in json_xml_handler.iter_json_lines(rest, session.user_id, session.user_dir))
+    return Response(200, [("Content-Type", "application/json; charset=utf-8")], await _primed(_pooled_text(lines)))
+
+
+async def _write_json(request, session, rest):
+    text = await _document_text(request)
+    await async_api.async_write_json(rest, text, session.user_id, session.user_dir,
+                                     _flag(request.query, "ignore_null", False),
+                                     _flag(request.query, "indented", True))
+    return Response(204, [])
+
+
+async def _patch_json(request, session, rest):
+    data = await request.body.read_all(MAX_REQUEST_BODY)
+    try:
+        operations = json.loads(data)
+    except ValueError as e:
+        raise HttpError(400, f"Неверный JSON Patch: {e}") from None
+    if not isinstance(operations, list):
+        raise HttpError(400, "JSON Patch - список операций")
+    await async_api.async_patch_json(rest, operations, session.user_id, session.user_dir,
+                                     _flag(request.query, "indented", True))
+    return Response(204, [])
+
+
+async def _read_xml(request, session, rest):
+    def lines():
+        return (line + "\n" for line in json_xml_handler.iter_xml_lines(rest, session.user_id, session.user_dir))
+    return Response(200, [("Content-Type", "application/xml; charset=utf-8")], await _primed(_pooled_text(lines)))
+
+
+async def _write_xml(request, session, rest):
+    text = await _document_text(request)
+    await async_api.async_write_xml(rest, text, session.user_id, session.user_dir)
+    return Response(204, [])
+
+
+async def _edit_xml(request, session, rest):
+    data = await _json_body(request)
+    await async_api.async_edit_xml_add_element(rest, str(data.get("xpath", ".")), str(_field(data, "name")),
+                                               str(data.get("value", "")), session.user_id, session.user_dir)
+    return Response(204, [])
+
+
+async def _usage(request, session, rest):
+    used, files, quota = await async_api.async_get_usage(session.user_id)
+    return _json_response({"used": used, "files": files, "quota": quota})
+
+
+async def _metrics(request, session, rest):
+    return Response(200, [("Content-Type", "text/plain; version=0.0.4")], metrics.dump_prometheus().encode("utf-8"))
+
+
+# (метод, путь или префикс с "/" на конце, обработчик, нужен вход)
+ROUTES = [
+    ("POST", "/register", _register, False),
+    ("POST", "/login", _login, False),
+    ("POST", "/logout", _logout, True),
+    ("GET", "/files/", _download, True),
+    ("PUT", "/files/", _upload, True),
+    ("DELETE", "/files/", _delete_file, True),
+    ("POST", "/copy", _copy, True),
+    ("POST", "/move", _move, True),
+    ("POST", "/move-dir", _move_dir, True),
+    ("POST", "/batch", _batch, True),
+    ("GET", "/dirs/", _list_dir, True),
+    ("POST", "/dirs/", _create_dir, True),
+    ("DELETE", "/dirs/", _delete_dir, True),
+    ("POST", "/archive", _archive, True),
+    ("POST", "/extract", _extract, True),
+    ("GET", "/json/", _read_json, True),
+    ("PUT", "/json/", _write_json, True),
+    ("PATCH", "/json/", _patch_json, True),
+    ("GET", "/xml/", _read_xml, True),
+    ("PUT", "/xml/", _write_xml, True),
+    ("POST", "/xml/", _edit_xml, True),
+    ("GET", "/usage", _usage, True),
+    ("GET", "/metrics", _metrics, False),
+]
+
+
+def _route(request: Request):
+    allowed = False
+    path = request.path if request.path != "/dirs" else "/dirs/"
+    for method, prefix, handler, needs_auth in ROUTES:
+        if path == prefix or (prefix.endswith("/") and path.startswith(prefix)):
+            if method == request.method:
+                return handler, needs_auth, path[len(prefix):]
+            allowed = True
+    raise HttpError(405 if allowed else 404, "Метод не поддерживается" if allowed else "Нет такого адреса")
+
+
+async def _session(request: Request, base_dir: str) -> Session:
+    scheme, _, token = request.headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        raise HttpError(401, "Нужен заголовок Authorization: Bearer <токен>")
+    try:
+        user_id, username = await async_api.async_validate_session(token.strip())
+    except ValueError as e:
+        raise HttpError(401, str(e)) from None
+    user_dir = os.path.join(base_dir, username)
+    os.makedirs(user_dir, exist_ok=True)
+    return Session(user_id, username, user_dir, token.strip())
+
+
+async def _handle(request: Request, base_dir: str) -> Response:
+    try:
+        handler, needs_auth, rest = _route(request)
+        session = await _session(request, base_dir) if needs_auth else None
+        return await handler(request, session, rest)
+    except HttpError as e:
+        return _error(e.status, str(e))
+    except file_manager.BatchError as e:
+        return _error(409, str(e), results=[result._asdict() for result in e.results])
+    except FileNotFoundError as e:
+        return _error(404, str(e))
+    except PermissionError as e:
+        return _error(403, str(e))
+    except (ValueError, OSError) as e:
+        return _error(400, str(e))
+    except Exception:
+        traceback.print_exc()
+        return _error(500, "Внутренняя ошибка сервера")
+
+
+def _ready(response: Response) -> asyncio.Future:
+    future = asyncio.get_running_loop().create_future()
+    future.set_result(response)
+    return future
+
+
+_CONTINUE = Response(100, [])
+
+
+async def _send(writer: asyncio.StreamWriter, response: Response, close: bool):
+    lines = [f"HTTP/1.1 {response.status} {_REASONS.get(response.status, '')}"]
+    if response.status == 100:
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        await writer.drain()
+        return
+    streamed = not isinstance(response.body, (bytes, bytearray))
+    lines += [f"{name}: {value}" for name, value in response.headers]
+    if streamed:
+        lines.append("Transfer-Encoding: chunked")
+    elif response.status != 204:
+        lines.append(f"Content-Length: {len(response.body)}")
+    if close:
+        lines.append("Connection: close")
+    writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+    if not streamed:
+        if response.body:
+            writer.write(response.body)
+        await writer.drain()
+        return
+    async for chunk in response.body:
+        if chunk:
+            writer.write(b"%x\r\n" % len(chunk))
+            writer.write(chunk)
+            writer.write(b"\r\n")
+            await writer.drain()
+    writer.write(b"0\r\n\r\n")
+    await writer.drain()
+
+
+async def _write_responses(writer: asyncio.StreamWriter, queue: asyncio.Queue):
+    # ответы строго в порядке запросов; после ошибки записи оставшиеся обработчики отменяются
+    broken = False
+    while True:
+        item = await queue.get()
+        if item is None:
+            return
+        future, close = item
+        if broken:
+            future.cancel()
+            continue
+        try:
+            response = await future
+            await _send(writer, response, close)
+        except Exception:
+            # клиент отключился или поток ответа оборвался: через это соединение больше не ответить
+            broken = True
+            writer.transport.abort()
+        if close:
+            broken = True
+
+
+async def _serve_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, base_dir: str):
+    writer.transport.set_write_buffer_limits(high=WRITE_BUFFER_HIGH)
+    queue = asyncio.Queue(PIPELINE_DEPTH)
+    responder = asyncio.create_task(_write_responses(writer, queue))
+    inflight = []  # обработчики запросов этого соединения
+    barrier = None  # последний изменяющий запрос
+    try:
+        while not responder.done():
+            try:
+                head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), KEEPALIVE_TIMEOUT)
+            except asyncio.LimitOverrunError:
+                await queue.put((_ready(_error(431, "Слишком большие заголовки")), True))
+                break
+            except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+                break
+            try:
+                request = _parse_head(head, reader)
+            except HttpError as e:
+                await queue.put((_ready(_error(e.status, str(e))), True))
+                break
+            body = request.body
+            if not body.finished.is_set() and request.headers.get("expect", "").lower() == "100-continue":
+                await queue.put((_ready(_CONTINUE), False))
+            # порядок выполнения: чтения соединения идут параллельно, изменяющий запрос ждёт все
+            # предыдущие, и все следующие ждут его - как если бы запросы шли по одному
+            if request.method in SAFE_METHODS:
+                waits = [barrier] if barrier is not None and not barrier.done() else []
+            else:
+                waits = [task for task in inflight if not task.done()]
+            if waits:
+                await asyncio.wait(waits)
+            inflight = [task for task in inflight if not task.done()]
+            task = asyncio.create_task(_handle(request, base_dir))
+            inflight.append(task)
+            if request.method not in SAFE_METHODS:
+                barrier = task
+            keep_alive = request.keep_alive
+            if not body.finished.is_set():
+                # следующий запрос начинается после тела: ждём, пока обработчик его дочитает
+                finished = asyncio.create_task(body.finished.wait())
+                await asyncio.wait((finished, task), return_when=asyncio.FIRST_COMPLETED)
+                if not finished.done():
+                    # обработчик завершился, не дочитав тело (ошибка): небольшой остаток пропускаем,
+                    # большой не читаем - соединение закрывается после ответа
+                    finished.cancel()
+                    try:
+                        await body.read_all(MAX_REQUEST_BODY)
+                    except HttpError:
+                        keep_alive = False
+            await queue.put((task, not keep_alive))
+            if not keep_alive:
+                break
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        await queue.put(None)
+        try:
+            await responder
+        finally:
+            writer.close()
+
+
+async def serve(host: str = HOST, port: int = PORT, base_dir: str = BASE_DIR):
+    os.makedirs(base_dir, exist_ok=True)
+    # как в main.py: межпроцессные блокировки, сервер может работать рядом с консольным клиентом
+    lock_manager.configure("process", base_dir)
+    db.init_db()
+    blob_store.configure(base_dir, enabled=CONTENT_ADDRESSED)
+    audit_log.configure(AUDIT_MODE, AUDIT_RETENTION_DAYS, AUDIT_ARCHIVE)
+    metrics.configure(METRICS, METRICS_FILE)
+    meta_cache.configure(True, META_CACHE_SIZE, META_CACHE_TTL)
+    content_cache.configure(True, CONTENT_CACHE_SIZE, CONTENT_CACHE_FILE_SIZE)
+
+    async def on_connect(reader, writer):
+        try:
+            await _serve_connection(reader, writer, base_dir)
+        except asyncio.CancelledError:
+            # остановка сервера. отменённая задача соединения в asyncio 3.11 печатает трассировку
+            # из колбэка start_server, поэтому соединение завершается обычным образом
+            writer.transport.abort()
+
+    server = await asyncio.start_server(on_connect, host, port, limit=MAX_HEADER_SIZE)
+    address = server.sockets[0].getsockname()
+    print(f"Сервер слушает http://{address[0]}:{address[1]}", flush=True)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        audit_log.shutdown()
+        executors.shutdown()
+        db.close_db_connections()
+
+
+def main(argv=None):
+    global MAX_UPLOAD_BODY
+    parser = argparse.ArgumentParser(description="HTTP-сервер файлового менеджера")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT, help="0 - любой свободный порт")
+    parser.add_argument("--base-dir", default=BASE_DIR, help="хранилище файлов пользователей")
+    parser.add_argument("--db", default=db.DB_PATH, help="файл базы данных")
+    parser.add_argument("--max-upload", type=int, default=MAX_UPLOAD_BODY, help="предел загружаемого файла, байт")
+    args = parser.parse_args(argv)
+    MAX_UPLOAD_BODY = args.max_upload
+    db.DB_PATH = args.db
+    try:
+        asyncio.run(serve(args.host, args.port, args.base_dir))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,39 @@
+import os
+
+import pytest
+
+import blob_store
+import content_cache
+import db
+import file_manager
+import lock_manager
+import meta_cache
+
+
+@pytest.fixture
+def storage(tmp_path, monkeypatch):
+    # отдельная БД и хранилище на тест, кэши и блокировки - в пределах процесса
+    monkeypatch.setattr(db, "DB_PATH", str(tmp_path / "test.db"))
+    lock_manager.configure("thread")
+    blob_store.configure(str(tmp_path), enabled=False)
+    meta_cache.clear()
+    content_cache.clear()
+    file_manager._indexed_dirs.clear()
+    db.init_db()
+    yield tmp_path
+    db.close_db_connections()
+    meta_cache.clear()
+    content_cache.clear()
+
+
+@pytest.fixture
+def user_id(storage):
+    db.add_user("tester", "-")
+    return db.get_user("tester")[0]
+
+
+@pytest.fixture
+def user_dir(storage):
+    path = os.path.join(storage, "tester")
+    os.makedirs(path)
+    return path
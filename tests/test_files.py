@@ -0,0 +1,94 @@
+import os
+
+import pytest
+
+import content_cache
+import db
+import file_manager
+
+
+def test_read_range_from_cache(user_id, user_dir):
+    file_manager.write_file("a.txt", "0123456789", user_id, user_dir)
+    whole = file_manager.read_file("a.txt", user_id, user_dir)
+    assert whole == b"0123456789"
+    # диапазон закэшированного файла - срез без копирования
+    part = file_manager.read_file("a.txt", user_id, user_dir, offset=2, count=3)
+    assert isinstance(part, memoryview) and part == b"234"
+    assert file_manager.read_file("a.txt", user_id, user_dir) is whole
+
+
+def test_read_range_without_cache(user_id, user_dir):
+    content_cache.configure(enabled=False)
+    try:
+        file_manager.write_file("a.txt", "0123456789", user_id, user_dir)
+        assert file_manager.read_file("a.txt", user_id, user_dir, offset=8) == b"89"
+    finally:
+        content_cache.configure()
+
+
+def test_read_missing(user_id, user_dir):
+    with pytest.raises(FileNotFoundError):
+        file_manager.read_file("nope.txt", user_id, user_dir)
+
+
+def test_quota_rejects_write(user_id, user_dir, monkeypatch):
+    monkeypatch.setattr(file_manager, "USER_QUOTA", 1000)
+    file_manager.write_file("a.txt", "x" * 600, user_id, user_dir)
+    with pytest.raises(ValueError, match="квота"):
+        file_manager.write_file("b.txt", "x" * 500, user_id, user_dir)
+    assert not os.path.exists(os.path.join(user_dir, "b.txt"))
+    # перезапись считается по новому размеру, а не в сумме со старым
+    file_manager.write_file("a.txt", "x" * 900, user_id, user_dir)
+    assert db.get_usage_stats(user_id)[:2] == (900, 1)
+
+
+def test_quota_rejects_append_and_copy(user_id, user_dir, monkeypatch):
+    monkeypatch.setattr(file_manager, "USER_QUOTA", 1000)
+    file_manager.write_file("a.txt", "x" * 900, user_id, user_dir)
+    with pytest.raises(ValueError, match="квота"):
+        file_manager.write_file("a.txt", "y" * 200, user_id, user_dir, mode="a")
+    assert os.path.getsize(os.path.join(user_dir, "a.txt")) == 900
+    with pytest.raises(ValueError, match="квота"):
+        file_manager.copy_file("a.txt", "c.txt", user_id, user_dir)
+    assert not os.path.exists(os.path.join(user_dir, "c.txt"))
+    assert db.get_usage_stats(user_id)[:2] == (900, 1)
+
+
+def test_per_user_quota(user_id, user_dir, monkeypatch):
+    monkeypatch.setattr(file_manager, "USER_QUOTA", 1000)
+    db.set_quota(user_id, 5000)
+    file_manager.write_file("a.txt", "x" * 3000, user_id, user_dir)
+    db.set_quota(user_id, 100)
+    with pytest.raises(ValueError, match="квота"):
+        file_manager.write_file("b.txt", "x", user_id, user_dir)
+
+
+def test_batch_atomic_rollback(user_id, user_dir):
+    file_manager.write_file("a.txt", "old", user_id, user_dir)
+    file_manager.write_file("b.txt", "keep", user_id, user_dir)
+    with pytest.raises(file_manager.BatchError) as error:
+        file_manager.run_batch([
+            {"op": "write", "path": "a.txt", "content": "new"},
+            {"op": "move", "from": "b.txt", "path": "c.txt"},
+            {"op": "delete", "path": "missing.txt"},
+        ], user_id, user_dir)
+    assert [result.ok for result in error.value.results] == [False, False, False]
+    # диск и бд - как до пакета
+    assert file_manager.read_file("a.txt", user_id, user_dir) == b"old"
+    assert file_manager.read_file("b.txt", user_id, user_dir) == b"keep"
+    assert not os.path.exists(os.path.join(user_dir, "c.txt"))
+    assert db.get_file_id("c.txt", user_id) is None
+    assert file_manager.list_directory("", user_id, user_dir) == ["a.txt", "b.txt"]
+    assert db.get_usage_stats(user_id)[:2] == (7, 2)
+
+
+def test_batch_non_atomic_skips_failed(user_id, user_dir):
+    file_manager.write_file("a.txt", "old", user_id, user_dir)
+    results = file_manager.run_batch([
+        {"op": "copy", "from": "a.txt", "path": "b.txt"},
+        {"op": "delete", "path": "missing.txt"},
+        {"op": "write", "path": "c.txt", "content": "c"},
+    ], user_id, user_dir, atomic=False)
+    assert [result.ok for result in results] == [True, False, True]
+    assert file_manager.list_directory("", user_id, user_dir) == ["a.txt", "b.txt", "c.txt"]
+    assert file_manager.read_file("b.txt", user_id, user_dir) == b"old"
@@ -0,0 +1,67 @@
+import json
+
+import pytest
+
+import file_manager
+import json_xml_handler
+
+
+def _load(path, user_id, user_dir):
+    return json.loads(file_manager.read_file(path, user_id, user_dir))
+
+
+def test_patch_operations(user_id, user_dir):
+    json_xml_handler.write_json("d.json", '{"a": 1, "b": [1, 2], "c": {"x": null}}', user_id, user_dir)
+    json_xml_handler.patch_json("d.json", [
+        {"op": "replace", "path": "/a", "value": 2},
+        {"op": "add", "path": "/b/-", "value": 3},
+        {"op": "remove", "path": "/c/x"},
+        {"op": "copy", "from": "/b", "path": "/e"},
+        {"op": "move", "from": "/a", "path": "/f"},
+        {"op": "test", "path": "/f", "value": 2},
+    ], user_id, user_dir)
+    assert _load("d.json", user_id, user_dir) == {"b": [1, 2, 3], "c": {}, "e": [1, 2, 3], "f": 2}
+
+
+def test_failed_patch_leaves_file(user_id, user_dir):
+    json_xml_handler.write_json("d.json", '{"a": 1}', user_id, user_dir)
+    before = file_manager.read_file("d.json", user_id, user_dir)
+    with pytest.raises(ValueError):
+        json_xml_handler.patch_json("d.json", [
+            {"op": "add", "path": "/b", "value": 1},
+            {"op": "test", "path": "/a", "value": 5},
+        ], user_id, user_dir)
+    assert file_manager.read_file("d.json", user_id, user_dir) == before
+
+
+def test_update_json(user_id, user_dir):
+    json_xml_handler.write_json("d.json", '{"a": {"b": 1}}', user_id, user_dir)
+    json_xml_handler.update_json("d.json", {"/a/b": 2, "/a/c": [1]}, user_id, user_dir)
+    assert _load("d.json", user_id, user_dir) == {"a": {"b": 2, "c": [1]}}
+
+
+def test_patch_retries_after_concurrent_write(user_id, user_dir, monkeypatch):
+    # файл заменили, пока патч его читал: патч повторяется по новой версии, а не затирает её
+    json_xml_handler.write_json("d.json", '{"a": 1}', user_id, user_dir)
+    read_file_stream = file_manager.read_file_stream
+    calls = []
+
+    def racing_read(*args, **kwargs):
+        chunks = read_file_stream(*args, **kwargs)
+        if not calls:
+            json_xml_handler.write_json("d.json", '{"a": 1, "other": true}', user_id, user_dir)
+        calls.append(args)
+        return chunks
+
+    monkeypatch.setattr(file_manager, "read_file_stream", racing_read)
+    json_xml_handler.patch_json("d.json", [{"op": "add", "path": "/b", "value": 2}], user_id, user_dir)
+    assert len(calls) == 2
+    assert _load("d.json", user_id, user_dir) == {"a": 1, "other": True, "b": 2}
+
+
+def test_document_limit(user_id, user_dir, monkeypatch):
+    monkeypatch.setattr(json_xml_handler, "MAX_DOCUMENT_SIZE", 100)
+    json_xml_handler.write_json("d.json", '{"a": 1}', user_id, user_dir)
+    with pytest.raises(ValueError):
+        json_xml_handler.update_json("d.json", {"/b": "x" * 200}, user_id, user_dir)
+    assert _load("d.json", user_id, user_dir) == {"a": 1}
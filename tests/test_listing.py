@@ -0,0 +1,50 @@
+import os
+
+import file_manager
+
+
+def _names(entries):
+    return [entry.name for entry in entries]
+
+
+def test_pages_follow_cursor(user_id, user_dir):
+    for i in range(7):
+        file_manager.write_file(f"f{i}.txt", "x" * (i + 1), user_id, user_dir)
+    file_manager.create_directory("d", user_id, user_dir)
+
+    names, cursor = [], None
+    while True:
+        page, cursor = file_manager.list_directory_page("", user_id, user_dir, after=cursor, limit=3)
+        assert len(page) <= 3
+        names += _names(page)
+        if cursor is None:
+            break
+    assert names == ["d"] + [f"f{i}.txt" for i in range(7)]
+
+
+def test_sort_by_size_reverse(user_id, user_dir):
+    for name, size in [("a", 5), ("b", 1), ("c", 3), ("d", 3)]:
+        file_manager.write_file(name, "x" * size, user_id, user_dir)
+    entries = file_manager.iter_directory("", user_id, user_dir, sort="size", reverse=True, page_size=2)
+    assert _names(entries) == ["a", "d", "c", "b"]
+
+
+def test_pattern(user_id, user_dir):
+    for name in ["report.txt", "notes.txt", "report.json"]:
+        file_manager.write_file(name, "x", user_id, user_dir)
+    assert _names(file_manager.iter_directory("", user_id, user_dir, pattern="report*")) == \
+        ["report.json", "report.txt"]
+
+
+def test_unindexed_entries_indexed_once(user_id, user_dir):
+    file_manager.write_file("b.txt", "bb", user_id, user_dir)
+    os.makedirs(os.path.join(user_dir, "manual", "f"))
+    with open(os.path.join(user_dir, "zz.txt"), "w") as f:
+        f.write("z" * 10)
+    open(os.path.join(user_dir, ".b.txt.abc.tmp"), "w").close()
+
+    entries = list(file_manager.iter_directory("", user_id, user_dir, page_size=1))
+    assert _names(entries) == ["b.txt", "manual", "zz.txt"]
+    zz = entries[-1]
+    assert zz.file_id is not None and zz.size == 10
+    assert file_manager.list_directory("manual", user_id, user_dir) == ["f"]
@@ -0,0 +1,77 @@
+import xml.etree.ElementTree as ET
+
+import pytest
+
+import file_manager
+import json_xml_handler
+import xml_stream
+
+NESTED = "<r><a><x><a><b id='1'/></a></x><b id='2'/></a><a><b id='3'/></a></r>"
+
+
+def _load(path, user_id, user_dir):
+    return ET.fromstring(bytes(file_manager.read_file(path, user_id, user_dir)))
+
+
+def _streamed_parent(xml: str, xpath: str, descendant: bool):
+    # id элемента, которому append_element добавил потомка "new"
+    events = xml_stream.append_element(xml_stream.iter_events(xml), xpath, ET.Element("new"), descendant)
+    root = ET.fromstring("".join(xml_stream.iter_text(events)))
+    return next(parent for parent in root.iter() if parent.find("new") is not None).get("id")
+
+
+def test_append_by_path(user_id, user_dir):
+    json_xml_handler.write_xml("d.xml", "<r><a id='1'/><a id='2'><b/></a></r>", user_id, user_dir)
+    json_xml_handler.edit_xml_add_element("d.xml", "a[@id='2']", "c", "text", user_id, user_dir)
+    json_xml_handler.edit_xml_add_element("d.xml", "b", "d", "", user_id, user_dir)
+    root = _load("d.xml", user_id, user_dir)
+    assert root.find("a[@id='2']/c").text == "text"
+    assert root.find("a[@id='2']/b/d") is not None
+    assert root.find("a[@id='1']/c") is None
+
+
+def test_append_not_found(user_id, user_dir):
+    json_xml_handler.write_xml("d.xml", "<r><a/></r>", user_id, user_dir)
+    before = file_manager.read_file("d.xml", user_id, user_dir)
+    with pytest.raises(ValueError):
+        json_xml_handler.edit_xml_add_element("d.xml", "missing", "c", "", user_id, user_dir)
+    assert file_manager.read_file("d.xml", user_id, user_dir) == before
+
+
+@pytest.mark.parametrize("xpath", ["b", "x/a/b", "a//b", "a/x/a/b", "a[2]/b", "b[@id='3']"])
+def test_descendant_matches_elementtree(xpath):
+    expected = ET.fromstring(NESTED).find(".//" + xpath).get("id")
+    assert _streamed_parent(NESTED, xpath, descendant=True) == expected
+
+
+@pytest.mark.parametrize("xpath", ["a/b", "*/b", "a[1]/b"])
+def test_descendant_ambiguous_refused(xpath):
+    # первое в документе совпадение (b id=1 во вложенном a) - не то, что вернёт find(".//" + xpath)
+    assert ET.fromstring(NESTED).find(".//" + xpath).get("id") != "1"
+    with pytest.raises(xml_stream.Unsupported):
+        _streamed_parent(NESTED, xpath, descendant=True)
+
+def test_nested_path_uses_elementtree_order(user_id, user_dir):
+    # первый в документе b под a - id=1, но find(".//a/b") идёт по внешнему a и возвращает id=2
+    json_xml_handler.write_xml("d.xml", NESTED, user_id, user_dir)
+    json_xml_handler.edit_xml_add_element("d.xml", "a/b", "new", "", user_id, user_dir)
+    root = _load("d.xml", user_id, user_dir)
+    assert [b.get("id") for b in root.iter("b") if b.find("new") is not None] == ["2"]
+
+
+def test_append_retries_after_concurrent_write(user_id, user_dir, monkeypatch):
+    json_xml_handler.write_xml("d.xml", "<r><a/></r>", user_id, user_dir)
+    read_file_stream = file_manager.read_file_stream
+    calls = []
+
+    def racing_read(*args, **kwargs):
+        chunks = read_file_stream(*args, **kwargs)
+        if not calls:
+            json_xml_handler.write_xml("d.xml", "<r><a/><other/></r>", user_id, user_dir)
+        calls.append(args)
+        return chunks
+
+    monkeypatch.setattr(file_manager, "read_file_stream", racing_read)
+    json_xml_handler.edit_xml_add_element("d.xml", "a", "c", "", user_id, user_dir)
+    root = _load("d.xml", user_id, user_dir)
+    assert root.find("other") is not None and root.find("a/c") is not None
@@ -0,0 +1,377 @@
+import re
+import xml.etree.ElementTree as ET
+
+try:
+    from defusedxml.ElementTree import iterparse
+except ImportError:
+    from xml.etree.ElementTree import iterparse
+
+# потоковая обработка XML: документ разбирается один раз (iterparse, защита от XXE через defusedxml)
+# и превращается в поток событий:
+#   ("start", тег, атрибуты, объявления пространств имён [(префикс, uri)])
+#   ("text", текст)   - текст элемента или хвост после дочернего элемента
+#   ("end", тег)
+# разобранные элементы сразу отцепляются от родителя - в памяти только цепочка открытых элементов.
+# iter_text форматирует поток с отступами (как minidom.toprettyxml, но без пустых строк
+# из пробельных узлов), append_element добавляет элемент по пути из простого подмножества XPath
+
+READ_CHUNK = 64 * 1024  # байт на один feed разборщика
+INDENT = "  "
+XML_NS = "http://www.w3.org/XML/1998/namespace"
+
+_NAME = re.compile(r"^[A-Za-z_][\w.\-]*(?::[A-Za-z_][\w.\-]*)?$")
+
+
+class NotFound(ValueError):
+    # путь XPath не нашёл ни одного элемента
+    pass
+
+
+class Unsupported(ValueError):
+    # выражение XPath вне потокового подмножества (или поток не может выбрать тот же элемент,
+    # что ElementTree.find) - нужна правка в памяти
+    pass
+
+
+class _ChunkReader:
+    # файлоподобная обёртка над итератором кусков bytes для iterparse
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._chunk = memoryview(b"")
+        self._pos = 0
+
+    def read(self, size: int = -1) -> bytes:
+        while self._pos >= len(self._chunk):
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return b""
+            self._chunk = memoryview(chunk.encode("utf-8") if isinstance(chunk, str) else chunk)
+            self._pos = 0
+        end = len(self._chunk) if size < 0 else self._pos + size
+        data = bytes(self._chunk[self._pos:end])
+        self._pos += len(data)
+        return data
+
+
+def _byte_chunks(source):
+    # str/bytes целиком или итератор кусков (например read_file_stream)
+    if isinstance(source, str):
+        source = source.encode("utf-8")
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        view = memoryview(source)
+        return (view[i:i + READ_CHUNK] for i in range(0, len(view), READ_CHUNK))
+    return source
+
+
+def iter_events(source):
+    # события документа; ошибка разбора или запрещённая конструкция (DTD-сущности) - исключение iterparse
+    stack = []  # открытые элементы
+    last = []  # по уровням: последний закрытый дочерний элемент (ждёт, пока станет известен его tail)
+    namespaces = []
+    for event, item in iterparse(_ChunkReader(_byte_chunks(source)), ("start", "end", "start-ns")):
+        if event == "start-ns":
+            namespaces.append(item)
+            continue
+        if event == "start":
+            if stack:
+                yield from _flush_text(stack[-1], last)
+            yield "start", item.tag, dict(item.attrib), namespaces
+            namespaces = []
+            stack.append(item)
+            last.append(None)
+            continue
+        # end: текст до закрывающего тега известен
+        yield from _flush_text(item, last)
+        last.pop()
+        yield "end", item.tag
+        stack.pop()
+        if stack:
+            last[-1] = item
+        else:
+            item.clear()
+
+
+def _flush_text(parent, last):
+    # текст перед следующим событием внутри parent: хвост последнего закрытого потомка или text самого parent.
+    # закрытый потомок отцепляется - дерево в памяти не растёт
+    child = last[-1]
+    if child is None:
+        if parent.text:
+            yield "text", parent.text
+        parent.text = None
+        return
+    if child.tail:
+        yield "text", child.tail
+    parent.remove(child)
+    child.clear()
+    last[-1] = None
+
+
+def element_events(elem):
+    # события готового элемента ElementTree (правка в памяти, новый элемент)
+    yield "start", elem.tag, dict(elem.attrib), []
+    if elem.text:
+        yield "text", elem.text
+    for child in elem:
+        yield from element_events(child)
+        if child.tail:
+            yield "text", child.tail
+    yield "end", elem.tag
+
+
+def _escape_text(text: str) -> str:
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+def _escape_attr(text: str) -> str:
+    return (_escape_text(text).replace('"', "&quot;")
+            .replace("\n", "&#10;").replace("\r", "&#13;").replace("\t", "&#09;"))
+
+
+class _Namespaces:
+    # префиксы для тегов вида {uri}имя: объявленные в документе или сгенерированные ns0, ns1...
+    def __init__(self):
+        self._scopes = [{XML_NS: "xml"}]  # uri -> префикс, копия при каждом новом объявлении
+        self._generated = 0
+
+    def push(self, declarations) -> list[tuple[str, str]]:
+        scope = self._scopes[-1]
+        if declarations:
+            scope = dict(scope)
+            for prefix, uri in declarations:
+                for old_uri in [u for u, p in scope.items() if p == prefix]:
+                    del scope[old_uri]
+                scope[uri] = prefix
+        self._scopes.append(scope)
+        return list(declarations)
+
+    def pop(self):
+        self._scopes.pop()
+
+    def name(self, tag: str, declarations: list, attribute: bool = False) -> str:
+        if tag[:1] != "{":
+            return tag
+        uri, local = tag[1:].split("}", 1)
+        scope = self._scopes[-1]
+        prefix = scope.get(uri)
+        if prefix is None or (attribute and prefix == ""):
+            # атрибут не может быть в пространстве по умолчанию - нужен префикс
+            prefix = f"ns{self._generated}"
+            self._generated += 1
+            self._scopes[-1] = scope = dict(scope)
+            scope[uri] = prefix
+            declarations.append((prefix, uri))
+        return f"{prefix}:{local}" if prefix else local
+
+
+def _start_tag(namespaces: _Namespaces, tag: str, attrib: dict, declared) -> tuple[str, str]:
+    declarations = namespaces.push(declared)
+    name = namespaces.name(tag, declarations)
+    attrs = [f' {namespaces.name(key, declarations, True)}="{_escape_attr(value)}"' for key, value in attrib.items()]
+    decls = [f' xmlns:{prefix}="{_escape_attr(uri)}"' if prefix else f' xmlns="{_escape_attr(uri)}"'
+             for prefix, uri in declarations]
+    return name, "<" + name + "".join(decls) + "".join(attrs)
+
+
+def iter_text(events, indent: str = INDENT):
+    # документ с отступами кусками (строками). элемент только с текстом - в одну строку как есть,
+    # текст смешанного содержимого - отдельными строками без крайних пробелов,
+    # пробельный текст с переводом строки (старые отступы) отбрасывается - повторное форматирование ничего не меняет
+    namespaces = _Namespaces()
+    names = []
+    open_tag = None  # начало тега последнего открытого элемента, ещё без ">"
+    pending_text = None  # текст этого элемента до первого потомка
+    yield '<?xml version="1.0" ?>\n'
+    for event in events:
+        kind = event[0]
+        if kind == "text":
+            text = event[1]
+            if not text.strip() and "\n" in text:
+                continue
+            if open_tag is not None and pending_text is None:
+                pending_text = text
+            else:
+                if open_tag is not None:
+                    yield open_tag + ">\n" + indent * len(names) + _escape_text(pending_text.strip()) + "\n"
+                    open_tag, pending_text = None, None
+                yield indent * len(names) + _escape_text(text.strip()) + "\n"
+            continue
+        if open_tag is not None and kind == "start":
+            # у открытого элемента появился потомок: тег закрывается, текст - отдельной строкой
+            yield open_tag + ">\n"
+            if pending_text is not None:
+                yield indent * len(names) + _escape_text(pending_text.strip()) + "\n"
+            open_tag, pending_text = None, None
+        if kind == "start":
+            name, tag = _start_tag(namespaces, event[1], event[2], event[3])
+            open_tag = indent * len(names) + tag
+            names.append(name)
+            continue
+        name = names.pop()
+        namespaces.pop()
+        if open_tag is None:
+            yield indent * len(names) + f"</{name}>\n"
+        elif pending_text is None:
+            yield open_tag + "/>\n"
+        else:
+            yield open_tag + ">" + _escape_text(pending_text) + f"</{name}>\n"
+        open_tag, pending_text = None, None
+
+
+# простое подмножество XPath (как у ElementTree.find): шаги tag, *, . через / и //,
+# предикаты [@attr], [@attr='v'], [n]. абсолютный путь /root/... начинается с корня
+
+_PREDICATE = re.compile(r"""\[\s*(?:@([^\s=\]]+)\s*(?:=\s*(?:'([^']*)'|"([^"]*)"))?|([1-9][0-9]*))\s*\]""")
+
+
+def _split_steps(xpath: str) -> list[tuple[bool, str]]:
+    # (потомок на любой глубине, шаг); "/" внутри {uri} и [...] не разделяет шаги
+    steps = []
+    current = ""
+    depth = 0
+    descendant = False
+    i = 0
+    while i < len(xpath):
+        c = xpath[i]
+        if c in "{[":
+            depth += 1
+        elif c in "}]":
+            depth -= 1
+        if c == "/" and depth == 0:
+            if current:
+                steps.append((descendant, current))
+                current, descendant = "", False
+            if xpath.startswith("//", i):
+                descendant = True
+                i += 1
+        else:
+            current += c
+        i += 1
+    if current:
+        steps.append((descendant, current))
+    elif descendant:
+        raise Unsupported(xpath)
+    return steps
+
+
+def parse_xpath(xpath: str) -> tuple[bool, list]:
+    # (абсолютный путь, [(потомок на любой глубине, тег или *, [(атрибут, значение | None, позиция | None)])])
+    xpath = xpath.strip()
+    absolute = xpath.startswith("/") and not xpath.startswith("//")
+    steps = []
+    for descendant, step in _split_steps(xpath[1:] if absolute else xpath):
+        match = re.match(r"^(\{[^}]*\}[^\[/]+|[^\[/{]+)", step)
+        tag = match.group(1).strip() if match else ""
+        rest = step[len(match.group(1)):] if match else step
+        predicates = []
+        while rest:
+            predicate = _PREDICATE.match(rest)
+            if predicate is None or not tag:
+                raise Unsupported(xpath)
+            attr, single, double, position = predicate.groups()
+            predicates.append((attr, single if single is not None else double, int(position) if position else None))
+            rest = rest[predicate.end():].lstrip()
+        if tag == "." and not predicates:
+            continue  # "./x" - то же, что "x"; в ".//x" признак потомка уже у следующего шага
+        if not tag or tag == "." or tag == ".." or tag.startswith("@") or "(" in tag:
+            raise Unsupported(xpath)
+        steps.append((descendant, tag, predicates))
+    if not steps or (absolute and steps[0][0]):
+        raise Unsupported(xpath)
+    return absolute, steps
+
+
+def _step_matches(step, info) -> bool:
+    _, tag, predicates = step
+    name, attrib, position, any_position = info
+    if tag != "*" and tag != name:
+        return False
+    for attr, value, index in predicates:
+        if index is not None:
+            if (any_position if tag == "*" else position) != index:
+                return False
+        elif attr not in attrib or (value is not None and attrib[attr] != value):
+            return False
+    return True
+
+
+def _first_path(chain: list, i: int, steps: list, j: int) -> list[int] | None:
+    # индексы chain для шагов steps[j:], первые в порядке ElementTree (по первому шагу, затем по второму...)
+    if j == len(steps):
+        return [] if i == len(chain) else None
+    step = steps[j]
+    for k in (range(i, len(chain)) if step[0] else range(i, min(i + 1, len(chain)))):
+        if _step_matches(step, chain[k]):
+            rest = _first_path(chain, k + 1, steps, j + 1)
+            if rest is not None:
+                return [k] + rest
+    return None
+
+
+def _ambiguous(chain: list, path: list[int], steps: list, start: int) -> bool:
+    # ElementTree.find перебирает совпадения вложенными циклами по шагам, а не в порядке документа.
+    # первое в документе совпадение может оказаться не первым для find, только если шаг "//"
+    # совпадает и с предком выбранного для него элемента: из этого предка позже может найтись
+    # другой путь, который find поставит раньше
+    for j, step in enumerate(steps):
+        if step[0]:
+            lo = path[j - 1] + 1 if j else start
+            if any(_step_matches(step, chain[k]) for k in range(lo, path[j])):
+                return True
+    return False
+
+
+def append_element(events, xpath: str, element: ET.Element, descendant: bool = False):
+    # поток с element, добавленным последним потомком элемента, который вернул бы ElementTree.find(xpath):
+    # путь отсчитывается от корня; "", "." и "/" - сам корень. descendant - искать путь на любой
+    # глубине (как find(".//" + xpath)). элемент выбирается по открывающему тегу - первый в порядке
+    # документа; если find мог бы выбрать другой (_ambiguous) - Unsupported. не найден - NotFound
+    if xpath.strip() in ("", ".", "/"):
+        absolute, steps = False, []
+    else:
+        absolute, steps = parse_xpath(xpath)
+        if descendant:
+            if absolute:
+                raise NotFound(f"Не найден элемент по XPath: {xpath}")
+            steps = [(True,) + steps[0][1:]] + steps[1:]
+    chain = []  # (тег, атрибуты, позиция среди одноимённых братьев, позиция среди всех братьев)
+    counters = [{}]
+    target = None  # глубина найденного элемента
+    done = False
+    for event in events:
+        kind = event[0]
+        if kind == "start":
+            tag = event[1]
+            counts = counters[-1]
+            counts[tag] = counts.get(tag, 0) + 1
+            counts[None] = counts.get(None, 0) + 1
+            chain.append((tag, event[2], counts[tag], counts[None]))
+            counters.append({})
+            if not done and target is None:
+                # относительный путь - от корня: сам корень в сравнение не входит
+                start = 0 if absolute else 1
+                if not steps:
+                    path = [] if len(chain) == 1 else None
+                else:
+                    path = _first_path(chain, start, steps, 0) if len(chain) > start else None
+                if path is not None:
+                    if _ambiguous(chain, path, steps, start):
+                        raise Unsupported(xpath)
+                    target = len(chain)
+        elif kind == "end":
+            if target == len(chain):
+                yield from element_events(element)
+                target, done = None, True
+            chain.pop()
+            counters.pop()
+        yield event
+    if not done:
+        raise NotFound(f"Не найден элемент по XPath: {xpath}")
+
+
+def new_element(name: str, text: str | None = None) -> ET.Element:
+    if not _NAME.match(name):
+        raise ValueError(f"Недопустимое имя элемента: {name}")
+    element = ET.Element(name)
+    element.text = text
+    return element
@@ -1,18 +1,229 @@
 import os
+import time
+import shutil
+import struct
+import tempfile
+import threading
+import zlib
 import zipfile
-from lock_manager import file_lock
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import lock_manager
+import audit_log
+import blob_store
 import db
-from file_manager import is_safe_path
+import metrics
+import content_cache
+from file_manager import is_safe_path, _open_temp, _discard_temp, _record_write, _check_quota
 
 MAX_EXTRACT_SIZE = 50 * 1024 * 1024  # 50 MB
+EXTRACT_CHUNK = 1024 * 1024
 
-def create_archive(paths: list[str], zip_path: str, user_id: int, user_dir: str) -> None:
+COMPRESS_LEVEL = 6
+COMPRESS_WORKERS = os.cpu_count() or 1
+COMPRESS_CHUNK = 1024 * 1024  # кусок файла, который сжимает один поток
+COMPRESS_WINDOW = 32 * 1024  # предыдущие данные как словарь для следующего куска (окно deflate)
+
+_ZIP64_LIMIT = (1 << 31) - 1
+_LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+_CENTRAL_HEADER = struct.Struct("<IHHHHHHIIIHHHHHII")
+_END_RECORD = struct.Struct("<IHHHHIIH")
+_ZIP64_END_RECORD = struct.Struct("<IQHHIIQQQQ")
+_ZIP64_LOCATOR = struct.Struct("<IIQI")
+
+
+def _dos_time(mtime: float) -> tuple[int, int]:
+    t = time.localtime(mtime)
+    if t.tm_year < 1980:
+        return 0, (1 << 5) | 1  # 1980-01-01
+    return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), \
+        ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+
+
+class _ZipStreamWriter:
+    # запись ZIP потоком: локальный заголовок пишется до данных, а crc и размеры
+    # дописываются в него после (файл назначения seekable), поэтому член архива не буферизуется.
+    # zip64 включается для больших членов и больших архивов
+    def __init__(self, f):
+        self._f = f
+        self._entries = []
+        self._current = None
+
+    def start_member(self, name: str, st: os.stat_result, is_dir: bool):
+        name_bytes = name.encode("utf-8")
+        flags = 0 if name_bytes.isascii() else 0x800  # имя в UTF-8
+        method = zipfile.ZIP_STORED if is_dir else zipfile.ZIP_DEFLATED
+        zip64 = not is_dir and st.st_size * 1.05 > _ZIP64_LIMIT
+        dos_time, dos_date = _dos_time(st.st_mtime)
+        extra = struct.pack("<HHQQ", 1, 16, 0, 0) if zip64 else b""
+        offset = self._f.tell()
+        self._f.write(_LOCAL_HEADER.pack(
+            0x04034b50, 45 if zip64 else 20, flags, method, dos_time, dos_date,
+            0, 0xFFFFFFFF if zip64 else 0, 0xFFFFFFFF if zip64 else 0, len(name_bytes), len(extra)))
+        self._f.write(name_bytes)
+        self._f.write(extra)
+        attr = (st.st_mode & 0xFFFF) << 16
+        if is_dir:
+            attr |= 0x10
+        self._current = {"name": name_bytes, "flags": flags, "method": method, "time": dos_time,
+                         "date": dos_date, "offset": offset, "zip64": zip64, "attr": attr,
+                         "crc": 0, "compressed": 0, "size": 0}
+
+    def write(self, data: bytes):
+        self._f.write(data)
+
+    def finish_member(self, crc: int, compressed: int, size: int):
+        entry = self._current
+        entry.update(crc=crc, compressed=compressed, size=size)
+        end = self._f.tell()
+        self._f.seek(entry["offset"] + 14)
+        if entry["zip64"]:
+            self._f.write(struct.pack("<I", crc))
+            self._f.seek(entry["offset"] + _LOCAL_HEADER.size + len(entry["name"]) + 4)
+            self._f.write(struct.pack("<QQ", size, compressed))
+        elif compressed > _ZIP64_LIMIT or size > _ZIP64_LIMIT:
+            raise ValueError("Файл изменился во время архивации")
+        else:
+            self._f.write(struct.pack("<III", crc, compressed, size))
+        self._f.seek(end)
+        self._entries.append(entry)
+        self._current = None
+
+    def close(self):
+        cd_offset = self._f.tell()
+        for e in self._entries:
+            fields = []
+            size, compressed, offset = e["size"], e["compressed"], e["offset"]
+            if e["zip64"] or size > _ZIP64_LIMIT:
+                fields.append(size)
+                size = 0xFFFFFFFF
+            if e["zip64"] or compressed > _ZIP64_LIMIT:
+                fields.append(compressed)
+                compressed = 0xFFFFFFFF
+            if offset > _ZIP64_LIMIT:
+                fields.append(offset)
+                offset = 0xFFFFFFFF
+            extra = struct.pack(f"<HH{len(fields)}Q", 1, 8 * len(fields), *fields) if fields else b""
+            version = 45 if fields else 20
+            self._f.write(_CENTRAL_HEADER.pack(
+                0x02014b50, (3 << 8) | version, version, e["flags"], e["method"], e["time"], e["date"],
+                e["crc"], compressed, size, len(e["name"]), len(extra), 0, 0, 0, e["attr"], offset))
+            self._f.write(e["name"])
+            self._f.write(extra)
+        cd_end = self._f.tell()
+        count, cd_size = len(self._entries), cd_end - cd_offset
+        if count >= 0xFFFF or cd_offset > _ZIP64_LIMIT or cd_size > _ZIP64_LIMIT:
+            self._f.write(_ZIP64_END_RECORD.pack(
+                0x06064b50, _ZIP64_END_RECORD.size - 12, (3 << 8) | 45, 45, 0, 0, count, count, cd_size, cd_offset))
+            self._f.write(_ZIP64_LOCATOR.pack(0x07064b50, 0, cd_end, 1))
+            count, cd_size, cd_offset = min(count, 0xFFFF), min(cd_size, 0xFFFFFFFF), min(cd_offset, 0xFFFFFFFF)
+        self._f.write(_END_RECORD.pack(0x06054b50, 0, 0, count, count, cd_size, cd_offset, 0))
+
+
+def _compress_chunk(data: bytes, zdict: bytes, final: bool) -> bytes:
+    # независимое сжатие куска (как pigz): словарь - хвост предыдущего куска, поэтому степень сжатия
+    # почти как у одного потока; Z_SYNC_FLUSH выравнивает по байту и не ставит признак конца,
+    # так что куски склеиваются в один корректный поток deflate
+    if zdict:
+        compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, -15, zdict=zdict)
+    else:
+        compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+
+def _collect_members(paths: list[str], user_dir: str, skip: str) -> list[tuple[str, str, bool]]:
+    # (имя в архиве, путь на диске, директория ли); директории обходятся рекурсивно
+    members = []
+    for p in paths:
+        src = os.path.join(user_dir, p)
+        if not is_safe_path(src, user_dir, allow_base=True):
+            raise ValueError("Обнаружено попытка обхода пути")
+        arcname = lock_manager.normalize_path(p)
+        if os.path.isfile(src):
+            members.append((arcname, src, False))
+        elif os.path.isdir(src):
+            for root, dirs, files in os.walk(src):
+                # временные директории незавершённых распаковок не архивируем
+                dirs[:] = sorted(d for d in dirs if not (d.startswith(".") and d.endswith(".tmp")))
+                rel = lock_manager.normalize_path(os.path.relpath(root, src))
+                prefix = "/".join(part for part in (arcname, rel) if part)
+                if prefix:
+                    members.append((prefix + "/", root, True))
+                for name in sorted(files):
+                    full = os.path.join(root, name)
+                    # свой архив и временные файлы незавершённых записей не архивируем
+                    if os.path.abspath(full) == skip or (name.startswith(".") and name.endswith(".tmp")):
+                        continue
+                    members.append(("/".join(part for part in (prefix, name) if part), full, False))
+        else:
+            raise ValueError(f"Путь {p} не найден")
+    return members
+
+
+def _write_archive(f, members: list[tuple[str, str, bool]], workers: int) -> int:
+    # чтение и запись в этом потоке, сжатие кусков в пуле. заголовки и куски всех членов архива
+    # идут одной упорядоченной очередью: мелкие файлы сжимаются параллельно друг с другом,
+    # крупные - по кускам; в памяти не больше window кусков
+    writer = _ZipStreamWriter(f)
+    window = max(2, workers * 2)
+    pending = deque()
+    state = {"crc": 0, "compressed": 0, "size": 0}
+    total_in = 0
+
+    def flush_one():
+        item = pending.popleft()
+        if item[0] == "start":
+            _, arcname, st, is_dir = item
+            writer.start_member(arcname, st, is_dir)
+            if is_dir:
+                writer.finish_member(0, 0, 0)
+            return
+        _, raw, future, last = item
+        data = future.result()
+        writer.write(data)
+        state["crc"] = zlib.crc32(raw, state["crc"])
+        state["compressed"] += len(data)
+        state["size"] += len(raw)
+        if last:
+            writer.finish_member(state["crc"], state["compressed"], state["size"])
+            state.update(crc=0, compressed=0, size=0)
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="sfm-zip") as pool:
+        for arcname, full, is_dir in members:
+            pending.append(("start", arcname, os.stat(full), is_dir))
+            if is_dir:
+                continue
+            with open(full, "rb") as src:
+                zdict = b""
+                chunk = src.read(COMPRESS_CHUNK)
+                while True:
+                    next_chunk = src.read(COMPRESS_CHUNK) if chunk else b""
+                    last = not next_chunk
+                    pending.append(("chunk", chunk, pool.submit(_compress_chunk, chunk, zdict, last), last))
+                    total_in += len(chunk)
+                    while len(pending) > window:
+                        flush_one()
+                    if last:
+                        break
+                    zdict = chunk[-COMPRESS_WINDOW:]
+                    chunk = next_chunk
+        while pending:
+            flush_one()
+    writer.close()
+    return total_in
+
+
+@metrics.timed()
+def create_archive(paths: list[str], zip_path: str, user_id: int, user_dir: str,
+                   workers: int = COMPRESS_WORKERS) -> dict:
 
     # Создание ZIP
-    # атомарно с file_lock
+    # атомарно: shared на исходные пути, exclusive на архив
     # логирование
-    # сжатие DEFLATED
-    # список путей с поддиректорией
+    # сжатие DEFLATED параллельно по кускам в workers потоках (zlib отпускает GIL)
+    # список путей с поддиректорией, директории добавляются рекурсивно
+    # архив пишется во временный файл и подменяется через os.replace
+    # возвращает статистику: файлы, байты до/после сжатия, время, МБ/с
 
     full_zip = os.path.join(user_dir, zip_path)
     if not is_safe_path(full_zip, user_dir):
@@ -20,72 +231,180 @@ def create_archive(paths: list[str], zip_path: str, user_id: int, user_dir: str)
     if not zip_path.endswith(".zip"):
         zip_path += ".zip"
         full_zip += ".zip"
-    with file_lock:
-        file_id = db.get_file_id(zip_path, user_id)
-        op_type = "modify" if file_id is not None else "create"
-        with zipfile.ZipFile(full_zip, "w", zipfile.ZIP_DEFLATED) as z:
-            for p in paths:
-                src = os.path.join(user_dir, p)
-                if os.path.exists(src):
-                    z.write(src, arcname=p)
-                else:
-                    raise ValueError(f"Путь {p} не найден")
-        size = os.path.getsize(full_zip)
-        if file_id is not None:
-            db.update_file_size(file_id, size)
-        else:
-            file_id = db.add_file(os.path.basename(zip_path), size, zip_path, user_id)
-        db.log_operation(op_type, file_id, user_id)
+    started = time.perf_counter()
+    with lock_manager.locked(user_id, shared=paths, exclusive=[zip_path]):
+        members = _collect_members(paths, user_dir, os.path.abspath(full_zip))
+        f, tmp_path = _open_temp(full_zip)
+        try:
+            with f:
+                bytes_in = _write_archive(f, members, workers)
+            size = os.path.getsize(tmp_path)
+            with db.transaction() as conn:
+                _record_write(zip_path, size, user_id, conn)
+                os.replace(tmp_path, full_zip)
+                content_cache.invalidate(full_zip)
+        except BaseException:
+            _discard_temp(tmp_path)
+            raise
+    blob_store.collect_garbage()
+    seconds = time.perf_counter() - started
+    return {
+        "files": sum(1 for _, _, is_dir in members if not is_dir),
+        "bytes_in": bytes_in,
+        "bytes_out": size,
+        "seconds": seconds,
+        "mb_per_s": bytes_in / (1024 * 1024) / seconds if seconds else 0.0,
+    }
 
 
-def extract_zip(zip_path: str, user_id: int, user_dir: str) -> None:
-    full_zip = os.path.join(user_dir, zip_path)
-    if not is_safe_path(full_zip, user_dir):
-        raise ValueError("Обнаружено попытка обхода пути")
-    if not os.path.exists(full_zip):
-        raise FileNotFoundError("Архив не найден")
+class _SizeCap:
+    # общий счётчик распакованных байт: лимит проверяется по реальным данным,
+    # а не по file_size из заголовков архива, которым нельзя доверять
+    def __init__(self, limit: int):
+        self._limit = limit
+        self._total = 0
+        self._lock = threading.Lock()
+
+    def add(self, n: int):
+        with self._lock:
+            self._total += n
+            if self._total > self._limit:
+                raise ValueError("ZIP-бомба обнаружена")
+
+
+def _plan_extract(infos: list[zipfile.ZipInfo], zip_path: str, user_dir: str) -> list[tuple[zipfile.ZipInfo, str]]:
+    # один проход по центральному каталогу: проверка имён и пути назначения относительно корня пользователя
+    plan = []
+    for info in infos:
+        member = info.filename.rstrip("/")
+
+        # Защита от traversal
+        if member.startswith('/') or member.startswith('\\') or '../' in member or '..\\' in member:
+            raise ValueError("Небезопасный путь в архиве")
+
+        # Путь относительно корня хранилища (для БД)
+        rel_path = os.path.join(os.path.dirname(zip_path), member).replace("\\", "/").lstrip("/")
+        if not is_safe_path(os.path.join(user_dir, rel_path), user_dir):
+            raise ValueError("Небезопасный путь в архиве")
+        plan.append((info, rel_path))
+    return plan
+
+
+def _extract_member(z: zipfile.ZipFile, info: zipfile.ZipInfo, staged: str, cap: _SizeCap) -> int:
+    # потоковая распаковка одного члена во временный файл с проверкой общего лимита по ходу
+    size = 0
+    with z.open(info) as src, open(staged, "wb") as dst:
+        while True:
+            chunk = src.read(EXTRACT_CHUNK)
+            if not chunk:
+                break
+            cap.add(len(chunk))
+            size += len(chunk)
+            dst.write(chunk)
+    return size
+
+
+def _extract_parallel(full_zip: str, files: dict, staged: dict, cap: _SizeCap, workers: int) -> dict:
+    # у каждого потока свой ZipFile - у общего объекта чтение сериализуется.
+    # вызывается под shared блокировкой архива: по пути открывается тот же файл, что и у плана
+    archives = threading.local()
+    opened = []
+
+    def extract(info, target):
+        z = getattr(archives, "zip", None)
+        if z is None:
+            z = archives.zip = zipfile.ZipFile(full_zip, "r")
+            opened.append(z)
+        return _extract_member(z, info, target, cap)
 
-    # Директория, куда будем распаковывать — именно та, где лежит архив
-    extract_dir = os.path.dirname(full_zip) or user_dir
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="sfm-unzip") as pool:
+        futures = {rel_path: pool.submit(extract, info, staged[rel_path]) for rel_path, info in files.items()}
+        try:
+            return {rel_path: future.result() for rel_path, future in futures.items()}
+        except BaseException:
+            for future in futures.values():
+                future.cancel()
+            raise
+        finally:
+            pool.shutdown(wait=True)
+            for z in opened:
+                z.close()
 
-    # Проверка бомбы
-    total_size = 0
-    with zipfile.ZipFile(full_zip, "r") as z:
-        for info in z.infolist():
-            if not info.is_dir():
-                total_size += info.file_size
-    if total_size > MAX_EXTRACT_SIZE:
+
+def _same_file(z: zipfile.ZipFile, full_zip: str) -> bool:
+    # открытый архив - всё ещё файл по пути full_zip (его не подменили и не дописали)
+    try:
+        current = os.stat(full_zip)
+    except FileNotFoundError:
+        return False
+    opened = os.fstat(z.fp.fileno())
+    return ((opened.st_dev, opened.st_ino, opened.st_size, opened.st_mtime_ns)
+            == (current.st_dev, current.st_ino, current.st_size, current.st_mtime_ns))
+
+
+def _extract_plan(z: zipfile.ZipFile, full_zip: str, plan: list[tuple[zipfile.ZipInfo, str]],
+                  user_id: int, user_dir: str, workers: int):
+    # быстрый отказ по заголовкам; настоящий лимит - по распакованным данным в _SizeCap
+    if sum(info.file_size for info, _ in plan if not info.is_dir()) > MAX_EXTRACT_SIZE:
         raise ValueError("ZIP-бомба обнаружена")
+    # при повторе имени в архиве побеждает последний член, как при обычной распаковке
+    files = {rel_path: info for info, rel_path in plan if not info.is_dir()}
+    dirs = [rel_path for info, rel_path in plan if info.is_dir()]
 
-    # Атомарная распаковка
-    with file_lock:
-        extracted = []
-        with zipfile.ZipFile(full_zip, "r") as z:
-            for info in z.infolist():
-                member = info.filename.rstrip("/")
+    staging = tempfile.mkdtemp(dir=os.path.dirname(full_zip) or user_dir, prefix=".extract-", suffix=".tmp")
+    try:
+        cap = _SizeCap(MAX_EXTRACT_SIZE)
+        staged = {rel_path: os.path.join(staging, str(i)) for i, rel_path in enumerate(files)}
+        if workers > 1 and len(files) > 1:
+            sizes = _extract_parallel(full_zip, files, staged, cap, workers)
+        else:
+            sizes = {rel_path: _extract_member(z, info, staged[rel_path], cap) for rel_path, info in files.items()}
 
-                # Защита от traversal
-                if member.startswith('/') or member.startswith('\\') or '../' in member or '..\\' in member:
-                    raise ValueError("Небезопасный путь в архиве")
+        for rel_path in files:
+            if os.path.isdir(os.path.join(user_dir, rel_path)):
+                raise ValueError(f"В архиве файл {rel_path}, а на диске это директория")
 
-                # Путь относительно корня хранилища (для БД)
-                rel_path = os.path.join(os.path.dirname(zip_path), member).replace("\\", "/").lstrip("/")
+        with db.transaction() as conn:
+            operations = db.record_files([(rel_path, sizes[rel_path]) for rel_path in files], user_id, conn)
+            # счётчик Usage уже учёл распакованное (с заменой существующих файлов) - файлы ещё не на месте
+            _check_quota(user_id, conn)
+            audit_log.record_many(operations, user_id, conn)
+            for rel_path in dirs:
+                db.add_directory(rel_path, user_id, conn)
+                os.makedirs(os.path.join(user_dir, rel_path), exist_ok=True)
+            for rel_path in files:
                 target = os.path.join(user_dir, rel_path)
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                os.replace(staged[rel_path], target)
+                content_cache.invalidate(target)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
 
-                if not is_safe_path(target, user_dir):
-                    raise ValueError("Небезопасный путь в архиве")
 
-                # Создаём поддиректории и извлекаем прямо в директорию архива
-                os.makedirs(os.path.dirname(target), exist_ok=True)
-                z.extract(info, extract_dir)
-
-                if not info.is_dir():
-                    f_size = os.path.getsize(target)
-                    f_id = db.get_file_id(rel_path, user_id)
-                    if f_id is not None:
-                        db.update_file_size(f_id, f_size)
-                        db.log_operation("modify", f_id, user_id)
-                    else:
-                        f_id = db.add_file(os.path.basename(rel_path), f_size, rel_path, user_id)
-                        db.log_operation("create", f_id, user_id)
-                    extracted.append(rel_path)
\ No newline at end of file
+@metrics.timed()
+def extract_zip(zip_path: str, user_id: int, user_dir: str, workers: int = 1) -> None:
+    # распаковка в директорию архива: центральный каталог читается один раз, по нему строится план,
+    # и из того же открытого архива члены распаковываются потоком во временную директорию
+    # (workers > 1 - параллельно, со своим ZipFile у каждого потока), затем под блокировкой
+    # переносятся на место, а записи Files и Operations пишутся пачками в одной транзакции
+    full_zip = os.path.join(user_dir, zip_path)
+    if not is_safe_path(full_zip, user_dir):
+        raise ValueError("Обнаружено попытка обхода пути")
+    if not os.path.exists(full_zip):
+        raise FileNotFoundError("Архив не найден")
+
+    while True:
+        try:
+            z = zipfile.ZipFile(full_zip, "r")
+        except FileNotFoundError:
+            raise FileNotFoundError("Архив не найден") from None
+        with z:
+            plan = _plan_extract(z.infolist(), zip_path, user_dir)
+            # Атомарная распаковка под exclusive на все извлекаемые пути. их список известен только
+            # из плана, поэтому архив открыт до блокировки: если его успели подменить, план строится заново
+            with lock_manager.locked(user_id, shared=[zip_path], exclusive=[rel for _, rel in plan]):
+                if _same_file(z, full_zip):
+                    _extract_plan(z, full_zip, plan, user_id, user_dir, workers)
+                    break
+    # перезаписанные файлы могли освободить blob'ы
+    blob_store.collect_garbage()